@@ -0,0 +1,152 @@
+"""
+Low-resolution, short-GOP proxies of stored assets for interactive previews.
+
+When an asset arrives, a small H.264 proxy (480p by default, a keyframe every
+PROXY_GOP frames, no B-frames) is encoded in the background and kept beside the
+source. Seeking to an exact frame of the proxy decodes at most one short GOP of a
+small picture, so preview latency no longer depends on the source resolution or
+its GOP length. Final renders always read the original.
+
+A failed encode is remembered for PROXY_RETRY_SECONDS, so previews do not retry it
+on every request, and then attempted again. At most MAX_FAILED_PROXIES failures are
+remembered at once.
+"""
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Tuple
+
+import ffmpeg
+
+import asset_store
+
+PROXY_NAME = "proxy.mp4"
+PROXY_HEIGHT = int(os.environ.get("UPSCALEFX_PROXY_HEIGHT", "480"))
+# Frames per GOP; 1 makes the proxy all-intra
+PROXY_GOP = int(os.environ.get("UPSCALEFX_PROXY_GOP", "12"))
+PROXY_CRF = 26
+PROXY_PRESET = "veryfast"
+PROXY_AUDIO_BITRATE = "96k"
+# Proxy encodes run in the background and should not starve foreground jobs
+PROXY_WORKERS = max(1, int(os.environ.get("UPSCALEFX_PROXY_WORKERS", "1")))
+# A failed proxy is scheduled again once this long has passed
+PROXY_RETRY_SECONDS = float(os.environ.get("UPSCALEFX_PROXY_RETRY_SECONDS", "600"))
+MAX_FAILED_PROXIES = 1000
+
+_executor = ThreadPoolExecutor(max_workers=PROXY_WORKERS, thread_name_prefix="asset_proxy")
+_jobs: Dict[str, Dict[str, Any]] = {}
+_jobs_lock = threading.Lock()
+
+
+def proxy_path(asset_id: str) -> str:
+    return os.path.join(asset_store.asset_dir(asset_id), PROXY_NAME)
+
+
+def generate_proxy(input_path: str, output_path: str) -> str:
+    """Encodes the proxy of input_path to output_path, replacing it atomically when done."""
+    try:
+        probe = ffmpeg.probe(input_path)
+    except ffmpeg.Error as e:
+        raise ValueError(f"Error probing video file: {e.stderr.decode('utf8') if e.stderr else 'Unknown ffmpeg error'}")
+    video_stream = next((s for s in probe["streams"] if s["codec_type"] == "video" and not s.get("disposition", {}).get("attached_pic")), None)
+    if video_stream is None:
+        raise ValueError("No video stream found")
+    has_audio = any(s["codec_type"] == "audio" for s in probe["streams"])
+    # Never upscale; libx264 needs even dimensions
+    height = min(PROXY_HEIGHT, int(video_stream["height"])) // 2 * 2
+
+    source = ffmpeg.input(input_path)
+    streams = [source[str(video_stream["index"])].filter("scale", -2, height)]
+    audio_options = {}
+    if has_audio:
+        streams.append(source["a:0"])
+        audio_options = {"acodec": "aac", "audio_bitrate": PROXY_AUDIO_BITRATE, "ac": 2}
+
+    tmp_path = f"{output_path}.{uuid.uuid4().hex}.mp4"
+    try:
+        (
+            ffmpeg
+            .output(
+                *streams, tmp_path,
+                vcodec="libx264", preset=PROXY_PRESET, crf=PROXY_CRF, tune="fastdecode",
+                g=PROXY_GOP, keyint_min=PROXY_GOP, sc_threshold=0, bf=0, pix_fmt="yuv420p",
+                movflags="+faststart", sn=None, **audio_options
+            )
+            .global_args("-nostdin")
+            .overwrite_output()
+            .run(quiet=True)
+        )
+        os.replace(tmp_path, output_path)
+    except ffmpeg.Error as e:
+        raise Exception(f"FFmpeg error while encoding proxy: {e.stderr.decode('utf8') if e.stderr else 'Unknown ffmpeg error'}")
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return output_path
+
+
+def _forget_failures_locked(now: float) -> None:
+    """Drops failures older than PROXY_RETRY_SECONDS, then the oldest beyond MAX_FAILED_PROXIES."""
+    failed = [asset_id for asset_id, job in _jobs.items() if job["status"] == "failed"]
+    for asset_id in failed:
+        if now - _jobs[asset_id]["failed_at"] >= PROXY_RETRY_SECONDS:
+            del _jobs[asset_id]
+    # Failures are recorded in order, so the dict holds the oldest first
+    failed = [asset_id for asset_id in failed if asset_id in _jobs]
+    for asset_id in failed[:max(0, len(failed) - MAX_FAILED_PROXIES)]:
+        del _jobs[asset_id]
+
+
+def _run_job(asset_id: str) -> None:
+    try:
+        generate_proxy(asset_store.get_asset(asset_id)["path"], proxy_path(asset_id))
+        with _jobs_lock:
+            _jobs.pop(asset_id, None)
+    except Exception as e:
+        print(f"Error while generating proxy for asset {asset_id}: {str(e)}")
+        with _jobs_lock:
+            _jobs.pop(asset_id, None)
+            _jobs[asset_id] = {"status": "failed", "error": str(e), "failed_at": time.time()}
+            _forget_failures_locked(time.time())
+
+
+def proxy_status(asset_id: str) -> Dict[str, Any]:
+    """"ready", "generating", "failed" (with "error") or "missing"."""
+    if os.path.exists(proxy_path(asset_id)):
+        return {"status": "ready"}
+    with _jobs_lock:
+        _forget_failures_locked(time.time())
+        return dict(_jobs.get(asset_id, {"status": "missing"}))
+
+
+def schedule_proxy(asset_id: str, retry_failed: bool = False) -> Dict[str, Any]:
+    """
+    Queues the proxy encode of an asset unless its proxy exists or is already being
+    generated by this process. A recent failure is only retried with retry_failed.
+    Returns the resulting status.
+    """
+    asset_store.get_asset(asset_id)
+    with _jobs_lock:
+        if os.path.exists(proxy_path(asset_id)):
+            return {"status": "ready"}
+        _forget_failures_locked(time.time())
+        job = _jobs.get(asset_id)
+        if job and (job["status"] == "generating" or not retry_failed):
+            return dict(job)
+        _jobs[asset_id] = {"status": "generating"}
+    _executor.submit(_run_job, asset_id)
+    return {"status": "generating"}
+
+
+def preview_input(asset_id: str) -> Tuple[str, bool]:
+    """
+    Returns (path, is_proxy): the proxy when it is ready, otherwise the original,
+    after queueing the proxy so later previews can use it.
+    """
+    path = proxy_path(asset_id)
+    if os.path.exists(path):
+        return path, True
+    schedule_proxy(asset_id)
+    return asset_store.get_asset(asset_id)["path"], False
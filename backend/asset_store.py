@@ -0,0 +1,459 @@
+"""
+Content-addressed asset store fed by resumable, parallel chunked uploads.
+
+An upload session preallocates its target file and accepts chunks at arbitrary
+offsets. Each chunk is spooled to a scratch file, verified against an optional
+per-chunk SHA-256, and only then copied into place. Received byte ranges are
+tracked in a JSON sidecar so a client can resume after a dropped connection.
+When every byte has arrived, the whole-file hash becomes the asset id; identical
+content is stored once, and a client that announces a hash the store already
+holds skips the upload entirely.
+"""
+import base64
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, List, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows: sessions are only locked within this process
+    fcntl = None
+
+ASSET_DIR = os.environ.get("UPSCALEFX_ASSET_DIR", "assets")
+UPLOAD_SESSION_DIR = os.environ.get("UPSCALEFX_UPLOAD_SESSION_DIR", os.path.join("temp_uploads", "sessions"))
+SOURCE_NAME = "source"
+HASH_CHUNK_SIZE = 1024 * 1024
+# Largest upload a session may declare; its space is reserved when the session opens
+MAX_UPLOAD_BYTES = int(float(os.environ.get("UPSCALEFX_MAX_UPLOAD_MB", "16384")) * 1024 * 1024)
+# Sessions without a chunk for this long are removed, along with their reserved file
+UPLOAD_SESSION_TTL_SECONDS = float(os.environ.get("UPSCALEFX_UPLOAD_SESSION_TTL_HOURS", "24")) * 3600
+# Expired sessions are swept when a new one opens, at most this often
+SESSION_SWEEP_INTERVAL_SECONDS = 300
+
+# Guards _upload_locks and _last_sweep; never held while a session is in use
+_session_lock = threading.Lock()
+# Per-upload locks with the number of threads using each, dropped when unused
+_upload_locks: Dict[str, List[Any]] = {}
+_last_sweep = 0.0
+
+
+class UploadChecksumError(ValueError):
+    """A chunk or the assembled file did not match the checksum the client announced."""
+
+
+class UploadClosedError(ValueError):
+    """A chunk arrived for an upload that is already being finalized or complete."""
+
+
+class UploadTooLargeError(ValueError):
+    """The declared upload size is over MAX_UPLOAD_BYTES or the free disk space."""
+
+
+def _is_hex_digest(value: str) -> bool:
+    return len(value) == 64 and all(c in "0123456789abcdef" for c in value)
+
+
+def asset_dir(asset_id: str) -> str:
+    if not _is_hex_digest(asset_id):
+        raise FileNotFoundError(f"Asset not found: {asset_id}")
+    return os.path.join(ASSET_DIR, asset_id[:2], asset_id)
+
+
+def get_asset(asset_id: str) -> Dict[str, Any]:
+    """Returns the stored record of an asset, including the path of its source file."""
+    manifest_path = os.path.join(asset_dir(asset_id), "asset.json")
+    if not os.path.exists(manifest_path):
+        raise FileNotFoundError(f"Asset not found: {asset_id}")
+    with open(manifest_path) as f:
+        record = json.load(f)
+    record["path"] = os.path.join(asset_dir(asset_id), record["source"])
+    return record
+
+
+def asset_exists(asset_id: str) -> bool:
+    try:
+        get_asset(asset_id)
+        return True
+    except FileNotFoundError:
+        return False
+
+
+def store_file(path: str, filename: str, asset_id: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Moves a complete file into the store under its SHA-256, or discards it if the
+    content is already stored. Returns the asset record.
+    """
+    if asset_id is None:
+        asset_id = hash_file(path)
+    if asset_exists(asset_id):
+        os.remove(path)
+        return get_asset(asset_id)
+
+    extension = os.path.splitext(filename)[1].lower() or ".mp4"
+    target_dir = asset_dir(asset_id)
+    os.makedirs(target_dir, exist_ok=True)
+    source = f"{SOURCE_NAME}{extension}"
+    os.replace(path, os.path.join(target_dir, source))
+    record = {
+        "asset_id": asset_id,
+        "filename": filename,
+        "size": os.path.getsize(os.path.join(target_dir, source)),
+        "source": source,
+        "created_at": time.time(),
+    }
+    # Written last and atomically: an asset exists once its manifest does
+    tmp_manifest = os.path.join(target_dir, f".asset.{uuid.uuid4().hex}.json")
+    with open(tmp_manifest, "w") as f:
+        json.dump(record, f)
+    os.replace(tmp_manifest, os.path.join(target_dir, "asset.json"))
+    return get_asset(asset_id)
+
+
+def hash_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _merge_range(ranges: List[List[int]], start: int, end: int) -> List[List[int]]:
+    """Adds the half-open range [start, end) to a sorted list of disjoint ranges."""
+    merged: List[List[int]] = []
+    for r_start, r_end in sorted(ranges + [[start, end]]):
+        if merged and r_start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], r_end)
+        else:
+            merged.append([r_start, r_end])
+    return merged
+
+
+def _contiguous_offset(ranges: List[List[int]]) -> int:
+    return ranges[0][1] if ranges and ranges[0][0] == 0 else 0
+
+
+def _session_paths(upload_id: str) -> Dict[str, str]:
+    try:
+        uuid.UUID(upload_id)
+    except ValueError:
+        raise FileNotFoundError(f"Upload not found: {upload_id}")
+    base = os.path.join(UPLOAD_SESSION_DIR, upload_id)
+    return {"state": f"{base}.json", "data": f"{base}.part", "lock": f"{base}.lock"}
+
+
+@contextmanager
+def _upload_lock(upload_id: str):
+    with _session_lock:
+        entry = _upload_locks.setdefault(upload_id, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            yield
+    finally:
+        with _session_lock:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del _upload_locks[upload_id]
+
+
+@contextmanager
+def _locked_session(upload_id: str):
+    """Serialises state updates of one upload across threads and uvicorn worker processes."""
+    paths = _session_paths(upload_id)
+    if not os.path.exists(paths["state"]):
+        raise FileNotFoundError(f"Upload not found: {upload_id}")
+    with _upload_lock(upload_id), open(paths["lock"], "a") as lock_file:
+        if fcntl:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            with open(paths["state"]) as f:
+                state = json.load(f)
+            try:
+                yield paths, state
+            finally:
+                # Persisted even when the caller fails, e.g. to record a reset after a bad hash
+                tmp_state = f"{paths['state']}.{uuid.uuid4().hex}"
+                with open(tmp_state, "w") as f:
+                    json.dump(state, f)
+                os.replace(tmp_state, paths["state"])
+        finally:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _public_state(state: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "upload_id": state["upload_id"],
+        "size": state["size"],
+        "filename": state["filename"],
+        "received": state["received"],
+        "offset": _contiguous_offset(state["received"]),
+        "complete": state["status"] == "complete",
+        "asset_id": state.get("asset_id"),
+        "deduplicated": state.get("deduplicated", False),
+    }
+
+
+def create_upload(size: int, filename: str, sha256: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Opens an upload session for a file of the given size. When sha256 names content
+    the store already holds, no session is needed and the existing asset is returned.
+    """
+    if size <= 0:
+        raise ValueError("Upload size must be a positive number of bytes.")
+    if MAX_UPLOAD_BYTES > 0 and size > MAX_UPLOAD_BYTES:
+        raise UploadTooLargeError(f"Upload size exceeds the limit of {MAX_UPLOAD_BYTES} bytes.")
+    if sha256 is not None:
+        sha256 = sha256.lower()
+        if not _is_hex_digest(sha256):
+            raise ValueError("sha256 must be a 64 character hex digest.")
+        if asset_exists(sha256):
+            return {
+                "upload_id": None,
+                "size": size,
+                "filename": filename,
+                "received": [[0, size]],
+                "offset": size,
+                "complete": True,
+                "asset_id": sha256,
+                "deduplicated": True,
+            }
+
+    os.makedirs(UPLOAD_SESSION_DIR, exist_ok=True)
+    _maybe_sweep_sessions()
+    if size > shutil.disk_usage(UPLOAD_SESSION_DIR).free:
+        raise UploadTooLargeError("Not enough free disk space for an upload of this size.")
+    upload_id = str(uuid.uuid4())
+    paths = _session_paths(upload_id)
+    fd = os.open(paths["data"], os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+    try:
+        # Reserve the space up front so parallel chunks never race to extend the file
+        try:
+            os.posix_fallocate(fd, 0, size)
+        except (AttributeError, OSError):
+            os.ftruncate(fd, size)
+    finally:
+        os.close(fd)
+    state = {
+        "upload_id": upload_id,
+        "size": size,
+        "filename": filename,
+        "sha256": sha256,
+        "received": [],
+        "status": "uploading",
+        "created_at": time.time(),
+    }
+    with open(paths["state"], "w") as f:
+        json.dump(state, f)
+    return _public_state(state)
+
+
+def get_upload(upload_id: str) -> Dict[str, Any]:
+    paths = _session_paths(upload_id)
+    if not os.path.exists(paths["state"]):
+        raise FileNotFoundError(f"Upload not found: {upload_id}")
+    with open(paths["state"]) as f:
+        return _public_state(json.load(f))
+
+
+def parse_checksum_header(header_value: Optional[str]) -> Optional[bytes]:
+    """Parses a tus-style 'sha256 <base64 digest>' Upload-Checksum header."""
+    if not header_value:
+        return None
+    algorithm, _, encoded = header_value.strip().partition(" ")
+    if algorithm.lower() != "sha256":
+        raise ValueError(f"Unsupported checksum algorithm: {algorithm}. Supported: 'sha256'.")
+    try:
+        digest = base64.b64decode(encoded.strip(), validate=True)
+    except ValueError:
+        raise ValueError("Upload-Checksum digest must be base64 encoded.")
+    if len(digest) != 32:
+        raise ValueError("Upload-Checksum digest has the wrong length for sha256.")
+    return digest
+
+
+def _pwrite_all(fd: int, data: Any, position: int) -> None:
+    view = memoryview(data)
+    while view:
+        written = os.pwrite(fd, view, position)
+        position += written
+        view = view[written:]
+
+
+class ChunkWriter:
+    """
+    Receives one chunk of an upload, starting at offset. Chunks may arrive in any
+    order and in parallel; a chunk only counts as received once commit() has verified
+    its checksum.
+
+    The bytes go to a scratch file of their own and are copied into the upload file
+    by commit(), under the session lock and only while the upload is still open. A
+    corrupt, overlapping or late chunk therefore never changes verified data or a
+    file that is being hashed or has been stored.
+    """
+
+    def __init__(self, upload_id: str, offset: int):
+        self.upload_id = upload_id
+        self.paths = _session_paths(upload_id)
+        if not os.path.exists(self.paths["state"]):
+            raise FileNotFoundError(f"Upload not found: {upload_id}")
+        with open(self.paths["state"]) as f:
+            state = json.load(f)
+        self.size = state["size"]
+        if state["status"] != "uploading":
+            raise UploadClosedError(f"Upload {upload_id} is {state['status']} and takes no more chunks.")
+        if offset < 0 or offset >= self.size:
+            raise ValueError(f"Upload-Offset {offset} is outside the declared size of {self.size} bytes.")
+        self.offset = offset
+        self.position = offset
+        self._digest = hashlib.sha256()
+        self._scratch_path = f"{os.path.splitext(self.paths['data'])[0]}.{uuid.uuid4().hex}.chunk"
+        self._scratch_fd: Optional[int] = os.open(self._scratch_path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o644)
+
+    def write(self, data: bytes) -> None:
+        if self._scratch_fd is None:
+            raise ValueError(f"Chunk at offset {self.offset} is already closed.")
+        if self.position + len(data) > self.size:
+            raise ValueError(f"Chunk at offset {self.offset} runs past the declared size of {self.size} bytes.")
+        self._digest.update(data)
+        _pwrite_all(self._scratch_fd, data, self.position - self.offset)
+        self.position += len(data)
+
+    def _apply(self, data_fd: int) -> None:
+        """Copies the scratch bytes into the upload file. Called with the session locked."""
+        copied = 0
+        length = self.position - self.offset
+        while copied < length:
+            count = min(HASH_CHUNK_SIZE, length - copied)
+            if hasattr(os, "copy_file_range"):
+                # Copied by the kernel, without passing through this process
+                written = os.copy_file_range(self._scratch_fd, data_fd, count, copied, self.offset + copied)
+            else:
+                block = os.pread(self._scratch_fd, count, copied)
+                _pwrite_all(data_fd, block, self.offset + copied)
+                written = len(block)
+            if written <= 0:
+                raise OSError(f"Scratch file of the chunk at offset {self.offset} is truncated.")
+            copied += written
+
+    def commit(self, checksum: Optional[bytes] = None) -> Dict[str, Any]:
+        """Records the written range and completes the upload when the last gap is filled."""
+        try:
+            if checksum is not None and self._digest.digest() != checksum:
+                raise UploadChecksumError(f"Checksum mismatch for chunk at offset {self.offset}.")
+            with _locked_session(self.upload_id) as (paths, state):
+                if state["status"] != "uploading":
+                    # Being hashed or already stored: nothing may change the file now
+                    raise UploadClosedError(f"Upload {self.upload_id} is {state['status']} and takes no more chunks.")
+                if self.position > self.offset:
+                    data_fd = os.open(paths["data"], os.O_WRONLY)
+                    try:
+                        self._apply(data_fd)
+                    finally:
+                        os.close(data_fd)
+                    state["received"] = _merge_range(state["received"], self.offset, self.position)
+                if state["received"] != [[0, self.size]]:
+                    return _public_state(state)
+                # Hashing the whole file takes long; other requests must not wait for it
+                state["status"] = "finalizing"
+        finally:
+            self.close()
+        return _finalize(self.upload_id)
+
+    def close(self) -> None:
+        """Closes and removes the scratch file; uncommitted bytes are discarded."""
+        if self._scratch_fd is not None:
+            os.close(self._scratch_fd)
+            self._scratch_fd = None
+            os.remove(self._scratch_path)
+
+
+def write_chunk(upload_id: str, offset: int, chunks: Iterable[bytes], checksum: Optional[bytes] = None) -> Dict[str, Any]:
+    """Convenience wrapper writing an iterable of byte strings as one chunk."""
+    writer = ChunkWriter(upload_id, offset)
+    try:
+        for data in chunks:
+            writer.write(data)
+    except BaseException:
+        writer.close()
+        raise
+    return writer.commit(checksum)
+
+
+def _finalize(upload_id: str) -> Dict[str, Any]:
+    """
+    Verifies the whole file and moves it into the store. The session is marked
+    "finalizing" by the caller, so the file is hashed without holding its lock.
+    """
+    paths = _session_paths(upload_id)
+    try:
+        file_hash = hash_file(paths["data"])
+    except BaseException:
+        with _locked_session(upload_id) as (paths, state):
+            state["status"] = "uploading"
+        raise
+    with _locked_session(upload_id) as (paths, state):
+        if state.get("sha256") and state["sha256"] != file_hash:
+            state["received"] = []
+            state["status"] = "uploading"
+            raise UploadChecksumError("Uploaded file does not match the announced sha256; all chunks must be re-sent.")
+        state["deduplicated"] = asset_exists(file_hash)
+        store_file(paths["data"], state["filename"], asset_id=file_hash)
+        state["status"] = "complete"
+        state["asset_id"] = file_hash
+        return _public_state(state)
+
+
+def expire_sessions(max_age: float = UPLOAD_SESSION_TTL_SECONDS, now: Optional[float] = None) -> List[str]:
+    """Removes sessions (finished or not) idle for longer than max_age; returns their ids."""
+    now = time.time() if now is None else now
+    expired = []
+    try:
+        entries = list(os.scandir(UPLOAD_SESSION_DIR))
+    except FileNotFoundError:
+        return expired
+    sessions: Dict[str, List[os.DirEntry]] = {}
+    for entry in entries:
+        sessions.setdefault(entry.name.split(".", 1)[0], []).append(entry)
+    for upload_id, files in sessions.items():
+        try:
+            _session_paths(upload_id)
+        except FileNotFoundError:
+            continue
+        # Files of a session (state, data, lock and chunk scratch files) are touched on
+        # every chunk; the newest one dates its last activity
+        try:
+            last_activity = max(entry.stat().st_mtime for entry in files)
+        except FileNotFoundError:
+            continue
+        if now - last_activity > max_age:
+            for entry in files:
+                if os.path.exists(entry.path):
+                    os.remove(entry.path)
+            expired.append(upload_id)
+    return expired
+
+
+def _maybe_sweep_sessions() -> None:
+    global _last_sweep
+    with _session_lock:
+        if time.time() - _last_sweep < SESSION_SWEEP_INTERVAL_SECONDS:
+            return
+        _last_sweep = time.time()
+    for upload_id in expire_sessions():
+        print(f"Removed upload session {upload_id} after {UPLOAD_SESSION_TTL_SECONDS / 3600:g} hours without activity.")
+
+
+def cancel_upload(upload_id: str) -> None:
+    paths = _session_paths(upload_id)
+    if not os.path.exists(paths["state"]):
+        raise FileNotFoundError(f"Upload not found: {upload_id}")
+    for path in paths.values():
+        if os.path.exists(path):
+            os.remove(path)
@@ -0,0 +1,211 @@
+"""
+Batch scheduling of processing jobs described by a manifest.
+
+A manifest is either a JSON list of items or an object with an "items" list and an
+optional "concurrency". Each item names its input (an "asset_id" from the asset
+store or a server-side "path"), an "operation" and its "params":
+
+    {"concurrency": 4, "items": [
+        {"id": "intro", "path": "/media/intro.mov", "operation": "upscale", "params": {"scale_option": "2x"}},
+        {"asset_id": "9f86d0...", "operation": "compress", "params": {"quality_preset": "low"}}
+    ]}
+
+Batches run in the background on one executor shared by all batches, so at most
+BATCH_MAX_CONCURRENCY items run at once in this process, whoever is watching. Results
+are recorded as they complete; finished batches are forgotten after
+BATCH_RETENTION_SECONDS.
+
+Usage: python batch.py manifest.json [--concurrency N]
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+BATCH_MAX_CONCURRENCY = int(os.environ.get("UPSCALEFX_BATCH_MAX_CONCURRENCY", str(max(1, os.cpu_count() or 1))))
+# Finished batches stay available for status requests this long
+BATCH_RETENTION_SECONDS = float(os.environ.get("UPSCALEFX_BATCH_RETENTION_HOURS", "24")) * 3600
+
+# Status of batches started by this process, keyed by batch id
+BATCHES: Dict[str, Dict[str, Any]] = {}
+_batches_lock = threading.Lock()
+# Notified whenever an item of any batch finishes
+_batches_changed = threading.Condition(_batches_lock)
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+def parse_manifest(manifest: Any) -> Dict[str, Any]:
+    """Normalises a manifest into {"items": [...], "concurrency": int | None}."""
+    if isinstance(manifest, list):
+        manifest = {"items": manifest}
+    if not isinstance(manifest, dict) or not isinstance(manifest.get("items"), list):
+        raise ValueError("Manifest must be a list of items or an object with an 'items' list.")
+    if not manifest["items"]:
+        raise ValueError("Manifest contains no items.")
+    for index, item in enumerate(manifest["items"]):
+        if not isinstance(item, dict):
+            raise ValueError(f"Manifest item {index} must be an object.")
+        if not item.get("operation"):
+            raise ValueError(f"Manifest item {index} has no 'operation'.")
+        if bool(item.get("asset_id")) == bool(item.get("path")):
+            raise ValueError(f"Manifest item {index} needs exactly one of 'asset_id' or 'path'.")
+        if not isinstance(item.get("params", {}), dict):
+            raise ValueError(f"Manifest item {index} 'params' must be an object.")
+    concurrency = manifest.get("concurrency")
+    if concurrency is not None and (not isinstance(concurrency, int) or concurrency <= 0):
+        raise ValueError("Manifest 'concurrency' must be a positive integer.")
+    return {"items": manifest["items"], "concurrency": concurrency}
+
+
+def _shared_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _batches_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=BATCH_MAX_CONCURRENCY, thread_name_prefix="batch")
+        return _executor
+
+
+def expire_batches(now: Optional[float] = None) -> None:
+    """Forgets batches that finished more than BATCH_RETENTION_SECONDS ago."""
+    now = time.time() if now is None else now
+    with _batches_lock:
+        for batch_id in [b for b, batch in BATCHES.items() if batch.get("finished_at") and now - batch["finished_at"] > BATCH_RETENTION_SECONDS]:
+            del BATCHES[batch_id]
+
+
+def start_batch(
+    items: List[Dict[str, Any]],
+    run_item: Callable[[str, int, Dict[str, Any]], Dict[str, Any]],
+    concurrency: Optional[int] = None,
+    batch_id: Optional[str] = None,
+) -> str:
+    """
+    Starts running run_item(batch_id, index, item) for every item in the background,
+    with at most `concurrency` of them running at once, and returns the batch id.
+    run_item returns a dict merged into the item's status (e.g. output path or URL).
+    Finished items are read with wait_for_results().
+    """
+    expire_batches()
+    batch_id = batch_id or str(uuid.uuid4())
+    concurrency = max(1, min(concurrency or BATCH_MAX_CONCURRENCY, BATCH_MAX_CONCURRENCY))
+    statuses = [
+        {"batch_id": batch_id, "index": index, "id": item.get("id", str(index)), "operation": item["operation"], "status": "queued"}
+        for index, item in enumerate(items)
+    ]
+    finished: List[Dict[str, Any]] = []
+    with _batches_lock:
+        BATCHES[batch_id] = {"batch_id": batch_id, "concurrency": concurrency, "items": statuses, "finished": finished, "finished_at": None}
+    executor = _shared_executor()
+
+    def execute(index: int) -> Dict[str, Any]:
+        status = statuses[index]
+        status["status"] = "running"
+        started = time.monotonic()
+        try:
+            status.update(run_item(batch_id, index, items[index]))
+            status["status"] = "complete"
+        except Exception as e:
+            print(f"Error in batch {batch_id} item {index}: {str(e)}")
+            status.update({"status": "failed", "error": str(e)})
+        status["elapsed_seconds"] = round(time.monotonic() - started, 3)
+        with _batches_changed:
+            finished.append(dict(status))
+            _batches_changed.notify_all()
+        return status
+
+    def schedule() -> None:
+        # Items are submitted only as slots free up, so a large manifest never floods the shared pool
+        pending = set()
+        next_index = 0
+        while next_index < len(items) or pending:
+            while next_index < len(items) and len(pending) < concurrency:
+                pending.add(executor.submit(execute, next_index))
+                next_index += 1
+            _, pending = wait(pending, return_when=FIRST_COMPLETED)
+        with _batches_changed:
+            BATCHES[batch_id]["finished_at"] = time.time()
+            _batches_changed.notify_all()
+
+    threading.Thread(target=schedule, name=f"batch-{batch_id[:8]}", daemon=True).start()
+    return batch_id
+
+
+def wait_for_results(batch_id: str, start: int = 0, timeout: Optional[float] = None) -> Tuple[List[Dict[str, Any]], bool]:
+    """
+    Returns the results of the batch's items that finished after the first `start`,
+    waiting up to timeout seconds for one when there are none yet, and whether the
+    whole batch has finished. Raises KeyError for unknown or expired batches.
+    """
+    with _batches_changed:
+        batch = BATCHES[batch_id]
+        _batches_changed.wait_for(lambda: len(batch["finished"]) > start or batch["finished_at"] is not None, timeout)
+        return batch["finished"][start:], batch["finished_at"] is not None
+
+
+def run_batch(
+    items: List[Dict[str, Any]],
+    run_item: Callable[[str, int, Dict[str, Any]], Dict[str, Any]],
+    concurrency: Optional[int] = None,
+    batch_id: Optional[str] = None,
+) -> Iterator[Dict[str, Any]]:
+    """Starts a batch and yields each item's result as soon as it finishes."""
+    batch_id = start_batch(items, run_item, concurrency=concurrency, batch_id=batch_id)
+    received = 0
+    while True:
+        results, done = wait_for_results(batch_id, received)
+        yield from results
+        received += len(results)
+        if done:
+            return
+
+
+def batch_summary(batch_id: str) -> Dict[str, Any]:
+    """Per-item status of a batch; raises KeyError for unknown or expired batches."""
+    expire_batches()
+    with _batches_lock:
+        batch = BATCHES[batch_id]
+        items = [dict(status) for status in batch["items"]]
+    counts: Dict[str, int] = {}
+    for status in items:
+        counts[status["status"]] = counts.get(status["status"], 0) + 1
+    return {
+        "batch_id": batch_id,
+        "concurrency": batch["concurrency"],
+        "total": len(items),
+        "finished": batch["finished_at"] is not None,
+        "counts": counts,
+        "items": items,
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Run a batch manifest against local files and print one JSON line per finished item.")
+    parser.add_argument("manifest", help="Path to the manifest JSON file, or '-' for stdin")
+    parser.add_argument("--concurrency", type=int, default=None, help="Maximum number of items processed at once")
+    args = parser.parse_args(argv)
+
+    manifest_file = sys.stdin if args.manifest == "-" else open(args.manifest)
+    with manifest_file:
+        manifest = parse_manifest(json.load(manifest_file))
+
+    # Imported here so the CLI shares the API's operations without a circular import
+    from main import run_batch_item
+
+    failures = 0
+    for result in run_batch(
+        manifest["items"],
+        lambda batch_id, index, item: run_batch_item(batch_id, index, item, allow_any_path=True),
+        concurrency=args.concurrency or manifest["concurrency"],
+    ):
+        failures += result["status"] == "failed"
+        print(json.dumps(result), flush=True)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,245 @@
+"""
+Choosing an x264 CRF for a size or quality target from a few sample encodes.
+
+Short windows spread across the timeline are encoded at a handful of probe CRFs,
+all in parallel. Bitrate is close to exponential in CRF and SSIM (in dB) close to
+linear, so the probe points are interpolated in log-bitrate / SSIM-dB space to find
+the CRF that meets the target. Nothing is extrapolated: when the target lies outside
+the probed CRFs, search_crf() probes further out first, and a target still out of
+reach gets the nearest probed CRF. The caller then runs a single full encode at that CRF.
+"""
+import math
+import os
+import re
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+import ffmpeg
+
+PROBE_CRFS = (18, 24, 30, 36)
+SAMPLE_COUNT = 4
+SAMPLE_SECONDS = 3.0
+SEARCH_PRESET = "medium"
+CRF_RANGE = (12.0, 51.0)
+# Extra probe rounds when the target lies outside the probed CRFs
+EXTRA_PROBES = 2
+# How far past the extrapolated CRF an extra probe goes, so it brackets the target
+PROBE_MARGIN = 2
+# Container overhead not captured by the sample bitrates
+MUXING_OVERHEAD = 0.02
+DEFAULT_AUDIO_BITRATE = 128_000
+
+
+def sample_windows(duration: float, count: int = SAMPLE_COUNT, seconds: float = SAMPLE_SECONDS) -> List[Tuple[float, float]]:
+    """(start, length) windows centred in equal parts of the timeline; short inputs are sampled whole."""
+    if duration <= count * seconds * 2:
+        return [(0.0, duration)]
+    part = duration / count
+    return [(max(0.0, part * (i + 0.5) - seconds / 2), seconds) for i in range(count)]
+
+
+def ssim_to_db(ssim: float) -> float:
+    return -10 * math.log10(max(1e-10, 1 - ssim))
+
+
+def db_to_ssim(db: float) -> float:
+    return 1 - 10 ** (-db / 10)
+
+
+def _crf_for(crfs: List[float], values: List[float], target: float) -> Optional[float]:
+    """
+    CRF at which a value that falls with CRF (log bitrate, SSIM in dB) reaches target,
+    interpolated linearly between neighbouring probe points. None when target lies
+    outside the probed values.
+    """
+    points = list(zip(crfs, values))
+    if target > values[0]:
+        return None
+    if len(points) == 1:
+        return crfs[0] if target == values[0] else None
+    segment = next(((a, b) for a, b in zip(points, points[1:]) if b[1] <= target), None)
+    if segment is None:
+        return None
+    (c0, v0), (c1, v1) = segment
+    if v1 >= v0:
+        # Flat or noisy segment: the value does not react to CRF here
+        return c0 if target >= v0 else c1
+    return c0 + (target - v0) * (c1 - c0) / (v1 - v0)
+
+
+def _probe_beyond(crfs: List[float], values: List[float], target: float) -> Optional[float]:
+    """
+    CRF to probe next when target lies outside the probed values: where the end segment
+    on that side reaches it, plus PROBE_MARGIN further out, within CRF_RANGE. None when
+    the probes already bracket target or the bound on that side has been probed.
+    """
+    if _crf_for(crfs, values, target) is not None:
+        return None
+    below = target > values[0]
+    crf = CRF_RANGE[0] if below else CRF_RANGE[1]
+    if len(crfs) > 1:
+        (c0, v0), (c1, v1) = ((crfs[0], values[0]), (crfs[1], values[1])) if below else ((crfs[-2], values[-2]), (crfs[-1], values[-1]))
+        if v1 < v0:
+            reached = c0 + (target - v0) * (c1 - c0) / (v1 - v0)
+            crf = math.floor(reached) - PROBE_MARGIN if below else math.ceil(reached) + PROBE_MARGIN
+    crf = int(min(max(crf, CRF_RANGE[0]), CRF_RANGE[1]))
+    return None if crf in crfs else crf
+
+
+def _value_at(crfs: List[float], values: List[float], crf: float) -> float:
+    """Piecewise-linear value at crf, which lies within the probed CRFs."""
+    if len(crfs) == 1:
+        return values[0]
+    index = min(max(next((i for i, c in enumerate(crfs) if c > crf), len(crfs)) - 1, 0), len(crfs) - 2)
+    c0, c1, v0, v1 = crfs[index], crfs[index + 1], values[index], values[index + 1]
+    return v0 + (crf - c0) * (v1 - v0) / (c1 - c0)
+
+
+def _measure_ssim(sample_path: str, input_path: str, start: float, length: float) -> float:
+    _, stderr = (
+        ffmpeg
+        .filter([ffmpeg.input(sample_path), ffmpeg.input(input_path, ss=start, t=length)], "ssim")
+        .output("-", format="null")
+        .run(capture_stdout=True, capture_stderr=True)
+    )
+    match = re.search(r"All:([\d.]+)", stderr.decode("utf-8", errors="ignore"))
+    if not match:
+        raise Exception("Could not read SSIM of a sample encode.")
+    return float(match.group(1))
+
+
+def _encode_sample(input_path: str, window: Tuple[float, float], crf: float, work_dir: str, threads: int, measure_ssim: bool) -> Dict[str, Any]:
+    start, length = window
+    sample_path = os.path.join(work_dir, f"sample_{start:.3f}_{crf}.mp4")
+    (
+        ffmpeg
+        .input(input_path, ss=start, t=length)
+        .output(sample_path, an=None, sn=None, vcodec="libx264", crf=crf, preset=SEARCH_PRESET, threads=threads)
+        .global_args("-nostdin")
+        .overwrite_output()
+        .run(quiet=True)
+    )
+    result = {"start": start, "length": length, "crf": crf, "bytes": os.path.getsize(sample_path)}
+    if measure_ssim:
+        result["ssim"] = _measure_ssim(sample_path, input_path, start, length)
+    os.remove(sample_path)
+    return result
+
+
+def probe_samples(input_path: str, duration: float, measure_ssim: bool = False, crfs=PROBE_CRFS) -> List[Dict[str, Any]]:
+    """Encodes every sample window at every probe CRF in parallel."""
+    windows = sample_windows(duration)
+    jobs = [(window, crf) for crf in crfs for window in windows]
+    cpus = os.cpu_count() or 1
+    workers = min(len(jobs), cpus)
+    threads = max(1, cpus // workers)
+    with tempfile.TemporaryDirectory(prefix="crf_search_") as work_dir, ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(_encode_sample, input_path, window, crf, work_dir, threads, measure_ssim) for window, crf in jobs]
+        return [future.result() for future in futures]
+
+
+def _per_crf(samples: List[Dict[str, Any]]) -> Dict[float, Dict[str, float]]:
+    """Aggregates samples into the bitrate and mean SSIM of each probe CRF."""
+    totals: Dict[float, Dict[str, float]] = {}
+    for sample in samples:
+        total = totals.setdefault(sample["crf"], {"bits": 0.0, "seconds": 0.0, "ssim": 0.0, "count": 0})
+        total["bits"] += sample["bytes"] * 8
+        total["seconds"] += sample["length"]
+        total["ssim"] += sample.get("ssim", 0.0)
+        total["count"] += 1
+    return {
+        crf: {"bitrate": t["bits"] / t["seconds"], "ssim": t["ssim"] / t["count"]}
+        for crf, t in sorted(totals.items())
+    }
+
+
+def _clamp_crf(crf: float, round_up: bool) -> float:
+    """
+    Clamps crf to CRF_RANGE at a step of 0.1, rounded towards the side that still meets
+    the target: up (smaller output) for a size cap, down (better quality) for an SSIM floor.
+    """
+    # Rounded first so float noise (23.0000001) does not move an exact step
+    tenths = round(crf * 10, 4)
+    tenths = math.ceil(tenths) if round_up else math.floor(tenths)
+    return min(max(tenths / 10, CRF_RANGE[0]), CRF_RANGE[1])
+
+
+def _target_curve(
+    points: Dict[float, Dict[str, float]],
+    duration: float,
+    target_size_bytes: Optional[int],
+    target_ssim: Optional[float],
+    audio_bitrate: float,
+) -> Tuple[List[float], float]:
+    """The probed values the target is searched on (log video bitrate or SSIM dB) and the target value."""
+    if (target_size_bytes is None) == (target_ssim is None):
+        raise ValueError("Specify exactly one of a target size or a target SSIM.")
+    if target_size_bytes is not None:
+        video_bitrate = target_size_bytes * 8 * (1 - MUXING_OVERHEAD) / duration - audio_bitrate
+        if video_bitrate <= 0:
+            raise ValueError("Target size is too small to hold the audio alone.")
+        return [math.log(p["bitrate"]) for p in points.values()], math.log(video_bitrate)
+    if not 0 < target_ssim < 1:
+        raise ValueError("Target SSIM must be between 0 and 1.")
+    return [ssim_to_db(p["ssim"]) for p in points.values()], ssim_to_db(target_ssim)
+
+
+def choose_crf(
+    samples: List[Dict[str, Any]],
+    duration: float,
+    target_size_bytes: Optional[int] = None,
+    target_ssim: Optional[float] = None,
+    audio_bitrate: float = 0,
+) -> Dict[str, Any]:
+    """
+    Interpolates the probe points and returns the CRF meeting the target with the
+    predicted video bitrate, output size and SSIM (when measured). A target outside
+    the probed range gets the nearest probed CRF.
+    """
+    points = _per_crf(samples)
+    crfs = list(points)
+    values, target = _target_curve(points, duration, target_size_bytes, target_ssim, audio_bitrate)
+    log_rates = [math.log(p["bitrate"]) for p in points.values()]
+    has_ssim = all("ssim" in s for s in samples)
+    ssim_dbs = [ssim_to_db(p["ssim"]) for p in points.values()] if has_ssim else []
+
+    crf = _crf_for(crfs, values, target)
+    if crf is None:
+        crf = crfs[0] if target > values[0] else crfs[-1]
+    # Probes are whole CRFs, so rounding to 0.1 never leaves the probed range
+    crf = _clamp_crf(crf, round_up=target_size_bytes is not None)
+
+    predicted_bitrate = math.exp(_value_at(crfs, log_rates, crf))
+    result = {
+        "crf": crf,
+        "predicted_video_bitrate": round(predicted_bitrate),
+        "predicted_size_bytes": round((predicted_bitrate + audio_bitrate) * duration / 8 / (1 - MUXING_OVERHEAD)),
+        "probe_points": {str(c): {"bitrate": round(p["bitrate"]), **({"ssim": round(p["ssim"], 5)} if has_ssim else {})} for c, p in points.items()},
+    }
+    if has_ssim:
+        result["predicted_ssim"] = round(db_to_ssim(_value_at(crfs, ssim_dbs, crf)), 5)
+    return result
+
+
+def search_crf(
+    input_path: str,
+    duration: float,
+    target_size_bytes: Optional[int] = None,
+    target_ssim: Optional[float] = None,
+    audio_bitrate: float = 0,
+) -> Dict[str, Any]:
+    """
+    Probes PROBE_CRFS and, while the target lies outside the probed range, one more CRF
+    past it (up to EXTRA_PROBES times), then returns choose_crf() for all samples.
+    """
+    measure_ssim = target_ssim is not None
+    samples = probe_samples(input_path, duration, measure_ssim=measure_ssim)
+    for _ in range(EXTRA_PROBES):
+        points = _per_crf(samples)
+        values, target = _target_curve(points, duration, target_size_bytes, target_ssim, audio_bitrate)
+        crf = _probe_beyond(list(points), values, target)
+        if crf is None:
+            break
+        samples += probe_samples(input_path, duration, measure_ssim=measure_ssim, crfs=(crf,))
+    return choose_crf(samples, duration, target_size_bytes=target_size_bytes, target_ssim=target_ssim, audio_bitrate=audio_bitrate)
@@ -0,0 +1,293 @@
+"""
+In-process probing and frame decoding (PyAV) for small, latency-bound operations.
+
+Spawning ffprobe/ffmpeg costs far more than reading a header or decoding one frame,
+so open demuxer/decoder contexts are kept in a bounded LRU pool keyed by path.
+Repeated probes and frame grabs on the same video reuse the open container; a grab
+shortly after the previous one keeps decoding forward instead of seeking again.
+
+PyAV is optional and imported on first use. Every function raises DecodeError when
+it is missing or cannot handle a file, and callers fall back to the ffmpeg/ffprobe
+subprocess path.
+"""
+import importlib.util
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from fractions import Fraction
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+# PyAV, once loaded; importing it costs tens of milliseconds, so it is not done at start-up
+av = None
+
+POOL_SIZE = max(1, int(os.environ.get("UPSCALEFX_DECODE_POOL_SIZE", "8")))
+# A grab this far past the last decoded frame decodes forward instead of seeking
+CONTINUE_DECODE_SECONDS = 2.0
+# Frames this close to the requested time count as landing on it
+FRAME_TOLERANCE = 0.001
+IMAGE_ENCODERS = {"jpg": ("mjpeg", "yuvj420p"), "jpeg": ("mjpeg", "yuvj420p"), "png": ("png", "rgb24")}
+
+
+class DecodeError(Exception):
+    """The in-process decoder is unavailable or failed; use the subprocess path instead."""
+
+
+def available() -> bool:
+    return av is not None or importlib.util.find_spec("av") is not None
+
+
+def _load_av():
+    global av
+    if av is None:
+        try:
+            import av as module
+        except ImportError:
+            raise DecodeError("PyAV is not installed.")
+        av = module
+    return av
+
+
+class _OpenMedia:
+    """An open container and the decode state of its first video stream. Used under lock only."""
+
+    def __init__(self, path: str, identity: Tuple[int, ...]):
+        self.path = path
+        self.identity = identity
+        self.container = av.open(path)
+        self.lock = threading.Lock()
+        self.closed = False
+        self.frames: Optional[Iterator] = None
+        self.last_frame = None
+
+    def close(self) -> None:
+        with self.lock:
+            if not self.closed:
+                self.closed = True
+                self.container.close()
+
+
+_pool: "OrderedDict[str, _OpenMedia]" = OrderedDict()
+_pool_lock = threading.Lock()
+
+
+def _identity(path: str) -> Optional[Tuple[int, ...]]:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+def _checkout(path: str) -> _OpenMedia:
+    identity = _identity(path)
+    if identity is None:
+        raise FileNotFoundError(f"Input video not found: {path}")
+    retired: List[_OpenMedia] = []
+    with _pool_lock:
+        entry = _pool.get(path)
+        if entry is not None and entry.identity == identity:
+            _pool.move_to_end(path)
+            return entry
+    # Opened outside the pool lock so a slow open does not stall other files
+    try:
+        entry = _OpenMedia(path, identity)
+    except av.error.FFmpegError as e:
+        raise DecodeError(f"Could not open {path}: {e}")
+    with _pool_lock:
+        current = _pool.get(path)
+        if current is not None and current.identity == identity:
+            retired.append(entry)
+            entry = current
+        else:
+            if current is not None:
+                retired.append(current)
+            _pool[path] = entry
+        # Files that were deleted or replaced (e.g. temporary uploads) give back their descriptors
+        for other_path, other in list(_pool.items()):
+            if other is not entry and _identity(other_path) != other.identity:
+                retired.append(_pool.pop(other_path))
+        while len(_pool) > POOL_SIZE:
+            retired.append(_pool.popitem(last=False)[1])
+    for stale in retired:
+        stale.close()
+    return entry
+
+
+def _discard(entry: _OpenMedia) -> None:
+    with _pool_lock:
+        if _pool.get(entry.path) is entry:
+            del _pool[entry.path]
+
+
+@contextmanager
+def _open(path: str):
+    """Yields the pooled container of path with its lock held."""
+    _load_av()
+    while True:
+        entry = _checkout(path)
+        with entry.lock:
+            if entry.closed:
+                # Evicted between checkout and lock; check out again
+                continue
+            try:
+                yield entry
+            except av.error.FFmpegError as e:
+                # The decode state may be broken; the next call opens the file afresh
+                _discard(entry)
+                entry.closed = True
+                entry.container.close()
+                raise DecodeError(f"Decoding {path} failed: {e}")
+            return
+
+
+def forget(path: str) -> None:
+    """
+    Closes the pooled container of path, if any. Call it when deleting a file, so its
+    descriptor (and, for files in RAM-backed directories, its memory) is given back now
+    instead of at the next checkout of another file.
+    """
+    with _pool_lock:
+        entry = _pool.pop(path, None)
+    if entry is not None:
+        entry.close()
+
+
+def close_all() -> None:
+    with _pool_lock:
+        entries = list(_pool.values())
+        _pool.clear()
+    for entry in entries:
+        entry.close()
+
+
+def _video_stream(container):
+    stream = next((s for s in container.streams.video if not s.disposition & av.stream.Disposition.attached_pic), None)
+    if stream is None:
+        raise ValueError("No video stream found")
+    return stream
+
+
+def _rate(value: Optional[Fraction]) -> str:
+    return f"{value.numerator}/{value.denominator}" if value else "0/0"
+
+
+def _seconds(value: Optional[float]) -> Optional[str]:
+    return f"{value:.6f}" if value is not None else None
+
+
+def _stream_info(stream) -> Dict[str, Any]:
+    context = stream.codec_context
+    info: Dict[str, Any] = {
+        "index": stream.index,
+        "codec_type": stream.type,
+        "time_base": _rate(stream.time_base),
+        "disposition": {name: int(bool(stream.disposition & flag)) for name, flag in av.stream.Disposition.__members__.items()},
+        "tags": dict(stream.metadata),
+    }
+    if context is not None:
+        info.update(codec_name=context.codec.canonical_name, codec_long_name=context.codec.long_name)
+        if context.profile:
+            info["profile"] = context.profile
+        if context.bit_rate:
+            info["bit_rate"] = str(context.bit_rate)
+    if stream.type == "video":
+        info.update(
+            width=context.width,
+            height=context.height,
+            pix_fmt=context.format.name if context.format else None,
+            sample_aspect_ratio=f"{stream.sample_aspect_ratio.numerator}:{stream.sample_aspect_ratio.denominator}" if stream.sample_aspect_ratio else "0:1",
+            r_frame_rate=_rate(stream.base_rate),
+            avg_frame_rate=_rate(stream.average_rate),
+        )
+    elif stream.type == "audio":
+        info.update(
+            sample_fmt=context.format.name if context.format else None,
+            sample_rate=str(context.sample_rate),
+            channels=context.layout.nb_channels,
+            channel_layout=context.layout.name,
+        )
+    if stream.start_time is not None and stream.time_base:
+        info.update(start_pts=stream.start_time, start_time=_seconds(float(stream.start_time * stream.time_base)))
+    if stream.duration is not None and stream.time_base:
+        info.update(duration_ts=stream.duration, duration=_seconds(float(stream.duration * stream.time_base)))
+    if stream.frames:
+        info["nb_frames"] = str(stream.frames)
+    return info
+
+
+def probe(path: str) -> Dict[str, Any]:
+    """
+    Container and stream information shaped like `ffprobe -show_format -show_streams`
+    JSON (the fields the demuxer knows without decoding).
+    """
+    with _open(path) as entry:
+        container = entry.container
+        format_info = {
+            "filename": path,
+            "nb_streams": len(container.streams),
+            "format_name": container.format.name,
+            "format_long_name": container.format.long_name,
+            "size": str(os.path.getsize(path)),
+            "tags": dict(container.metadata),
+        }
+        if container.start_time is not None:
+            format_info["start_time"] = _seconds(container.start_time / av.time_base)
+        if container.duration is not None:
+            format_info["duration"] = _seconds(container.duration / av.time_base)
+        if container.bit_rate:
+            format_info["bit_rate"] = str(container.bit_rate)
+        return {"streams": [_stream_info(s) for s in container.streams], "format": format_info}
+
+
+def dimensions(path: str) -> Tuple[int, int]:
+    with _open(path) as entry:
+        context = _video_stream(entry.container).codec_context
+        return context.width, context.height
+
+
+def _frame_at(entry: _OpenMedia, seconds: float):
+    container = entry.container
+    stream = _video_stream(container)
+    # Like ffmpeg's -ss, the time is relative to the start of the file
+    target = seconds + (container.start_time or 0) / av.time_base
+    last = entry.last_frame
+    if last is not None and abs(last.time - target) <= FRAME_TOLERANCE:
+        return last
+    if entry.frames is None or last is None or not last.time < target <= last.time + CONTINUE_DECODE_SECONDS:
+        container.seek(int(target / stream.time_base), stream=stream, backward=True)
+        entry.frames = container.decode(stream)
+    for frame in entry.frames:
+        if frame.time is not None and frame.time >= target - FRAME_TOLERANCE:
+            entry.last_frame = frame
+            return frame
+    entry.frames = None
+    entry.last_frame = None
+    raise DecodeError(f"No frame at {seconds:g}s.")
+
+
+def _encode_image(frame, image_format: str) -> bytes:
+    codec_name, pix_fmt = IMAGE_ENCODERS[image_format]
+    encoder = av.CodecContext.create(codec_name, "w")
+    encoder.width = frame.width
+    encoder.height = frame.height
+    encoder.pix_fmt = pix_fmt
+    encoder.time_base = Fraction(1, 25)
+    packets = encoder.encode(frame.reformat(format=pix_fmt)) + encoder.encode(None)
+    return b"".join(bytes(packet) for packet in packets)
+
+
+def extract_frame(path: str, seconds: float, output_path: str, image_format: str = "jpg") -> str:
+    """Writes the first frame at or after seconds as a JPEG or PNG image."""
+    image_format = image_format.lower()
+    if image_format not in IMAGE_ENCODERS:
+        raise ValueError(f"Unsupported image format: {image_format}. Supported: {', '.join(IMAGE_ENCODERS)}")
+    with _open(path) as entry:
+        frame = _frame_at(entry, seconds)
+        if frame.rotation:
+            # ffmpeg autorotates by the display matrix; leave rotated videos to it
+            raise DecodeError("Rotated video.")
+        data = _encode_image(frame, image_format)
+    with open(output_path, "wb") as f:
+        f.write(data)
+    return output_path
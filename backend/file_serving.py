@@ -0,0 +1,166 @@
+"""
+Conditional and ranged delivery of processed files.
+
+Responses carry a strong ETag and Last-Modified, answer If-None-Match with 304,
+honour single byte-range requests (including If-Range) with 206, and hand the
+body to the server's zero-copy sendfile extension when it offers one.
+"""
+import os
+import stat
+from email.utils import formatdate
+from typing import Optional, Tuple
+from urllib.parse import quote
+
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import Response
+from starlette.types import Receive, Scope, Send
+
+CHUNK_SIZE = 256 * 1024
+ZERO_COPY_EXTENSION = "http.response.zerocopysend"
+
+
+def make_etag(st: os.stat_result) -> str:
+    """Strong validator derived from size and modification time; outputs are never edited in place."""
+    return f'"{st.st_size:x}-{st.st_mtime_ns:x}"'
+
+
+def _etag_matches(header_value: str, etag: str) -> bool:
+    if header_value.strip() == "*":
+        return True
+    # If-None-Match uses weak comparison, so W/ prefixes are ignored
+    candidates = [tag.strip().removeprefix("W/") for tag in header_value.split(",")]
+    return etag in candidates
+
+
+def parse_range(header_value: str, size: int) -> Optional[Tuple[int, int]]:
+    """
+    Parses a single 'bytes=' range into an inclusive (start, end) pair.
+    Returns None when the header should be ignored (malformed or multi-range) and
+    raises ValueError when the range cannot be satisfied.
+    """
+    unit, _, spec = header_value.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    start_str, sep, end_str = spec.strip().partition("-")
+    if not sep:
+        return None
+    try:
+        start = int(start_str) if start_str.strip() else None
+        end = int(end_str) if end_str.strip() else None
+    except ValueError:
+        return None
+    if start is None:
+        if end is None:
+            return None
+        if end == 0:
+            raise ValueError("Empty suffix range.")
+        return max(0, size - end), size - 1
+    if end is not None and end < start:
+        return None
+    if start >= size:
+        raise ValueError(f"Range {header_value} not satisfiable for {size} bytes.")
+    return start, size - 1 if end is None else min(end, size - 1)
+
+
+class RangedFileResponse(Response):
+    """Streams a file with ETag, conditional request and Range support."""
+
+    def __init__(self, path: str, media_type: str, filename: Optional[str] = None, request_headers=None, method: str = "GET"):
+        # Headers are computed per request in __call__, so the base initialiser is bypassed
+        self.status_code = 200
+        self.background = None
+        self.path = path
+        self.media_type = media_type
+        self.filename = filename
+        self.request_headers = request_headers or {}
+        self.send_body = method.upper() != "HEAD"
+
+    def _base_headers(self, st: os.stat_result, etag: str) -> list:
+        headers = [
+            (b"accept-ranges", b"bytes"),
+            (b"etag", etag.encode("latin-1")),
+            (b"last-modified", formatdate(st.st_mtime, usegmt=True).encode("latin-1")),
+        ]
+        if self.filename:
+            headers.append((b"content-disposition", f"attachment; filename*=utf-8''{quote(self.filename)}".encode("latin-1")))
+        return headers
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        await self._respond(scope, send)
+        if self.background is not None:
+            await self.background()
+
+    async def _respond(self, scope: Scope, send: Send) -> None:
+        try:
+            st = await run_in_threadpool(os.stat, self.path)
+        except FileNotFoundError:
+            await self._send_empty(send, 404, [])
+            return
+        if not stat.S_ISREG(st.st_mode):
+            await self._send_empty(send, 404, [])
+            return
+
+        size = st.st_size
+        etag = make_etag(st)
+        headers = self._base_headers(st, etag)
+
+        if_none_match = self.request_headers.get("if-none-match")
+        if if_none_match and _etag_matches(if_none_match, etag):
+            await self._send_empty(send, 304, headers)
+            return
+
+        status, start, end = 200, 0, size - 1
+        range_header = self.request_headers.get("range")
+        if_range = self.request_headers.get("if-range")
+        # A stale If-Range validator means the client's partial copy is outdated: send everything
+        if range_header and (not if_range or if_range.strip() == etag) and size > 0:
+            try:
+                byte_range = parse_range(range_header, size)
+            except ValueError:
+                await self._send_empty(send, 416, headers + [(b"content-range", f"bytes */{size}".encode("latin-1"))])
+                return
+            if byte_range:
+                status, (start, end) = 206, byte_range
+                headers.append((b"content-range", f"bytes {start}-{end}/{size}".encode("latin-1")))
+
+        length = end - start + 1 if size else 0
+        headers += [
+            (b"content-type", self.media_type.encode("latin-1")),
+            (b"content-length", str(length).encode("latin-1")),
+        ]
+        await send({"type": "http.response.start", "status": status, "headers": headers})
+        if not self.send_body or length == 0:
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        with open(self.path, "rb") as f:
+            if ZERO_COPY_EXTENSION in scope.get("extensions", {}):
+                # The server pushes the bytes with sendfile(2); nothing crosses into Python
+                await send({"type": ZERO_COPY_EXTENSION, "file": f, "offset": start, "count": length})
+                return
+            fd = f.fileno()
+            offset, remaining = start, length
+            while remaining > 0:
+                chunk = await run_in_threadpool(os.pread, fd, min(CHUNK_SIZE, remaining), offset)
+                if not chunk:
+                    break
+                offset += len(chunk)
+                remaining -= len(chunk)
+                await send({"type": "http.response.body", "body": chunk, "more_body": remaining > 0})
+            if remaining > 0:
+                # File shrank underneath us; close the body so the client sees a short read
+                await send({"type": "http.response.body", "body": b""})
+
+    @staticmethod
+    async def _send_empty(send: Send, status: int, headers: list) -> None:
+        await send({"type": "http.response.start", "status": status, "headers": headers})
+        await send({"type": "http.response.body", "body": b""})
+
+
+def resolve_within(root: str, relative_path: str) -> str:
+    """Joins relative_path onto root, refusing anything that escapes it."""
+    root_real = os.path.realpath(root)
+    candidate = os.path.realpath(os.path.join(root_real, relative_path))
+    if os.path.commonpath([root_real, candidate]) != root_real or candidate == root_real:
+        raise FileNotFoundError(f"Path not found: {relative_path}")
+    return candidate
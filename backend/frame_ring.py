@@ -0,0 +1,305 @@
+"""
+Shared-memory frame transport for per-frame Python processing.
+
+Frames decoded by an ffmpeg rawvideo reader are written straight into a fixed
+pool of shared memory slots, handed to N worker processes by slot index only,
+and streamed from the same memory into an ffmpeg rawvideo writer in order.
+No frame data is pickled or copied between stages.
+"""
+import multiprocessing
+import os
+import queue
+import sys
+import threading
+import traceback
+from multiprocessing import shared_memory
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import ffmpeg
+
+
+def _attach_shared_memory(name: str) -> shared_memory.SharedMemory:
+    """Attaches to an existing block; the creating process stays responsible for unlinking it."""
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    # Worker processes share their parent's resource tracker, so re-registering is harmless
+    return shared_memory.SharedMemory(name=name)
+
+
+class FramePool:
+    """
+    A fixed number of equally sized frame slots backed by one shared memory block.
+    Each slot is exposed as a NumPy array view and as a writable memoryview.
+    """
+
+    def __init__(self, slots: int, shape: Tuple[int, ...], dtype: str = "uint8", name: Optional[str] = None):
+        import numpy as np  # Imported lazily so the API process does not pay for it at startup
+
+        if slots <= 0:
+            raise ValueError("A frame pool needs at least one slot.")
+        self.slots = slots
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.frame_bytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        self._owner = name is None
+        if self._owner:
+            self._shm = shared_memory.SharedMemory(create=True, size=self.frame_bytes * slots)
+        else:
+            self._shm = _attach_shared_memory(name)
+        self._frames = np.ndarray((slots,) + self.shape, dtype=self.dtype, buffer=self._shm.buf)
+
+    @property
+    def spec(self) -> Dict[str, Any]:
+        """Everything another process needs to attach to this pool."""
+        return {"name": self._shm.name, "slots": self.slots, "shape": self.shape, "dtype": self.dtype.str}
+
+    @classmethod
+    def attach(cls, spec: Dict[str, Any]) -> "FramePool":
+        return cls(spec["slots"], spec["shape"], spec["dtype"], name=spec["name"])
+
+    def frame(self, slot: int):
+        """NumPy view of a slot; writes land directly in shared memory."""
+        return self._frames[slot]
+
+    def buffer(self, slot: int) -> memoryview:
+        start = slot * self.frame_bytes
+        return self._shm.buf[start:start + self.frame_bytes]
+
+    def close(self) -> None:
+        self._frames = None
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+
+
+def _frame_worker(
+    in_spec: Dict[str, Any],
+    out_spec: Optional[Dict[str, Any]],
+    frame_fn: Callable,
+    work_queue,
+    done_queue,
+) -> None:
+    """Worker process loop: runs frame_fn(src, dst) on slots named in work_queue."""
+    in_pool = FramePool.attach(in_spec)
+    out_pool = FramePool.attach(out_spec) if out_spec else in_pool
+    try:
+        while True:
+            item = work_queue.get()
+            if item is None:
+                break
+            seq, in_slot, out_slot = item
+            try:
+                frame_fn(in_pool.frame(in_slot), out_pool.frame(out_slot))
+            except Exception:
+                done_queue.put(("error", seq, traceback.format_exc()))
+                break
+            done_queue.put(("frame", seq, (in_slot, out_slot)))
+    finally:
+        if out_pool is not in_pool:
+            out_pool.close()
+        in_pool.close()
+
+
+def _drain(pipe, sink: bytearray) -> None:
+    """Collects ffmpeg's stderr so a chatty process never blocks on a full pipe."""
+    for chunk in iter(lambda: pipe.read(4096), b""):
+        sink.extend(chunk)
+
+
+def _read_exact(stream, view: memoryview) -> int:
+    filled = 0
+    while filled < len(view):
+        n = stream.readinto(view[filled:])
+        if not n:
+            break
+        filled += n
+    return filled
+
+
+def probe_frame_geometry(input_path: str) -> Tuple[int, int, str, bool]:
+    """Returns (width, height, frame rate string, has_audio) for the first video stream."""
+    probe = ffmpeg.probe(input_path)
+    video_stream = next((s for s in probe["streams"] if s["codec_type"] == "video"), None)
+    if video_stream is None:
+        raise ValueError("No video stream found")
+    frame_rate = video_stream.get("avg_frame_rate") or video_stream.get("r_frame_rate") or "25/1"
+    if frame_rate in ("0/0", "0/1"):
+        frame_rate = video_stream.get("r_frame_rate", "25/1")
+    has_audio = any(s["codec_type"] == "audio" for s in probe["streams"])
+    return int(video_stream["width"]), int(video_stream["height"]), frame_rate, has_audio
+
+
+def process_video_frames(
+    input_path: str,
+    output_path: str,
+    frame_fn: Callable,
+    workers: int = 0,
+    slots: int = 0,
+    out_size: Optional[Tuple[int, int]] = None,
+    pix_fmt: str = "bgr24",
+    output_options: Optional[Dict[str, Any]] = None,
+    mp_context: Optional[str] = None,
+) -> str:
+    """
+    Decodes input_path, runs frame_fn(src, dst) on every frame in worker processes and
+    encodes the results to output_path in the original frame order.
+
+    frame_fn must be a picklable top-level function. src and dst are (height, width, 3)
+    uint8 arrays living in shared memory; when out_size is None the transform is done
+    in place and dst is src. Otherwise dst has the out_size (width, height) geometry.
+    Audio from the input is carried over to the output.
+    """
+    if not os.path.exists(input_path):
+        raise FileNotFoundError(f"Input video not found: {input_path}")
+    if pix_fmt not in ("bgr24", "rgb24"):
+        raise ValueError(f"Unsupported pix_fmt for frame processing: {pix_fmt}. Supported: 'bgr24', 'rgb24'.")
+
+    width, height, frame_rate, has_audio = probe_frame_geometry(input_path)
+    out_width, out_height = out_size if out_size else (width, height)
+    workers = workers or max(1, (os.cpu_count() or 2) - 1)
+    # Enough slots for every worker to hold a frame plus a little read-ahead for the decoder
+    slots = slots or 2 * workers + 2
+
+    ctx = multiprocessing.get_context(mp_context)
+    in_pool = FramePool(slots, (height, width, 3))
+    out_pool = FramePool(slots, (out_height, out_width, 3)) if out_size else None
+    free_in: "queue.Queue[int]" = queue.Queue()
+    free_out: "queue.Queue[int]" = queue.Queue()
+    for slot in range(slots):
+        free_in.put(slot)
+        free_out.put(slot)
+    work_queue = ctx.Queue()
+    done_queue = ctx.Queue()
+
+    encode_options = {"vcodec": "libx264", "preset": "medium", "crf": 23, "pix_fmt": "yuv420p"}
+    encode_options.update(output_options or {})
+
+    # Workers are started before ffmpeg so forked children never inherit the encoder's
+    # stdin pipe, which would keep it from ever seeing end of input.
+    procs = [
+        ctx.Process(
+            target=_frame_worker,
+            args=(in_pool.spec, out_pool.spec if out_pool else None, frame_fn, work_queue, done_queue),
+            daemon=True,
+        )
+        for _ in range(workers)
+    ]
+    for p in procs:
+        p.start()
+
+    decoder = (
+        ffmpeg
+        .input(input_path)
+        .output("pipe:", format="rawvideo", pix_fmt=pix_fmt)
+        .global_args("-loglevel", "error", "-nostdin")
+        .run_async(pipe_stdout=True, pipe_stderr=True)
+    )
+    encoder_streams = [ffmpeg.input("pipe:", format="rawvideo", pix_fmt=pix_fmt, s=f"{out_width}x{out_height}", framerate=frame_rate)]
+    if has_audio:
+        encoder_streams.append(ffmpeg.input(input_path).audio)
+    encoder = (
+        ffmpeg
+        .output(*encoder_streams, output_path, **encode_options)
+        .global_args("-loglevel", "error")
+        .overwrite_output()
+        .run_async(pipe_stdin=True, pipe_stderr=True)
+    )
+    decoder_log, encoder_log = bytearray(), bytearray()
+    drains = [
+        threading.Thread(target=_drain, args=(decoder.stderr, decoder_log), daemon=True),
+        threading.Thread(target=_drain, args=(encoder.stderr, encoder_log), daemon=True),
+    ]
+    for t in drains:
+        t.start()
+
+    stop = threading.Event()
+    reader_state = {"frames": None, "error": None}
+
+    def read_frames() -> None:
+        # Both slots are reserved here, in sequence order, so the writer can always
+        # release them in order and a slow frame can never starve the ones behind it.
+        seq = 0
+        try:
+            while not stop.is_set():
+                in_slot = free_in.get()
+                out_slot = free_out.get() if out_pool else in_slot
+                if _read_exact(decoder.stdout, in_pool.buffer(in_slot)) < in_pool.frame_bytes:
+                    break
+                work_queue.put((seq, in_slot, out_slot))
+                seq += 1
+        except Exception as e:
+            reader_state["error"] = str(e)
+        finally:
+            reader_state["frames"] = seq
+            done_queue.put(("eof", seq, None))
+
+    reader = threading.Thread(target=read_frames, daemon=True)
+    reader.start()
+
+    pending: Dict[int, Tuple[int, int]] = {}
+    next_seq = 0
+    total = None
+    try:
+        while total is None or next_seq < total:
+            try:
+                kind, seq, payload = done_queue.get(timeout=1.0)
+            except queue.Empty:
+                if any(not p.is_alive() and p.exitcode not in (0, None) for p in procs):
+                    raise Exception("A frame worker process died unexpectedly.")
+                continue
+            if kind == "error":
+                raise Exception(f"Frame worker failed on frame {seq}:\n{payload}")
+            if kind == "eof":
+                total = seq
+                continue
+            pending[seq] = payload
+            while next_seq in pending:
+                in_slot, out_slot = pending.pop(next_seq)
+                encoder.stdin.write(out_pool.buffer(out_slot) if out_pool else in_pool.buffer(in_slot))
+                free_in.put(in_slot)
+                if out_pool:
+                    free_out.put(out_slot)
+                next_seq += 1
+        encoder.stdin.close()
+        if encoder.wait() != 0:
+            raise Exception(f"FFmpeg error during frame encoding: {encoder_log.decode('utf8', errors='ignore')}")
+        if decoder.wait() != 0 or reader_state["error"]:
+            raise Exception(f"FFmpeg error during frame decoding: {reader_state['error'] or decoder_log.decode('utf8', errors='ignore')}")
+    except Exception as e:
+        print(f"Error during shared-memory frame processing: {str(e)}")
+        for p in (decoder, encoder):
+            if p.poll() is None:
+                p.kill()
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        raise
+    finally:
+        stop.set()
+        # Unblock a reader waiting for a slot, then release the workers
+        free_in.put(0)
+        free_out.put(0)
+        for _ in procs:
+            work_queue.put(None)
+        for p in procs:
+            p.join(timeout=5)
+            if p.is_alive():
+                p.terminate()
+        if decoder.poll() is None:
+            decoder.kill()
+        reader.join(timeout=5)
+        # Closing the pipe under a reader still blocked in it is unsafe; the daemon thread keeps it until it exits
+        if reader.is_alive():
+            print("Frame reader thread did not exit; leaving the decoder pipe open.")
+        else:
+            decoder.stdout.close()
+        for t in drains:
+            t.join(timeout=1)
+        work_queue.close()
+        done_queue.close()
+        if out_pool:
+            out_pool.close()
+        in_pool.close()
+
+    if not os.path.exists(output_path) or os.path.getsize(output_path) == 0:
+        raise Exception("Output file not created or is empty after frame processing.")
+    return output_path
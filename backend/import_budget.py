@@ -0,0 +1,68 @@
+"""
+Import-time budget check for the API module.
+
+Imports a module in a fresh interpreter with `python -X importtime`, reports its
+cumulative import time and the slowest imports, and fails when the budget is
+exceeded, so a heavy module-level import is caught before it slows every worker
+start:
+
+    python import_budget.py --module main --budget-ms 1000
+"""
+import argparse
+import os
+import re
+import subprocess
+import sys
+from typing import Any, Dict, List, Tuple
+
+IMPORT_BUDGET_MS = float(os.environ.get("UPSCALEFX_IMPORT_BUDGET_MS", "1000"))
+IMPORT_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+
+def measure_imports(module: str) -> Tuple[float, List[Dict[str, Any]]]:
+    """
+    Returns the module's cumulative import time (ms) and the self/cumulative times (ms)
+    of the modules it imported directly.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{result.stderr[-2000:]}")
+    # Children are listed before their parent, indented two spaces deeper
+    children: List[Dict[str, Any]] = []
+    for line in result.stderr.splitlines():
+        match = IMPORT_LINE.match(line)
+        if not match:
+            continue
+        self_us, cumulative_us, indent, name = int(match.group(1)), int(match.group(2)), match.group(3), match.group(4)
+        depth = (len(indent) - 1) // 2
+        if depth == 0:
+            if name == module:
+                return cumulative_us / 1000, children
+            children = []
+        elif depth == 1:
+            children.append({"module": name, "self_ms": self_us / 1000, "cumulative_ms": cumulative_us / 1000})
+    raise RuntimeError(f"{module} was already imported by the interpreter; nothing to measure.")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Fail when importing a module exceeds an import-time budget.")
+    parser.add_argument("--module", default="main")
+    parser.add_argument("--budget-ms", type=float, default=IMPORT_BUDGET_MS)
+    parser.add_argument("--top", type=int, default=10, help="Number of direct imports to list")
+    args = parser.parse_args(argv)
+
+    total_ms, children = measure_imports(args.module)
+    print(f"import {args.module}: {total_ms:.1f} ms (budget {args.budget_ms:g} ms)")
+    for entry in sorted(children, key=lambda e: e["cumulative_ms"], reverse=True)[:args.top]:
+        print(f"  {entry['cumulative_ms']:8.1f} ms  {entry['module']}")
+    if total_ms > args.budget_ms:
+        print(f"Over budget by {total_ms - args.budget_ms:.1f} ms.")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,573 @@
+"""
+Shared job queue between the API tier and standalone encode workers (worker.py).
+
+A job names an "operation" and its "params" (as in batch manifests) and an "input"
+reference into job storage (storage.py). Workers claim queued jobs under a lease,
+extend it with heartbeats while they run, and report the result or error. When a
+worker dies its lease lapses, and the next requeue_expired() call puts the job back
+in the queue, until it has been attempted max_attempts times. Long jobs record their
+finished segments (segmented_encode.py) and progress with the job, so the next
+attempt resumes after the last finished segment.
+
+Backends, chosen by URL (UPSCALEFX_JOB_QUEUE):
+
+    sqlite:///var/lib/upscalefx/jobs.db   single host, any number of worker processes
+    redis://queue-host:6379/0             several hosts (needs the `redis` package)
+    memory://                             one process only, e.g. tests
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, List, Optional
+
+JOB_QUEUE_URL = os.environ.get("UPSCALEFX_JOB_QUEUE", "sqlite://jobs.db")
+# A claimed job returns to the queue when its worker has not heartbeated for this long
+LEASE_SECONDS = float(os.environ.get("UPSCALEFX_JOB_LEASE_SECONDS", "60"))
+MAX_ATTEMPTS = int(os.environ.get("UPSCALEFX_JOB_MAX_ATTEMPTS", "3"))
+# Workers not seen for this long are left out of workers()
+WORKER_TIMEOUT_SECONDS = LEASE_SECONDS
+
+JOB_STATUSES = ("queued", "running", "complete", "failed")
+
+
+class JobNotFoundError(LookupError):
+    pass
+
+
+def _new_job(operation: str, params: Dict[str, Any], input_ref: Dict[str, Any], max_attempts: int) -> Dict[str, Any]:
+    now = time.time()
+    return {
+        "job_id": str(uuid.uuid4()),
+        "operation": operation,
+        "params": params,
+        "input": input_ref,
+        "status": "queued",
+        "attempts": 0,
+        "max_attempts": max(1, max_attempts),
+        "worker_id": None,
+        "lease_expires": None,
+        "created_at": now,
+        "updated_at": now,
+        "progress": None,
+        "result": None,
+        "error": None,
+    }
+
+
+class JobQueue(ABC):
+    """Interface of the queue backends. Every method is safe to call from several threads."""
+
+    @abstractmethod
+    def enqueue(self, operation: str, params: Dict[str, Any], input_ref: Dict[str, Any], max_attempts: int = MAX_ATTEMPTS) -> Dict[str, Any]:
+        """Adds a queued job and returns its record."""
+
+    @abstractmethod
+    def get(self, job_id: str) -> Dict[str, Any]:
+        """Returns the job record; raises JobNotFoundError."""
+
+    @abstractmethod
+    def claim(self, worker_id: str, lease_seconds: float = LEASE_SECONDS) -> Optional[Dict[str, Any]]:
+        """Takes the oldest queued job for worker_id, or returns None when the queue is empty."""
+
+    @abstractmethod
+    def heartbeat(self, worker_id: str, job_ids: Iterable[str] = (), lease_seconds: float = LEASE_SECONDS) -> List[str]:
+        """
+        Records that worker_id is alive and extends the leases of its running jobs.
+        Returns the ids it still holds; a job missing from the result was re-queued and
+        must be abandoned.
+        """
+
+    @abstractmethod
+    def complete(self, job_id: str, worker_id: str, result: Dict[str, Any]) -> bool:
+        """Marks a job complete. Returns False when worker_id no longer holds it."""
+
+    @abstractmethod
+    def fail(self, job_id: str, worker_id: str, error: str) -> bool:
+        """Marks a job failed for good. Returns False when worker_id no longer holds it."""
+
+    @abstractmethod
+    def save_segment(self, job_id: str, worker_id: str, segment: Dict[str, Any], progress: float) -> bool:
+        """
+        Records a finished segment (a dict with its "index") and the job's progress
+        (0-1). Returns False when worker_id no longer holds the job.
+        """
+
+    @abstractmethod
+    def segments(self, job_id: str) -> List[Dict[str, Any]]:
+        """Finished segments recorded for a job, by index."""
+
+    @abstractmethod
+    def requeue_expired(self) -> List[str]:
+        """
+        Re-queues running jobs whose lease has lapsed, or fails them once their attempts
+        are used up. Returns the affected job ids; the caller deletes the stored files
+        of the jobs that failed (worker.Worker.delete_job_files).
+        """
+
+    @abstractmethod
+    def workers(self) -> List[Dict[str, Any]]:
+        """Workers that heartbeated recently, with the jobs they hold."""
+
+
+class MemoryJobQueue(JobQueue):
+    """In-process queue for tests and single-process setups."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._jobs: Dict[str, Dict[str, Any]] = {}
+        self._segments: Dict[str, Dict[int, Dict[str, Any]]] = {}
+        self._workers: Dict[str, Dict[str, Any]] = {}
+
+    def enqueue(self, operation, params, input_ref, max_attempts=MAX_ATTEMPTS):
+        job = _new_job(operation, params, input_ref, max_attempts)
+        with self._lock:
+            self._jobs[job["job_id"]] = job
+            return json.loads(json.dumps(job))
+
+    def get(self, job_id):
+        with self._lock:
+            if job_id not in self._jobs:
+                raise JobNotFoundError(f"Job not found: {job_id}")
+            return json.loads(json.dumps(self._jobs[job_id]))
+
+    def claim(self, worker_id, lease_seconds=LEASE_SECONDS):
+        now = time.time()
+        with self._lock:
+            queued = [job for job in self._jobs.values() if job["status"] == "queued"]
+            if not queued:
+                return None
+            job = min(queued, key=lambda j: j["created_at"])
+            job.update(status="running", worker_id=worker_id, attempts=job["attempts"] + 1, lease_expires=now + lease_seconds, updated_at=now)
+            return json.loads(json.dumps(job))
+
+    def heartbeat(self, worker_id, job_ids=(), lease_seconds=LEASE_SECONDS):
+        now = time.time()
+        held = []
+        with self._lock:
+            for job_id in job_ids:
+                job = self._jobs.get(job_id)
+                if job and job["status"] == "running" and job["worker_id"] == worker_id:
+                    job["lease_expires"] = now + lease_seconds
+                    held.append(job_id)
+            self._workers[worker_id] = {"worker_id": worker_id, "last_seen": now, "jobs": held}
+        return held
+
+    def _finish(self, job_id, worker_id, **fields):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if not job or job["status"] != "running" or job["worker_id"] != worker_id:
+                return False
+            job.update(lease_expires=None, updated_at=time.time(), **fields)
+            return True
+
+    def complete(self, job_id, worker_id, result):
+        return self._finish(job_id, worker_id, status="complete", result=result, error=None, progress=1.0)
+
+    def fail(self, job_id, worker_id, error):
+        return self._finish(job_id, worker_id, status="failed", error=error)
+
+    def save_segment(self, job_id, worker_id, segment, progress):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if not job or job["status"] != "running" or job["worker_id"] != worker_id:
+                return False
+            self._segments.setdefault(job_id, {})[segment["index"]] = json.loads(json.dumps(segment))
+            job.update(progress=progress, updated_at=time.time())
+            return True
+
+    def segments(self, job_id):
+        with self._lock:
+            return [dict(segment) for _, segment in sorted(self._segments.get(job_id, {}).items())]
+
+    def requeue_expired(self):
+        now = time.time()
+        affected = []
+        with self._lock:
+            for job in self._jobs.values():
+                if job["status"] == "running" and job["lease_expires"] < now:
+                    _expire(job, now)
+                    affected.append(job["job_id"])
+        return affected
+
+    def workers(self):
+        cutoff = time.time() - WORKER_TIMEOUT_SECONDS
+        with self._lock:
+            return [dict(w) for w in self._workers.values() if w["last_seen"] >= cutoff]
+
+
+def _expire(job: Dict[str, Any], now: float) -> None:
+    """Applies a lapsed lease to a job record."""
+    if job["attempts"] >= job["max_attempts"]:
+        job.update(status="failed", error=f"Worker {job['worker_id']} stopped responding; gave up after {job['attempts']} attempts.")
+    else:
+        job.update(status="queued")
+    job.update(worker_id=None, lease_expires=None, updated_at=now)
+
+
+class SQLiteJobQueue(JobQueue):
+    """Queue in a SQLite database; worker processes on the same host share the file."""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS jobs (
+            job_id TEXT PRIMARY KEY,
+            operation TEXT NOT NULL,
+            params TEXT NOT NULL,
+            input TEXT NOT NULL,
+            status TEXT NOT NULL,
+            attempts INTEGER NOT NULL,
+            max_attempts INTEGER NOT NULL,
+            worker_id TEXT,
+            lease_expires REAL,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL,
+            progress REAL,
+            result TEXT,
+            error TEXT
+        );
+        CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at);
+        CREATE TABLE IF NOT EXISTS segments (
+            job_id TEXT NOT NULL,
+            segment_index INTEGER NOT NULL,
+            data TEXT NOT NULL,
+            PRIMARY KEY (job_id, segment_index)
+        );
+        CREATE TABLE IF NOT EXISTS workers (
+            worker_id TEXT PRIMARY KEY,
+            last_seen REAL NOT NULL
+        );
+    """
+    JSON_COLUMNS = ("params", "input", "result")
+
+    def __init__(self, path: str):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._connect() as connection:
+            # WAL lets the API read job status while a worker holds the write lock
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.executescript(self.SCHEMA)
+            # Databases created before progress was tracked
+            columns = {row["name"] for row in connection.execute("PRAGMA table_info(jobs)")}
+            if "progress" not in columns:
+                connection.execute("ALTER TABLE jobs ADD COLUMN progress REAL")
+
+    @contextmanager
+    def _connect(self):
+        # A connection per call: sqlite3 connections must not be shared between threads
+        connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        connection.row_factory = sqlite3.Row
+        try:
+            yield connection
+        finally:
+            connection.close()
+
+    @contextmanager
+    def _transaction(self):
+        with self._connect() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield connection
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+
+    def _row_to_job(self, row: sqlite3.Row) -> Dict[str, Any]:
+        job = dict(row)
+        for column in self.JSON_COLUMNS:
+            job[column] = json.loads(job[column]) if job[column] is not None else None
+        return job
+
+    def enqueue(self, operation, params, input_ref, max_attempts=MAX_ATTEMPTS):
+        job = _new_job(operation, params, input_ref, max_attempts)
+        row = {key: json.dumps(value) if key in self.JSON_COLUMNS and value is not None else value for key, value in job.items()}
+        with self._transaction() as connection:
+            connection.execute(
+                f"INSERT INTO jobs ({', '.join(row)}) VALUES ({', '.join('?' for _ in row)})",
+                list(row.values())
+            )
+        return job
+
+    def get(self, job_id):
+        with self._connect() as connection:
+            row = connection.execute("SELECT * FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        if row is None:
+            raise JobNotFoundError(f"Job not found: {job_id}")
+        return self._row_to_job(row)
+
+    def claim(self, worker_id, lease_seconds=LEASE_SECONDS):
+        now = time.time()
+        with self._transaction() as connection:
+            row = connection.execute(
+                "SELECT job_id FROM jobs WHERE status = 'queued' ORDER BY created_at, rowid LIMIT 1"
+            ).fetchone()
+            if row is None:
+                return None
+            connection.execute(
+                "UPDATE jobs SET status = 'running', worker_id = ?, attempts = attempts + 1, lease_expires = ?, updated_at = ? WHERE job_id = ?",
+                (worker_id, now + lease_seconds, now, row["job_id"])
+            )
+            return self._row_to_job(connection.execute("SELECT * FROM jobs WHERE job_id = ?", (row["job_id"],)).fetchone())
+
+    def heartbeat(self, worker_id, job_ids=(), lease_seconds=LEASE_SECONDS):
+        now = time.time()
+        held = []
+        with self._transaction() as connection:
+            connection.execute(
+                "INSERT INTO workers (worker_id, last_seen) VALUES (?, ?) ON CONFLICT (worker_id) DO UPDATE SET last_seen = excluded.last_seen",
+                (worker_id, now)
+            )
+            for job_id in job_ids:
+                updated = connection.execute(
+                    "UPDATE jobs SET lease_expires = ? WHERE job_id = ? AND worker_id = ? AND status = 'running'",
+                    (now + lease_seconds, job_id, worker_id)
+                ).rowcount
+                if updated:
+                    held.append(job_id)
+        return held
+
+    def _finish(self, job_id, worker_id, status, result=None, error=None):
+        with self._transaction() as connection:
+            return connection.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, lease_expires = NULL, updated_at = ?, "
+                "progress = CASE WHEN ? = 'complete' THEN 1.0 ELSE progress END "
+                "WHERE job_id = ? AND worker_id = ? AND status = 'running'",
+                (status, json.dumps(result) if result is not None else None, error, time.time(), status, job_id, worker_id)
+            ).rowcount == 1
+
+    def complete(self, job_id, worker_id, result):
+        return self._finish(job_id, worker_id, "complete", result=result)
+
+    def fail(self, job_id, worker_id, error):
+        return self._finish(job_id, worker_id, "failed", error=error)
+
+    def save_segment(self, job_id, worker_id, segment, progress):
+        with self._transaction() as connection:
+            held = connection.execute(
+                "UPDATE jobs SET progress = ?, updated_at = ? WHERE job_id = ? AND worker_id = ? AND status = 'running'",
+                (progress, time.time(), job_id, worker_id)
+            ).rowcount == 1
+            if held:
+                connection.execute(
+                    "INSERT OR REPLACE INTO segments (job_id, segment_index, data) VALUES (?, ?, ?)",
+                    (job_id, segment["index"], json.dumps(segment))
+                )
+            return held
+
+    def segments(self, job_id):
+        with self._connect() as connection:
+            rows = connection.execute("SELECT data FROM segments WHERE job_id = ? ORDER BY segment_index", (job_id,)).fetchall()
+        return [json.loads(row["data"]) for row in rows]
+
+    def requeue_expired(self):
+        now = time.time()
+        affected = []
+        with self._transaction() as connection:
+            rows = connection.execute(
+                "SELECT * FROM jobs WHERE status = 'running' AND lease_expires < ?", (now,)
+            ).fetchall()
+            for row in rows:
+                job = self._row_to_job(row)
+                _expire(job, now)
+                connection.execute(
+                    "UPDATE jobs SET status = ?, worker_id = NULL, lease_expires = NULL, error = ?, updated_at = ? WHERE job_id = ?",
+                    (job["status"], job["error"], now, job["job_id"])
+                )
+                affected.append(job["job_id"])
+        return affected
+
+    def workers(self):
+        cutoff = time.time() - WORKER_TIMEOUT_SECONDS
+        with self._connect() as connection:
+            rows = connection.execute("SELECT worker_id, last_seen FROM workers WHERE last_seen >= ?", (cutoff,)).fetchall()
+            jobs = connection.execute("SELECT job_id, worker_id FROM jobs WHERE status = 'running'").fetchall()
+        return [
+            {"worker_id": row["worker_id"], "last_seen": row["last_seen"], "jobs": [j["job_id"] for j in jobs if j["worker_id"] == row["worker_id"]]}
+            for row in rows
+        ]
+
+
+class RedisJobQueue(JobQueue):
+    """
+    Queue in Redis, shared by workers on any number of hosts. Job records are JSON
+    strings; state transitions run as Lua scripts so they are atomic on the server.
+    """
+
+    # KEYS: queued list, running sorted set (score = lease expiry). ARGV: key prefix, worker, now, lease
+    CLAIM = """
+        local job_id = redis.call('RPOP', KEYS[1])
+        if not job_id then return false end
+        local key = ARGV[1] .. 'job:' .. job_id
+        local job = cjson.decode(redis.call('GET', key))
+        job.status = 'running'
+        job.worker_id = ARGV[2]
+        job.attempts = job.attempts + 1
+        job.lease_expires = tonumber(ARGV[3]) + tonumber(ARGV[4])
+        job.updated_at = tonumber(ARGV[3])
+        local encoded = cjson.encode(job)
+        redis.call('SET', key, encoded)
+        redis.call('ZADD', KEYS[2], job.lease_expires, job_id)
+        return encoded
+    """
+    # KEYS: running sorted set. ARGV: key prefix, job id, worker, lease expiry
+    EXTEND = """
+        local key = ARGV[1] .. 'job:' .. ARGV[2]
+        local raw = redis.call('GET', key)
+        if not raw then return 0 end
+        local job = cjson.decode(raw)
+        if job.status ~= 'running' or job.worker_id ~= ARGV[3] then return 0 end
+        job.lease_expires = tonumber(ARGV[4])
+        redis.call('SET', key, cjson.encode(job))
+        redis.call('ZADD', KEYS[1], job.lease_expires, ARGV[2])
+        return 1
+    """
+    # KEYS: running sorted set. ARGV: key prefix, job id, worker, status, result JSON, error, now
+    FINISH = """
+        local key = ARGV[1] .. 'job:' .. ARGV[2]
+        local raw = redis.call('GET', key)
+        if not raw then return 0 end
+        local job = cjson.decode(raw)
+        if job.status ~= 'running' or job.worker_id ~= ARGV[3] then return 0 end
+        job.status = ARGV[4]
+        if ARGV[4] == 'complete' then job.progress = 1 end
+        if ARGV[5] ~= '' then job.result = cjson.decode(ARGV[5]) end
+        if ARGV[6] ~= '' then job.error = ARGV[6] else job.error = cjson.null end
+        job.lease_expires = cjson.null
+        job.updated_at = tonumber(ARGV[7])
+        redis.call('SET', key, cjson.encode(job))
+        redis.call('ZREM', KEYS[1], ARGV[2])
+        return 1
+    """
+    # KEYS: segments hash of the job. ARGV: key prefix, job id, worker, segment index, segment JSON, progress, now
+    SEGMENT = """
+        local key = ARGV[1] .. 'job:' .. ARGV[2]
+        local raw = redis.call('GET', key)
+        if not raw then return 0 end
+        local job = cjson.decode(raw)
+        if job.status ~= 'running' or job.worker_id ~= ARGV[3] then return 0 end
+        job.progress = tonumber(ARGV[6])
+        job.updated_at = tonumber(ARGV[7])
+        redis.call('SET', key, cjson.encode(job))
+        redis.call('HSET', KEYS[1], ARGV[4], ARGV[5])
+        return 1
+    """
+    # KEYS: queued list, running sorted set. ARGV: key prefix, now
+    EXPIRE = """
+        local expired = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', '(' .. ARGV[2])
+        for _, job_id in ipairs(expired) do
+            local key = ARGV[1] .. 'job:' .. job_id
+            local job = cjson.decode(redis.call('GET', key))
+            redis.call('ZREM', KEYS[2], job_id)
+            if job.attempts >= job.max_attempts then
+                job.status = 'failed'
+                job.error = 'Worker ' .. tostring(job.worker_id) .. ' stopped responding; gave up after ' .. job.attempts .. ' attempts.'
+            else
+                job.status = 'queued'
+                redis.call('LPUSH', KEYS[1], job_id)
+            end
+            job.worker_id = cjson.null
+            job.lease_expires = cjson.null
+            job.updated_at = tonumber(ARGV[2])
+            redis.call('SET', key, cjson.encode(job))
+        end
+        return expired
+    """
+
+    def __init__(self, url: str, prefix: str = "upscalefx:"):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("The redis package is required for redis:// job queues.")
+        self.client = redis.Redis.from_url(url, decode_responses=True)
+        self.prefix = prefix
+        self.queued_key = f"{prefix}queued"
+        self.running_key = f"{prefix}running"
+        self.workers_key = f"{prefix}workers"
+        self._claim = self.client.register_script(self.CLAIM)
+        self._extend = self.client.register_script(self.EXTEND)
+        self._finish_script = self.client.register_script(self.FINISH)
+        self._segment = self.client.register_script(self.SEGMENT)
+        self._expire = self.client.register_script(self.EXPIRE)
+
+    def _job_key(self, job_id: str) -> str:
+        return f"{self.prefix}job:{job_id}"
+
+    def enqueue(self, operation, params, input_ref, max_attempts=MAX_ATTEMPTS):
+        job = _new_job(operation, params, input_ref, max_attempts)
+        with self.client.pipeline() as pipe:
+            pipe.set(self._job_key(job["job_id"]), json.dumps(job))
+            pipe.lpush(self.queued_key, job["job_id"])
+            pipe.execute()
+        return job
+
+    def get(self, job_id):
+        raw = self.client.get(self._job_key(job_id))
+        if raw is None:
+            raise JobNotFoundError(f"Job not found: {job_id}")
+        return json.loads(raw)
+
+    def claim(self, worker_id, lease_seconds=LEASE_SECONDS):
+        raw = self._claim(keys=[self.queued_key, self.running_key], args=[self.prefix, worker_id, time.time(), lease_seconds])
+        return json.loads(raw) if raw else None
+
+    def heartbeat(self, worker_id, job_ids=(), lease_seconds=LEASE_SECONDS):
+        now = time.time()
+        held = [
+            job_id for job_id in job_ids
+            if self._extend(keys=[self.running_key], args=[self.prefix, job_id, worker_id, now + lease_seconds])
+        ]
+        self.client.hset(self.workers_key, worker_id, json.dumps({"worker_id": worker_id, "last_seen": now, "jobs": held}))
+        return held
+
+    def _finish(self, job_id, worker_id, status, result=None, error=None):
+        return bool(self._finish_script(
+            keys=[self.running_key],
+            args=[self.prefix, job_id, worker_id, status, json.dumps(result) if result is not None else "", error or "", time.time()]
+        ))
+
+    def complete(self, job_id, worker_id, result):
+        return self._finish(job_id, worker_id, "complete", result=result)
+
+    def fail(self, job_id, worker_id, error):
+        return self._finish(job_id, worker_id, "failed", error=error)
+
+    def save_segment(self, job_id, worker_id, segment, progress):
+        return bool(self._segment(
+            keys=[f"{self.prefix}segments:{job_id}"],
+            args=[self.prefix, job_id, worker_id, segment["index"], json.dumps(segment), progress, time.time()]
+        ))
+
+    def segments(self, job_id):
+        entries = self.client.hgetall(f"{self.prefix}segments:{job_id}")
+        return [json.loads(raw) for _, raw in sorted(entries.items(), key=lambda item: int(item[0]))]
+
+    def requeue_expired(self):
+        return list(self._expire(keys=[self.queued_key, self.running_key], args=[self.prefix, time.time()]))
+
+    def workers(self):
+        cutoff = time.time() - WORKER_TIMEOUT_SECONDS
+        entries = [json.loads(raw) for raw in self.client.hvals(self.workers_key)]
+        return [entry for entry in entries if entry["last_seen"] >= cutoff]
+
+
+_memory_queue: Optional[MemoryJobQueue] = None
+
+
+def open_queue(url: str = JOB_QUEUE_URL) -> JobQueue:
+    """Opens the queue backend named by url (see the module docstring)."""
+    global _memory_queue
+    if url.startswith("sqlite://"):
+        return SQLiteJobQueue(url[len("sqlite://"):])
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisJobQueue(url)
+    if url == "memory://":
+        # One shared queue per process, so the API and in-process workers see the same jobs
+        if _memory_queue is None:
+            _memory_queue = MemoryJobQueue()
+        return _memory_queue
+    raise ValueError(f"Unsupported job queue URL: {url}. Use sqlite://, redis:// or memory://.")
@@ -0,0 +1,420 @@
+"""
+End-to-end load test of the API with a mixed workload.
+
+Starts the app locally (or targets --url), generates test media with ffmpeg, and
+fires requests at the endpoints in a weighted mix with Poisson arrivals: open-loop,
+so a slow server builds a backlog instead of slowing the load down. Each --rates
+value is one stage; per stage the report has throughput, per-endpoint p50/p95/p99
+latency and error rates, and CPU utilisation. The saturation point is the first
+offered rate the server could not keep up with. Reports are saved as JSON so runs
+can be compared across releases:
+
+    python loadtest.py --mix metadata=4,frame=3,compress=2,upscale=1 --rates 0.5,1,2,4 --stage-seconds 30
+    python loadtest.py --compare loadtest_reports/before.json loadtest_reports/after.json
+
+A recorded trace can be replayed instead of a synthetic mix (--trace): JSON lines of
+{"t": seconds from start, "endpoint": name}.
+
+Needs httpx (requirements-dev.txt).
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+REPORT_DIR = os.environ.get("UPSCALEFX_LOADTEST_REPORT_DIR", "loadtest_reports")
+DEFAULT_MIX = "metadata=4,frame=3,compress=2,upscale=1"
+# A stage whose throughput falls below this share of the offered rate is saturated
+SATURATION_THROUGHPUT_RATIO = 0.9
+SATURATION_ERROR_RATE = 0.05
+
+# Endpoint name -> (path, form fields)
+ENDPOINTS: Dict[str, Tuple[str, Dict[str, str]]] = {
+    "metadata": ("/get-metadata/", {}),
+    "frame": ("/extract-frame/", {"timestamp": "1"}),
+    "compress": ("/compress-video/", {"quality_preset": "low"}),
+    "upscale": ("/upscale-video/", {"scale_option": "2x"}),
+}
+
+
+def parse_mix(value: str) -> Dict[str, float]:
+    mix = {}
+    for part in value.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in ENDPOINTS:
+            raise ValueError(f"Unknown endpoint in mix: {name}. Known: {', '.join(ENDPOINTS)}")
+        mix[name] = float(weight or 1)
+    if not mix or sum(mix.values()) <= 0:
+        raise ValueError("The mix needs at least one endpoint with a positive weight.")
+    return mix
+
+
+def generate_media(directory: str, width: int, height: int, seconds: float) -> str:
+    """Encodes (once) a test clip with moving video and a tone, like a small camera upload."""
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"clip_{width}x{height}_{seconds:g}s.mp4")
+    if not os.path.exists(path):
+        subprocess.run([
+            "ffmpeg", "-v", "error", "-y",
+            "-f", "lavfi", "-i", f"testsrc2=size={width}x{height}:rate=30",
+            "-f", "lavfi", "-i", "sine=frequency=440:sample_rate=48000",
+            "-t", str(seconds), "-c:v", "libx264", "-preset", "veryfast", "-pix_fmt", "yuv420p",
+            "-c:a", "aac", "-shortest", path,
+        ], check=True)
+    return path
+
+
+def percentile(sorted_values: List[float], q: float) -> Optional[float]:
+    if not sorted_values:
+        return None
+    position = (len(sorted_values) - 1) * q
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+
+class CpuSampler:
+    """
+    Host CPU utilisation (/proc/stat) and CPU seconds of the server's process tree,
+    including its worker processes and finished ffmpeg children. Linux only; elsewhere
+    every figure is None.
+    """
+
+    def __init__(self, server_pid: Optional[int]):
+        self.server_pid = server_pid
+        self.available = os.path.exists("/proc/stat")
+        self.ticks = os.sysconf("SC_CLK_TCK") if self.available else 100
+
+    def _host(self) -> Tuple[int, int]:
+        with open("/proc/stat") as f:
+            values = [int(v) for v in f.readline().split()[1:]]
+        idle = values[3] + (values[4] if len(values) > 4 else 0)
+        return sum(values) - idle, sum(values)
+
+    def _tree_seconds(self) -> Optional[float]:
+        if self.server_pid is None:
+            return None
+        children: Dict[int, List[int]] = {}
+        times: Dict[int, int] = {}
+        for entry in os.listdir("/proc"):
+            if not entry.isdigit():
+                continue
+            try:
+                with open(f"/proc/{entry}/stat") as f:
+                    fields = f.read().rsplit(")", 1)[1].split()
+            except OSError:
+                continue
+            pid = int(entry)
+            children.setdefault(int(fields[1]), []).append(pid)
+            # utime, stime, and the same for children already waited for
+            times[pid] = sum(int(v) for v in fields[11:15])
+        total, stack = 0, [self.server_pid]
+        while stack:
+            pid = stack.pop()
+            total += times.get(pid, 0)
+            stack.extend(children.get(pid, []))
+        return total / self.ticks
+
+    def sample(self) -> Dict[str, Any]:
+        if not self.available:
+            return {}
+        busy, total = self._host()
+        return {"time": time.monotonic(), "busy": busy, "total": total, "tree": self._tree_seconds()}
+
+    @staticmethod
+    def utilisation(start: Dict[str, Any], end: Dict[str, Any]) -> Dict[str, Optional[float]]:
+        if not start or not end:
+            return {"host_percent": None, "server_cpu_seconds": None, "server_cores": None}
+        elapsed = end["time"] - start["time"]
+        total = end["total"] - start["total"]
+        tree = end["tree"] - start["tree"] if end["tree"] is not None and start["tree"] is not None else None
+        return {
+            "host_percent": round(100 * (end["busy"] - start["busy"]) / total, 1) if total else None,
+            "server_cpu_seconds": round(tree, 2) if tree is not None else None,
+            # Cores kept busy by the server on average; compare with the host's core count
+            "server_cores": round(tree / elapsed, 2) if tree is not None and elapsed > 0 else None,
+        }
+
+
+async def send_request(client: httpx.AsyncClient, endpoint: str, media: bytes, started: float) -> Dict[str, Any]:
+    path, fields = ENDPOINTS[endpoint]
+    begin = time.monotonic()
+    record: Dict[str, Any] = {"endpoint": endpoint, "sent_at": round(begin - started, 4)}
+    try:
+        response = await client.post(path, data=fields, files={"video": ("clip.mp4", media, "video/mp4")})
+        record["status"] = response.status_code
+        if response.status_code >= 400:
+            record["error"] = response.text[:200]
+    except httpx.HTTPError as e:
+        record["status"] = None
+        record["error"] = f"{type(e).__name__}: {str(e)}"
+    record["latency"] = time.monotonic() - begin
+    return record
+
+
+def summarise(records: List[Dict[str, Any]]) -> Dict[str, Any]:
+    latencies = sorted(r["latency"] for r in records if "error" not in r)
+    errors = sum("error" in r for r in records)
+    return {
+        "count": len(records),
+        "errors": errors,
+        "error_rate": round(errors / len(records), 4) if records else 0.0,
+        "p50": percentile(latencies, 0.50),
+        "p95": percentile(latencies, 0.95),
+        "p99": percentile(latencies, 0.99),
+        "mean": sum(latencies) / len(latencies) if latencies else None,
+        "max": latencies[-1] if latencies else None,
+    }
+
+
+def outstanding_at(records: List[Dict[str, Any]], moment: float) -> int:
+    """Requests sent but not yet answered at moment (seconds from the stage start)."""
+    return sum(r["sent_at"] <= moment < r["sent_at"] + r["latency"] for r in records)
+
+
+async def run_schedule(
+    base_url: str,
+    schedule: List[Tuple[float, str]],
+    media: bytes,
+    sampler: CpuSampler,
+    timeout: float,
+    window: float,
+) -> Dict[str, Any]:
+    """
+    Sends each (offset seconds, endpoint) of the schedule on time and waits for every
+    response. window is the arrival window: throughput counts the successes completed
+    in its second half, once the server is past warm-up and before arrivals stop, so
+    the time spent draining a backlog afterwards does not dilute it.
+    """
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+    async with httpx.AsyncClient(base_url=base_url, timeout=timeout, limits=limits) as client:
+        cpu_start = sampler.sample()
+        started = time.monotonic()
+        tasks = []
+        for offset, endpoint in schedule:
+            delay = started + offset - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(send_request(client, endpoint, media, started)))
+        records = await asyncio.gather(*tasks)
+        elapsed = time.monotonic() - started
+        cpu_end = sampler.sample()
+
+    half = window / 2
+    steady = sum("error" not in r and half <= r["sent_at"] + r["latency"] <= window for r in records)
+    by_endpoint: Dict[str, List[Dict[str, Any]]] = {}
+    for record in records:
+        by_endpoint.setdefault(record["endpoint"], []).append(record)
+    return {
+        "sent": len(records),
+        "elapsed_seconds": round(elapsed, 3),
+        # Successes completed per second in the second half of the arrival window
+        "throughput": round(steady / half, 3) if half > 0 else None,
+        # A server keeping up holds a steady backlog; a saturated one grows it for as long as arrivals go on
+        "backlog_mid": outstanding_at(records, half),
+        "backlog_end": outstanding_at(records, window),
+        "drain_seconds": round(max(0.0, elapsed - window), 3),
+        "overall": summarise(records),
+        "endpoints": {name: summarise(items) for name, items in sorted(by_endpoint.items())},
+        "cpu": CpuSampler.utilisation(cpu_start, cpu_end),
+        "sample_errors": [r["error"] for r in records if "error" in r][:5],
+    }
+
+
+def poisson_schedule(mix: Dict[str, float], rate: float, seconds: float, rng: random.Random) -> List[Tuple[float, str]]:
+    names, weights = list(mix), list(mix.values())
+    schedule, offset = [], rng.expovariate(rate)
+    while offset < seconds:
+        schedule.append((offset, rng.choices(names, weights)[0]))
+        offset += rng.expovariate(rate)
+    return schedule
+
+
+def load_trace(path: str) -> List[Tuple[float, str]]:
+    schedule = []
+    with open(path) as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            if entry.get("endpoint") not in ENDPOINTS:
+                raise ValueError(f"Trace line {line_number}: unknown endpoint {entry.get('endpoint')!r}.")
+            schedule.append((float(entry["t"]), entry["endpoint"]))
+    return sorted(schedule)
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(port: int, uvicorn_workers: int, work_dir: str) -> subprocess.Popen:
+    # The app writes its temp_* and assets directories under work_dir, not the source tree
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--app-dir", BACKEND_DIR,
+         "--host", "127.0.0.1", "--port", str(port), "--workers", str(uvicorn_workers), "--log-level", "warning"],
+        cwd=work_dir,
+    )
+
+
+def wait_until_ready(base_url: str, server: Optional[subprocess.Popen], timeout: float = 120) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server is not None and server.poll() is not None:
+            raise RuntimeError(f"The server exited with status {server.returncode} during start-up.")
+        try:
+            if httpx.get(f"{base_url}/ready", timeout=2).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.25)
+    raise RuntimeError(f"The server at {base_url} was not ready after {timeout:g}s.")
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def saturation_rate(stages: List[Dict[str, Any]]) -> Optional[float]:
+    """
+    The arrival rate of the first stage whose throughput or error rate shows the
+    server falling behind: completing fewer requests than arrive while arrivals
+    are still going on.
+    """
+    for stage in stages:
+        # A replayed trace has no rate to hold; its stage is only reported
+        if stage.get("offered_rate") is None:
+            continue
+        if stage["overall"]["error_rate"] > SATURATION_ERROR_RATE or (stage["throughput"] or 0) < SATURATION_THROUGHPUT_RATIO * stage["arrival_rate"]:
+            return stage["arrival_rate"]
+    return None
+
+
+def print_stage(stage: Dict[str, Any]) -> None:
+    offered = f"{stage['offered_rate']:g} req/s (arrivals {stage['arrival_rate']:g}/s)" if stage.get("offered_rate") is not None else f"trace (arrivals {stage['arrival_rate']:g}/s)"
+    cpu = stage["cpu"]
+    print(f"\n{offered}: sent {stage['sent']}, throughput {stage['throughput']} req/s, "
+          f"backlog {stage['backlog_mid']} -> {stage['backlog_end']}, drained in {stage['drain_seconds']}s, "
+          f"errors {stage['overall']['error_rate']:.1%}, host CPU {cpu['host_percent']}%, server cores {cpu['server_cores']}")
+    print(f"  {'endpoint':<10} {'count':>6} {'err%':>6} {'p50':>8} {'p95':>8} {'p99':>8}")
+    for name, summary in stage["endpoints"].items():
+        cells = [f"{summary[key]:8.3f}" if summary[key] is not None else f"{'-':>8}" for key in ("p50", "p95", "p99")]
+        print(f"  {name:<10} {summary['count']:>6} {summary['error_rate']:>6.1%} {' '.join(cells)}")
+
+
+def compare_reports(before_path: str, after_path: str) -> None:
+    with open(before_path) as f:
+        before = json.load(f)
+    with open(after_path) as f:
+        after = json.load(f)
+    print(f"{before.get('revision')} -> {after.get('revision')}; saturation {before.get('saturation_rate')} -> {after.get('saturation_rate')} req/s")
+    before_stages = {stage.get("offered_rate"): stage for stage in before["stages"]}
+    for stage in after["stages"]:
+        previous = before_stages.get(stage.get("offered_rate"))
+        if previous is None:
+            continue
+        print(f"\n{stage.get('offered_rate')} req/s: throughput {previous['throughput']} -> {stage['throughput']}")
+        for name, summary in stage["endpoints"].items():
+            old = previous["endpoints"].get(name)
+            if not old or old["p95"] is None or summary["p95"] is None:
+                continue
+            change = (summary["p95"] - old["p95"]) / old["p95"] * 100
+            print(f"  {name:<10} p95 {old['p95']:.3f}s -> {summary['p95']:.3f}s ({change:+.1f}%), errors {old['error_rate']:.1%} -> {summary['error_rate']:.1%}")
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Load-test the API with a mixed workload and save a JSON report.")
+    parser.add_argument("--url", default=None, help="Target a running server instead of starting one")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"Weighted endpoints, e.g. {DEFAULT_MIX} (known: {', '.join(ENDPOINTS)})")
+    parser.add_argument("--rates", default="0.5,1,2,4", help="Offered arrival rates (req/s), one stage each")
+    parser.add_argument("--stage-seconds", type=float, default=30, help="Arrival window of each stage")
+    parser.add_argument("--trace", default=None, help="Replay a JSON-lines trace instead of --mix/--rates")
+    parser.add_argument("--media-size", default="640x360", help="Test clip size, WIDTHxHEIGHT")
+    parser.add_argument("--media-seconds", type=float, default=5)
+    parser.add_argument("--uvicorn-workers", type=int, default=1)
+    parser.add_argument("--timeout", type=float, default=300, help="Per-request timeout in seconds")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default=None, help="Report path (default: a timestamped file in loadtest_reports/)")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"), help="Compare two saved reports and exit")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare_reports(*args.compare)
+        return 0
+
+    width, height = (int(v) for v in args.media_size.lower().split("x"))
+    work_dir = tempfile.mkdtemp(prefix="upscalefx-loadtest-")
+    with open(generate_media(os.path.join(work_dir, "media"), width, height, args.media_seconds), "rb") as f:
+        media = f.read()
+
+    server = None
+    base_url = args.url.rstrip("/") if args.url else None
+    if base_url is None:
+        port = free_port()
+        base_url = f"http://127.0.0.1:{port}"
+        server = start_server(port, args.uvicorn_workers, work_dir)
+    try:
+        wait_until_ready(base_url, server)
+        sampler = CpuSampler(server.pid if server else None)
+        rng = random.Random(args.seed)
+        mix = parse_mix(args.mix)
+        if args.trace:
+            plans = [(None, load_trace(args.trace))]
+        else:
+            plans = [(rate, poisson_schedule(mix, rate, args.stage_seconds, rng)) for rate in (float(r) for r in args.rates.split(","))]
+
+        stages = []
+        for rate, schedule in plans:
+            window = args.stage_seconds if rate is not None else max((offset for offset, _ in schedule), default=0) or 1
+            stage = {"offered_rate": rate, **asyncio.run(run_schedule(base_url, schedule, media, sampler, args.timeout, window))}
+            # The Poisson draw of a short stage can stray from the nominal rate
+            stage["arrival_rate"] = round(stage["sent"] / window, 3)
+            stages.append(stage)
+            print_stage(stage)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait(timeout=30)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "revision": git_revision(),
+        "host": {"platform": platform.platform(), "python": platform.python_version(), "cpu_count": os.cpu_count()},
+        "config": {
+            "url": args.url, "mix": None if args.trace else mix, "trace": args.trace, "stage_seconds": args.stage_seconds,
+            "media": {"width": width, "height": height, "seconds": args.media_seconds, "bytes": len(media)},
+            "uvicorn_workers": args.uvicorn_workers, "seed": args.seed,
+        },
+        "stages": stages,
+        "saturation_rate": saturation_rate(stages),
+    }
+    output = args.output or os.path.join(REPORT_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}_{report['revision'] or 'local'}.json")
+    if os.path.dirname(output):
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    saturation = report["saturation_rate"]
+    print(f"\nSaturation: {f'{saturation:g} req/s' if saturation is not None else 'not reached'}. Report saved to {output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
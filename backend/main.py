@@ -1,96 +1,531 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException
-from fastapi.responses import FileResponse
-import ffmpeg
+import json
+import mimetypes
 import os
+import re
 import shutil
+import subprocess
+import threading
+import time
 import uuid
+from contextlib import asynccontextmanager
+from functools import partial
+from typing import Any, Callable, Dict, List, Optional
+from urllib.parse import quote
 
-app = FastAPI()
-
-# Create a temporary directory for uploads if it doesn't exist
-UPLOAD_DIR = "temp_uploads"
-os.makedirs(UPLOAD_DIR, exist_ok=True)
-
-from fastapi import FastAPI, UploadFile, File, HTTPException, Form
-from fastapi.responses import FileResponse
 import ffmpeg
-import os
-import shutil
-import uuid
-from typing import Optional
-
-app = FastAPI()
+from fastapi import Depends, FastAPI, UploadFile, File, HTTPException, Form, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
+
+import asset_proxy
+import asset_store
+import batch
+import crf_search
+import decode_pool
+import job_queue
+import media_index
+import metadata_editor
+import scalers
+import segmented_encode
+import storage as job_storage
+import stream_planner
+import upload_spool
+import worker
+import worker_pool
+from file_serving import RangedFileResponse, resolve_within
+
+# Keep module-level imports light: every uvicorn and processing worker pays for them at
+# start-up (checked by import_budget.py). Heavy optional modules load on first use.
+
+# Queued-job workers run inside the API process (single-host setups); 0 leaves jobs to worker.py
+EMBEDDED_WORKERS = int(os.environ.get("UPSCALEFX_EMBEDDED_WORKERS", "0"))
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    for path in upload_spool.sweep_stale_staging():
+        print(f"Removed {path}, staged in memory by a process that is no longer running.")
+    # Processing workers spawn and import this module in the background while requests are served
+    worker_pool.start(warm_modules=(__name__,))
+    embedded_worker = None
+    if EMBEDDED_WORKERS > 0:
+        queue, store = job_backends()
+        embedded_worker = worker.Worker(queue, store, run_operation, concurrency=EMBEDDED_WORKERS, daemon=True)
+        threading.Thread(target=embedded_worker.run, daemon=True, name="embedded-worker").start()
+    yield
+    if embedded_worker is not None:
+        # Running jobs are abandoned; their leases lapse and they resume from their last segment
+        embedded_worker.stop()
+    worker_pool.shutdown()
+
+app = FastAPI(lifespan=lifespan)
+# Uploads stay in memory when small and are otherwise written once, to their final path
+app.router.route_class = upload_spool.SpoolingRoute
+app.add_middleware(upload_spool.BodySizeLimitMiddleware, max_bytes=upload_spool.MAX_REQUEST_BYTES)
 
 # Create a temporary directory for uploads if it doesn't exist
 UPLOAD_DIR = "temp_uploads"
+# Upload chunk bodies are written to disk in pieces of about this size
+UPLOAD_WRITE_BYTES = 1024 * 1024
 PROCESSED_DIR = "temp_processed"
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 os.makedirs(PROCESSED_DIR, exist_ok=True)
 
+# Media types for processed outputs, keyed by file extension
+MEDIA_TYPES = {
+    ".mp4": "video/mp4",
+    ".m4v": "video/mp4",
+    ".avi": "video/x-msvideo",
+    ".mov": "video/quicktime",
+    ".mkv": "video/x-matroska",
+    ".webm": "video/webm",
+    ".flv": "video/x-flv",
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".png": "image/png",
+    ".m3u8": "application/vnd.apple.mpegurl",
+    ".ts": "video/mp2t",
+    ".mpd": "application/dash+xml",
+    ".m4s": "video/iso.segment",
+}
+
+def output_file_response(path: str, media_type: str, filename: str) -> FileResponse:
+    """
+    Returns a processed file and points at its stable /outputs/ URL via Content-Location.
+    The location is relative, so it resolves correctly behind a path prefix such as /api.
+    """
+    relative_path = os.path.relpath(path, PROCESSED_DIR).replace(os.sep, "/")
+    return FileResponse(
+        path=path,
+        media_type=media_type,
+        filename=filename,
+        headers={"Content-Location": f"../outputs/{quote(relative_path)}"}
+    )
+
+def input_filename(video: Optional[UploadFile], asset_id: Optional[str]) -> str:
+    """
+    Validates that exactly one of an uploaded video or a stored asset id was given
+    and returns the original filename of the input.
+    """
+    if asset_id:
+        if video is not None:
+            raise HTTPException(status_code=400, detail="Provide either a video upload or an asset_id, not both.")
+        try:
+            return asset_store.get_asset(asset_id)["filename"]
+        except FileNotFoundError as e:
+            raise HTTPException(status_code=404, detail=str(e))
+    if video is None:
+        raise HTTPException(status_code=400, detail="No video provided. Upload a video or pass an asset_id.")
+    if not video.content_type or not video.content_type.startswith("video/"):
+        raise HTTPException(status_code=400, detail="Invalid file type. Please upload a video.")
+    return video.filename if video.filename else "video"
+
+def stage_input(video: Optional[UploadFile], asset_id: Optional[str], upload_path: str) -> tuple[str, bool]:
+    """
+    Makes an endpoint's input available on disk and returns (path, is_temporary).
+    Uploads are moved to upload_path, or staged in RAM under the same file name when
+    small (upload_spool.py), and must be removed by the caller; stored assets are used
+    in place and must never be deleted.
+    """
+    if asset_id:
+        try:
+            return asset_store.get_asset(asset_id)["path"], False
+        except FileNotFoundError as e:
+            raise HTTPException(status_code=404, detail=str(e))
+    try:
+        return upload_spool.stage_upload(video.file, upload_path), True
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Could not save uploaded video: {str(e)}")
+    finally:
+        video.file.close()
+
+def remove_temporary_input(path: str) -> None:
+    """Deletes a temporary input staged by stage_input and closes its pooled decoder, if any."""
+    decode_pool.forget(path)
+    if os.path.exists(path):
+        os.remove(path)
+
+# Quick previews render a short window of the input with the same settings as the full job
+PREVIEW_SECONDS = 4.0
+PREVIEW_MAX_SECONDS = 10.0
+
+def preview_options(
+    preview: bool = Form(False), # Render only a short window, to tune settings before the full job
+    preview_start: Optional[str] = Form(None), # Window start (seconds or HH:MM:SS); defaults to mid-video
+    preview_seconds: float = Form(PREVIEW_SECONDS),
+    preview_compare: bool = Form(False) # Return the original and processed window side by side
+) -> Optional[Dict[str, Any]]:
+    """Form fields shared by the processing endpoints; None when no preview was requested."""
+    if not preview:
+        return None
+    if not 0 < preview_seconds <= PREVIEW_MAX_SECONDS:
+        raise HTTPException(status_code=400, detail=f"preview_seconds must be between 0 and {PREVIEW_MAX_SECONDS:g}.")
+    return {"start": preview_start, "seconds": preview_seconds, "compare": preview_compare}
+
+def resolve_preview_window(input_path: str, start_time: Optional[str], seconds: float) -> tuple[float, float]:
+    """(start, length) of a preview window, centred on the video unless start_time is given."""
+    try:
+        duration = float(ffmpeg.probe(input_path).get('format', {}).get('duration') or 0)
+    except ffmpeg.Error as e:
+        raise ValueError(f"Error probing video file: {e.stderr.decode('utf8') if e.stderr else 'Unknown ffmpeg error'}")
+    if start_time:
+        start = media_index.parse_timestamp(start_time)
+    else:
+        start = max(0.0, (duration - seconds) / 2)
+    if duration > 0:
+        if start >= duration:
+            raise ValueError(f"Preview start {start:g}s is past the end of the video ({duration:g}s).")
+        seconds = min(seconds, duration - start)
+    return start, seconds
+
+def cut_preview_window_py(input_path: str, output_path: str, window: tuple[float, float], transform_video: bool = True) -> str:
+    """
+    Cuts a window of the input into an MKV holding the source's own streams, so the
+    processing step plans them exactly as for the whole file. Audio and untouched
+    video are stream-copied; with transform_video the video, which the step re-encodes
+    anyway, is encoded losslessly so it starts on the exact frame. Copied video
+    starts at the keyframe before the window.
+    """
+    plan = stream_planner.plan_streams(stream_planner.probe_streams(input_path), "mkv", transform_video=transform_video)
+    # Copied packets before the seek point are dropped so copied audio starts with the
+    # exact video; copied video keeps them, and its audio with it
+    copy_prior = 0 if transform_video else -1
+    try:
+        stream = stream_planner.planned_output(
+            input_path,
+            output_path,
+            plan,
+            video_options={'qp': 0, 'preset': 'ultrafast'},
+            input_options={'ss': window[0]},
+            t=window[1],
+            copypriorss=copy_prior
+        )
+        ffmpeg.run(stream, overwrite_output=True, quiet=True)
+    except ffmpeg.Error as e:
+        error_message = e.stderr.decode('utf8') if e.stderr else "Unknown ffmpeg error while cutting the preview window"
+        print(f"ffmpeg.Error while cutting preview window: {error_message}")
+        raise Exception(f"FFmpeg error while cutting the preview window: {error_message}")
+    return output_path
+
+def compare_preview_py(input_path: str, window: tuple[float, float], processed_path: str) -> str:
+    """
+    Replaces a processed preview with an MP4 of the original window (scaled to the same
+    height) and the processed result side by side.
+    """
+    compare_path = f"{os.path.splitext(processed_path)[0]}_compare.mp4"
+    _, height = get_video_dimensions(processed_path)
+    original = ffmpeg.input(input_path, ss=window[0], t=window[1]).video.filter('scale', -2, height).filter('setsar', 1)
+    processed = ffmpeg.input(processed_path).video.filter('setsar', 1)
+    try:
+        (
+            ffmpeg
+            .filter([original, processed], 'hstack', shortest=1)
+            .output(compare_path, vcodec='libx264', crf=18, preset='ultrafast', pix_fmt='yuv420p', movflags='+faststart')
+            .run(overwrite_output=True, quiet=True)
+        )
+    except ffmpeg.Error as e:
+        error_message = e.stderr.decode('utf8') if e.stderr else "Unknown ffmpeg error while building the comparison"
+        print(f"ffmpeg.Error while building preview comparison: {error_message}")
+        raise Exception(f"FFmpeg error while building the preview comparison: {error_message}")
+    finally:
+        if os.path.exists(processed_path):
+            os.remove(processed_path)
+    return compare_path
+
+def preview_py(process: Callable[[str], str], input_path: str, window: tuple[float, float], compare: bool = False, transform_video: bool = True) -> str:
+    """
+    Runs process (input path -> output path) on a window of the input instead of the
+    whole file. transform_video is False for steps that may copy the video stream.
+    """
+    window_path = os.path.join(UPLOAD_DIR, f"{uuid.uuid4()}_preview.mkv")
+    try:
+        cut_preview_window_py(input_path, window_path, window, transform_video)
+        output_path = process(window_path)
+    finally:
+        if os.path.exists(window_path):
+            os.remove(window_path)
+    return compare_preview_py(input_path, window, output_path) if compare else output_path
+
+def preview_file_response(path: str, filename: str, window: tuple[float, float]) -> FileResponse:
+    extension = os.path.splitext(path)[1].lower()
+    response = output_file_response(
+        path=path,
+        media_type=MEDIA_TYPES.get(extension, "application/octet-stream"),
+        filename=f"preview_{os.path.splitext(filename)[0]}{extension}"
+    )
+    response.headers["X-Preview-Window"] = f"{window[0]:.3f}-{window[0] + window[1]:.3f}"
+    return response
+
 @app.get("/")
 async def read_root():
     return {"message": "Welcome to the Video Upscaling API"}
 
+@app.get("/ready")
+async def readiness_endpoint():
+    """Readiness probe: 503 until the processing workers have started and loaded their modules."""
+    ready = worker_pool.is_ready()
+    return JSONResponse(
+        {"ready": ready, "processing_workers": worker_pool.worker_count()},
+        status_code=200 if ready else 503
+    )
+
+@app.api_route("/outputs/{output_path:path}", methods=["GET", "HEAD"])
+async def get_output_endpoint(request: Request, output_path: str, filename: Optional[str] = None):
+    """
+    Serves a processed file at a stable URL with Range/206, ETag/If-None-Match
+    and If-Range support, so players can seek and downloads can resume.
+    """
+    try:
+        file_path = resolve_within(PROCESSED_DIR, output_path)
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    if not os.path.isfile(file_path):
+        raise HTTPException(status_code=404, detail=f"Output not found: {output_path}")
+
+    extension = os.path.splitext(file_path)[1].lower()
+    media_type = MEDIA_TYPES.get(extension) or mimetypes.guess_type(file_path)[0] or "application/octet-stream"
+    return RangedFileResponse(
+        path=file_path,
+        media_type=media_type,
+        filename=filename,
+        request_headers=request.headers,
+        method=request.method
+    )
+
+@app.post("/uploads/", status_code=201)
+async def create_upload_endpoint(
+    size: int = Form(...),
+    filename: str = Form("video"),
+    sha256: Optional[str] = Form(None) # Hex digest of the whole file, enables server-side dedup
+):
+    """
+    Starts a resumable upload. If the store already holds content with the given sha256,
+    the response is already complete and carries the existing asset_id.
+    """
+    try:
+        # Also sweeps expired sessions, so it runs off the event loop
+        state = await run_in_threadpool(asset_store.create_upload, size=size, filename=filename, sha256=sha256)
+    except asset_store.UploadTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if state["complete"]:
+        asset_proxy.schedule_proxy(state["asset_id"])
+    return state
+
+@app.patch("/uploads/{upload_id}")
+async def upload_chunk_endpoint(upload_id: str, request: Request):
+    """
+    Writes the raw request body at the byte offset in the Upload-Offset header.
+    Chunks may be sent in parallel and in any order; an optional
+    'Upload-Checksum: sha256 <base64>' header is verified before the chunk counts.
+    Chunks for an upload that is already being finalized or complete get 409.
+    """
+    try:
+        offset = int(request.headers.get("upload-offset", ""))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Missing or invalid Upload-Offset header.")
+    try:
+        checksum = asset_store.parse_checksum_header(request.headers.get("upload-checksum"))
+        writer = asset_store.ChunkWriter(upload_id, offset)
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except asset_store.UploadClosedError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    try:
+        # Body pieces are small; they are gathered so each write to disk is one threadpool hop
+        buffer = bytearray()
+        async for data in request.stream():
+            buffer += data
+            if len(buffer) >= UPLOAD_WRITE_BYTES:
+                await run_in_threadpool(writer.write, bytes(buffer))
+                buffer.clear()
+        if buffer:
+            await run_in_threadpool(writer.write, bytes(buffer))
+    except ValueError as e:
+        writer.close()
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        writer.close()
+        print(f"Error writing upload chunk: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Could not write upload chunk: {str(e)}")
+    except BaseException:
+        # Client disconnects cancel the request; the chunk's scratch file must not linger
+        writer.close()
+        raise
+
+    try:
+        state = await run_in_threadpool(writer.commit, checksum)
+    except asset_store.UploadChecksumError as e:
+        raise HTTPException(status_code=460, detail=str(e))
+    except asset_store.UploadClosedError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    if state["complete"]:
+        # Previews of the new asset are served from a proxy encoded in the background
+        asset_proxy.schedule_proxy(state["asset_id"])
+    return JSONResponse(state, headers={"Upload-Offset": str(state["offset"])})
+
+@app.head("/uploads/{upload_id}")
+async def upload_offset_endpoint(upload_id: str):
+    """tus-style resume probe: Upload-Offset is the length of the contiguous prefix received."""
+    try:
+        state = asset_store.get_upload(upload_id)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404)
+    return Response(headers={
+        "Upload-Offset": str(state["offset"]),
+        "Upload-Length": str(state["size"]),
+        "Cache-Control": "no-store",
+    })
+
+@app.get("/uploads/{upload_id}")
+async def upload_status_endpoint(upload_id: str):
+    """Full upload state, including every received byte range for parallel resumes."""
+    try:
+        return asset_store.get_upload(upload_id)
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+@app.delete("/uploads/{upload_id}", status_code=204)
+async def cancel_upload_endpoint(upload_id: str):
+    try:
+        asset_store.cancel_upload(upload_id)
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    return Response(status_code=204)
+
+@app.get("/assets/{asset_id}")
+async def get_asset_endpoint(asset_id: str):
+    try:
+        record = asset_store.get_asset(asset_id)
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    return {**{key: value for key, value in record.items() if key != "path"}, "proxy": asset_proxy.proxy_status(asset_id)}
+
+@app.api_route("/assets/{asset_id}/proxy", methods=["GET", "HEAD"])
+async def get_asset_proxy_endpoint(request: Request, asset_id: str):
+    """
+    Serves the asset's low-resolution preview proxy with Range support. While it is
+    not ready yet, responds 202 with its status (and queues it if needed).
+    """
+    try:
+        status = asset_proxy.schedule_proxy(asset_id)
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    if status["status"] != "ready":
+        return JSONResponse(status, status_code=202, headers={"Cache-Control": "no-store"})
+    return RangedFileResponse(
+        path=asset_proxy.proxy_path(asset_id),
+        media_type="video/mp4",
+        request_headers=request.headers,
+        method=request.method
+    )
+
+@app.get("/assets/{asset_id}/preview")
+async def get_asset_preview_endpoint(asset_id: str, timestamp: str, image_format: str = "jpg"):
+    """
+    Preview frame at timestamp, decoded from the asset's proxy when it is ready (the
+    original otherwise). Frames are cached per asset, timestamp and source.
+    """
+    try:
+        seconds = media_index.parse_timestamp(timestamp)
+        input_path, is_proxy = asset_proxy.preview_input(asset_id)
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    source = "proxy" if is_proxy else "original"
+    preview_dir = os.path.join(PROCESSED_DIR, "previews", asset_id)
+    os.makedirs(preview_dir, exist_ok=True)
+    output_base = os.path.join(preview_dir, f"{source}_{seconds:.3f}")
+    output_path = f"{output_base}.{image_format.lower()}"
+    try:
+        if not os.path.exists(output_path):
+            output_path = await run_in_threadpool(extract_frame_py, input_path, output_base, f"{seconds:.3f}", image_format)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        print(f"Unhandled error during preview extraction: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error during preview extraction: {str(e)}")
+
+    response = output_file_response(
+        path=output_path,
+        media_type=MEDIA_TYPES.get(os.path.splitext(output_path)[1], "application/octet-stream"),
+        filename=os.path.basename(output_path)
+    )
+    response.headers["X-Preview-Source"] = source
+    return response
+
+def asset_media_index(asset_id: str, scenes: bool = False) -> media_index.MediaIndex:
+    """Keyframe (and optionally scene) index of an asset, built on first use and kept beside it."""
+    asset = asset_store.get_asset(asset_id)
+    sidecar_path = os.path.join(asset_store.asset_dir(asset_id), media_index.SIDECAR_NAME)
+    return media_index.load_or_build_index(asset["path"], sidecar_path, scenes=scenes)
+
+@app.get("/assets/{asset_id}/index")
+async def get_asset_index_endpoint(asset_id: str, scenes: bool = False):
+    """Keyframe times and byte positions; with scenes=true also scene cuts (a decode pass on first request)."""
+    try:
+        index = await run_in_threadpool(asset_media_index, asset_id, scenes)
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        print(f"Error while indexing asset {asset_id}: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error while indexing asset: {str(e)}")
+    return {"asset_id": asset_id, **index.to_dict()}
+
 @app.post("/upscale-video/")
 async def upscale_video_endpoint(
-    video: UploadFile = File(...),
-    scale_option: str = Form("2x") # e.g., "2x", "4x", "1080p", "4k"
+    video: Optional[UploadFile] = File(None),
+    asset_id: Optional[str] = Form(None),
+    scale_option: str = Form("2x"), # e.g., "2x", "4x", "1080p", "4k"
+    scaler: str = Form(scalers.DEFAULT_SCALER), # e.g., "lanczos", "bicubic", "zscale" or "auto"
+    quality_floor: Optional[float] = Form(None), # Minimum calibrated SSIM for scaler="auto"
+    preview: Optional[Dict[str, Any]] = Depends(preview_options)
 ):
-    if not video.content_type or not video.content_type.startswith("video/"):
-        raise HTTPException(status_code=400, detail="Invalid file type. Please upload a video.")
-
     file_id = str(uuid.uuid4())
-    original_filename = video.filename if video.filename else "video"
+    original_filename = input_filename(video, asset_id)
     file_extension = os.path.splitext(original_filename)[1] if original_filename and os.path.splitext(original_filename)[1] else ".mp4"
 
     input_temp_path = os.path.join(UPLOAD_DIR, f"{file_id}_input{file_extension}")
     output_temp_path = os.path.join(PROCESSED_DIR, f"{file_id}_upscaled{file_extension}")
 
-    try:
-        with open(input_temp_path, "wb") as buffer:
-            shutil.copyfileobj(video.file, buffer)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Could not save uploaded video: {str(e)}")
-    finally:
-        video.file.close()
+    input_temp_path, input_is_temporary = await run_in_threadpool(stage_input, video, asset_id, input_temp_path)
 
     try:
-        scale_factor_val = 0
-        target_width_val = 0
-        target_height_val = 0 # Primarily driven by width to maintain aspect ratio
-
-        if scale_option.lower().endswith('x'):
-            try:
-                factor = float(scale_option.lower().replace('x', ''))
-                if factor <= 0:
-                    raise ValueError("Scale factor must be positive.")
-                scale_factor_val = factor
-            except ValueError:
-                raise HTTPException(status_code=400, detail="Invalid scale factor format. Use '2x', '1.5x', etc.")
-        elif scale_option.lower() == '1080p':
-            target_width_val = 1920
-            target_height_val = 1080 # Used as a reference, aspect ratio preserved by width
-        elif scale_option.lower() == '4k':
-            target_width_val = 3840
-            target_height_val = 2160 # Used as a reference
-        else:
-            raise HTTPException(status_code=400, detail="Invalid scale_option. Supported: 'Nx' (e.g. '2x'), '1080p', '4k'.")
+        scale_factor_val, target_width_val, target_height_val = parse_scale_option(scale_option)
+        scaler = scalers.validate_scaler(scaler, quality_floor)
 
-        upscaled_file_path = upscale_video_py(
-            input_path=input_temp_path,
+        process = partial(
+            upscale_video_py,
             output_path=output_temp_path,
             scale_factor=scale_factor_val,
             target_width=target_width_val,
-            target_height=target_height_val # target_height is more of a guideline for the function
+            target_height=target_height_val, # target_height is more of a guideline for the function
+            scaler=scaler,
+            quality_floor=quality_floor
         )
+        if preview:
+            window = await run_in_threadpool(resolve_preview_window, input_temp_path, preview["start"], preview["seconds"])
+            upscaled_file_path = await worker_pool.run_in_process(preview_py, process, input_temp_path, window, preview["compare"])
+        else:
+            upscaled_file_path = await worker_pool.run_in_process(process, input_temp_path)
 
         # Ensure filename for download is somewhat descriptive
         download_filename = f"upscaled_{scale_option}_{original_filename}"
         if not download_filename.endswith(file_extension): # ensure correct extension if original_filename was weird
             download_filename = f"{os.path.splitext(download_filename)[0]}{file_extension}"
 
-
-        return FileResponse(
+        if preview:
+            return preview_file_response(upscaled_file_path, download_filename, window)
+        return output_file_response(
             path=upscaled_file_path,
             media_type='video/mp4', # Or determine dynamically if supporting other output types
             filename=download_filename # Suggests a filename to the browser
@@ -108,8 +543,8 @@ async def upscale_video_endpoint(
         raise HTTPException(status_code=500, detail=f"Error during video upscaling: {str(e)}")
     finally:
         # Clean up the input temporary file
-        if os.path.exists(input_temp_path):
-            os.remove(input_temp_path)
+        if input_is_temporary:
+            remove_temporary_input(input_temp_path)
         # Note: The upscaled file (output_temp_path) is sent and then should ideally be cleaned up.
         # FileResponse can use a background task for cleanup after sending.
         # For simplicity now, we are not auto-deleting it. A cron job or similar might be needed for `PROCESSED_DIR`.
@@ -120,8 +555,32 @@ async def upscale_video_endpoint(
         #    os.remove(upscaled_file_path)
         # For now, we'll leave it and address cleanup of PROCESSED_DIR as a potential improvement.
 
+def parse_scale_option(scale_option: str) -> tuple[float, int, int]:
+    """
+    Parses an upscale option into (scale_factor, target_width, target_height).
+    Exactly one of scale_factor or target_width is non-zero.
+    """
+    if scale_option.lower().endswith('x'):
+        try:
+            factor = float(scale_option.lower().replace('x', ''))
+        except ValueError:
+            raise ValueError("Invalid scale factor format. Use '2x', '1.5x', etc.")
+        if factor <= 0:
+            raise ValueError("Scale factor must be positive.")
+        return factor, 0, 0
+    elif scale_option.lower() == '1080p':
+        return 0, 1920, 1080 # Height is a reference, aspect ratio preserved by width
+    elif scale_option.lower() == '4k':
+        return 0, 3840, 2160 # Height is a reference
+    raise ValueError("Invalid scale_option. Supported: 'Nx' (e.g. '2x'), '1080p', '4k'.")
+
 def get_video_dimensions(input_path: str) -> tuple[int, int]:
-    """Gets the width and height of the video."""
+    """Gets the width and height of the video, in-process when PyAV is available."""
+    if decode_pool.available():
+        try:
+            return decode_pool.dimensions(input_path)
+        except decode_pool.DecodeError as e:
+            print(f"In-process probe failed, using ffprobe: {str(e)}")
     try:
         probe = ffmpeg.probe(input_path)
         video_stream = next((stream for stream in probe['streams'] if stream['codec_type'] == 'video'), None)
@@ -141,21 +600,30 @@ def upscale_video_py(
     output_path: str,
     scale_factor: float = 0,
     target_width: int = 0,
-    target_height: int = 0
+    target_height: int = 0,
+    checkpoint: Optional[segmented_encode.SegmentCheckpoint] = None,
+    scaler: str = scalers.DEFAULT_SCALER,
+    quality_floor: Optional[float] = None
 ) -> str:
     """
     Upscales a video using ffmpeg-python.
     Specify either scale_factor or target_width and target_height.
     If target_width and target_height are given, aspect ratio is preserved based on target_width.
+    scaler names a scalers.SCALERS entry, or "auto" for the fastest calibrated scaler
+    reaching quality_floor (an SSIM) at this scale factor (scalers.py).
+    With a checkpoint the video is encoded in resumable segments (segmented_encode.py).
     """
     if not os.path.exists(input_path):
         raise FileNotFoundError(f"Input video not found: {input_path}")
 
     try:
         original_width, original_height = get_video_dimensions(input_path)
+        effective_factor = scale_factor if scale_factor > 0 else target_width / original_width if target_width > 0 else 0
+        scaler_name = scalers.resolve_scaler(scaler, effective_factor, quality_floor)
+        print(f"Upscaling {effective_factor:g}x with scaler {scaler_name}")
 
         if scale_factor > 0:
-            vf_filter = f"scale=w=iw*{scale_factor}:h=ih*{scale_factor}:flags=lanczos"
+            vf_filter = scalers.scaler_filter(scaler_name, f"iw*{scale_factor}", f"ih*{scale_factor}")
         elif target_width > 0 and target_height > 0:
             # Calculate new height to maintain aspect ratio based on target_width
             # Or, if you want to fit within a box, you might need more complex logic
@@ -177,16 +645,21 @@ def upscale_video_py(
             # Let's make target_width the primary driver for "4K" type scaling
             # and ensure we don't upscale needlessly if original is already larger.
             if target_width >= original_width: # Only upscale
-                 vf_filter = f"scale=w={target_width}:h=-2:flags=lanczos" # -2 ensures height is divisible by 2 for codecs
+                 vf_filter = scalers.scaler_filter(scaler_name, target_width, -2) # -2 ensures height is divisible by 2 for codecs
             else: # If target is smaller, it's a downscale or no-op. For upscaling, this shouldn't be the primary path.
-                 vf_filter = f"scale=w={original_width}:h={original_height}:flags=lanczos" # No change or use original
+                 vf_filter = scalers.scaler_filter(scaler_name, original_width, original_height) # No change or use original
 
         else:
             raise ValueError("Either scale_factor or target_width must be specified.")
 
-        stream = ffmpeg.input(input_path)
-        stream = ffmpeg.output(stream, output_path, vf=vf_filter, preset='ultrafast', crf=23, vcodec='libx264')
-        ffmpeg.run(stream, overwrite_output=True, quiet=True)
+        # Only the video is scaled; audio and subtitles are copied whenever the container allows
+        plan = stream_planner.plan_streams(stream_planner.probe_streams(input_path), stream_planner.container_for(output_path), transform_video=True)
+        print(f"Upscale stream plan: {stream_planner.describe_plan(plan)}")
+        if checkpoint is not None:
+            segmented_encode.encode_planned(input_path, output_path, plan, checkpoint, video_filter=vf_filter, video_options={'preset': 'ultrafast', 'crf': 23})
+        else:
+            stream = stream_planner.planned_output(input_path, output_path, plan, video_filter=vf_filter, video_options={'preset': 'ultrafast', 'crf': 23})
+            ffmpeg.run(stream, overwrite_output=True, quiet=True)
 
         if not os.path.exists(output_path) or os.path.getsize(output_path) == 0:
             raise Exception("Output file not created or is empty after ffmpeg processing.")
@@ -221,13 +694,12 @@ def convert_video_py(input_path: str, output_path: str, target_format: str) -> s
     output_path_with_extension = f"{os.path.splitext(output_path)[0]}.{target_format.lower()}"
 
     try:
-        stream = ffmpeg.input(input_path)
-        # Use same preset and crf as upscale for now, can be parameterized later
-        # For some formats, specific codecs might be better/required.
-        # This basic conversion will let ffmpeg choose default codecs for the container.
-        # Example: .mov might default to h264, .webm to vp9 etc.
-        # If specific codecs are needed, this line needs to be more complex.
-        stream = ffmpeg.output(stream, output_path_with_extension, preset='ultrafast', crf=23)
+        # Streams the target container can already hold are copied, so a container-only
+        # change is a pure remux. The rest get the container's default encoder, using
+        # the same preset and crf as upscale for video.
+        plan = stream_planner.plan_streams(stream_planner.probe_streams(input_path), target_format.lower())
+        print(f"Convert stream plan ({'remux' if stream_planner.is_remux(plan) else 'encode'}): {stream_planner.describe_plan(plan)}")
+        stream = stream_planner.planned_output(input_path, output_path_with_extension, plan, video_options={'preset': 'ultrafast', 'crf': 23})
         ffmpeg.run(stream, overwrite_output=True, quiet=True)
 
         if not os.path.exists(output_path_with_extension) or os.path.getsize(output_path_with_extension) == 0:
@@ -249,14 +721,13 @@ def convert_video_py(input_path: str, output_path: str, target_format: str) -> s
 
 @app.post("/convert-video/")
 async def convert_video_endpoint(
-    video: UploadFile = File(...),
-    target_format: str = Form("mp4") # e.g., "mp4", "avi", "mov", "mkv"
+    video: Optional[UploadFile] = File(None),
+    asset_id: Optional[str] = Form(None),
+    target_format: str = Form("mp4"), # e.g., "mp4", "avi", "mov", "mkv"
+    preview: Optional[Dict[str, Any]] = Depends(preview_options)
 ):
-    if not video.content_type or not video.content_type.startswith("video/"):
-        raise HTTPException(status_code=400, detail="Invalid file type. Please upload a video.")
-
     file_id = str(uuid.uuid4())
-    original_filename = video.filename if video.filename else "video"
+    original_filename = input_filename(video, asset_id)
     # Keep original extension for input temp file
     input_file_extension = os.path.splitext(original_filename)[1] if original_filename and os.path.splitext(original_filename)[1] else ".tmp"
 
@@ -265,21 +736,21 @@ async def convert_video_endpoint(
     output_temp_base = os.path.join(PROCESSED_DIR, f"{file_id}_converted")
 
 
-    try:
-        with open(input_temp_path, "wb") as buffer:
-            shutil.copyfileobj(video.file, buffer)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Could not save uploaded video: {str(e)}")
-    finally:
-        video.file.close()
+    input_temp_path, input_is_temporary = await run_in_threadpool(stage_input, video, asset_id, input_temp_path)
 
     converted_file_path = ""
     try:
-        converted_file_path = convert_video_py(
-            input_path=input_temp_path,
+        process = partial(
+            convert_video_py,
             output_path=output_temp_base, # Base name, function adds extension
             target_format=target_format.lower()
         )
+        if preview:
+            window = await run_in_threadpool(resolve_preview_window, input_temp_path, preview["start"], preview["seconds"])
+            # A conversion copies every stream the target container can hold, video included
+            converted_file_path = await worker_pool.run_in_process(preview_py, process, input_temp_path, window, preview["compare"], False)
+        else:
+            converted_file_path = await worker_pool.run_in_process(process, input_temp_path)
 
         # Determine media type based on target format for the response
         media_type_map = {
@@ -294,7 +765,9 @@ async def convert_video_endpoint(
 
         download_filename = f"{os.path.splitext(original_filename)[0]}_converted.{target_format.lower()}"
 
-        return FileResponse(
+        if preview:
+            return preview_file_response(converted_file_path, download_filename, window)
+        return output_file_response(
             path=converted_file_path,
             media_type=response_media_type,
             filename=download_filename
@@ -309,8 +782,8 @@ async def convert_video_endpoint(
              os.remove(converted_file_path)
         raise HTTPException(status_code=500, detail=f"Error during video conversion: {str(e)}")
     finally:
-        if os.path.exists(input_temp_path):
-            os.remove(input_temp_path)
+        if input_is_temporary:
+            remove_temporary_input(input_temp_path)
         # As with upscaling, processed file cleanup is not yet implemented with BackgroundTask
 
 def compress_video_py(input_path: str, output_path: str, quality_preset: str) -> str:
@@ -361,16 +834,96 @@ def compress_video_py(input_path: str, output_path: str, quality_preset: str) ->
         raise Exception(f"General error during video compression (preset: {quality_preset}): {str(e)}")
 
 
+def compress_to_target_py(
+    input_path: str,
+    output_path: str,
+    target_size_mb: Optional[float] = None,
+    target_ssim: Optional[float] = None,
+    window: Optional[tuple[float, float]] = None
+) -> tuple[str, Dict[str, Any]]:
+    """
+    Compresses a video with libx264 to a target file size (MB) or a target SSIM.
+    The CRF is picked from parallel sample encodes (see crf_search.py) and the video is
+    encoded once at that CRF; audio is copied when MP4 can hold it.
+    With window=(start, seconds) only that part is encoded, at the CRF chosen for the whole video.
+    Returns the output path and the search result (chosen CRF and predictions).
+    """
+    if not os.path.exists(input_path):
+        raise FileNotFoundError(f"Input video not found: {input_path}")
+    if (target_size_mb is None) == (target_ssim is None):
+        raise ValueError("Specify exactly one of target_size_mb or target_ssim.")
+    if target_size_mb is not None and target_size_mb <= 0:
+        raise ValueError("target_size_mb must be positive.")
+    if target_ssim is not None and not 0 < target_ssim < 1:
+        raise ValueError("target_ssim must be between 0 and 1.")
+
+    output_path_with_extension = f"{os.path.splitext(output_path)[0]}.mp4"
+
+    try:
+        try:
+            probe = ffmpeg.probe(input_path)
+        except ffmpeg.Error as e:
+            raise ValueError(f"Error probing video file: {e.stderr.decode('utf8') if e.stderr else 'Unknown ffmpeg error'}")
+        duration = float(probe.get('format', {}).get('duration') or 0)
+        if duration <= 0:
+            raise ValueError("Could not determine the video duration.")
+
+        plan = stream_planner.plan_streams(probe['streams'], "mp4", transform_video=True)
+        streams_by_index = {s['index']: s for s in probe['streams']}
+        audio_bitrate = sum(
+            int(streams_by_index[e['index']].get('bit_rate') or crf_search.DEFAULT_AUDIO_BITRATE) if e['action'] == 'copy' else crf_search.DEFAULT_AUDIO_BITRATE
+            for e in plan if e['codec_type'] == 'audio' and e['action'] != 'drop'
+        )
+
+        search = crf_search.search_crf(
+            input_path,
+            duration,
+            target_size_bytes=int(target_size_mb * 1024 * 1024) if target_size_mb is not None else None,
+            target_ssim=target_ssim,
+            audio_bitrate=audio_bitrate
+        )
+        print(f"Target compression picked CRF {search['crf']} from sample encodes: {search['probe_points']}")
+
+        stream = stream_planner.planned_output(
+            input_path,
+            output_path_with_extension,
+            plan,
+            video_options={'crf': search['crf'], 'preset': crf_search.SEARCH_PRESET}, # Same preset as the samples
+            input_options={'ss': window[0]} if window else None,
+            **({'t': window[1]} if window else {})
+        )
+        ffmpeg.run(stream, overwrite_output=True, quiet=True)
+
+        if not os.path.exists(output_path_with_extension) or os.path.getsize(output_path_with_extension) == 0:
+            raise Exception("Output file not created or is empty after target compression.")
+        search['size_bytes'] = os.path.getsize(output_path_with_extension)
+        return output_path_with_extension, search
+    except ValueError:
+        raise
+    except ffmpeg.Error as e:
+        error_message = e.stderr.decode('utf8') if e.stderr else "Unknown ffmpeg error during target compression"
+        print(f"ffmpeg.Error during target compression: {error_message}")
+        if os.path.exists(output_path_with_extension) and os.path.getsize(output_path_with_extension) == 0:
+            os.remove(output_path_with_extension)
+        raise Exception(f"FFmpeg error during target compression: {error_message}")
+    except Exception as e:
+        print(f"Error during target compression: {str(e)}")
+        if os.path.exists(output_path_with_extension):
+             os.remove(output_path_with_extension)
+        raise Exception(f"General error during target compression: {str(e)}")
+
+
 @app.post("/compress-video/")
 async def compress_video_endpoint(
-    video: UploadFile = File(...),
-    quality_preset: str = Form("medium") # e.g., "high", "medium", "low"
+    video: Optional[UploadFile] = File(None),
+    asset_id: Optional[str] = Form(None),
+    quality_preset: str = Form("medium"), # e.g., "high", "medium", "low"
+    target_size_mb: Optional[float] = Form(None), # Overrides quality_preset: aim for this output size
+    target_ssim: Optional[float] = Form(None), # Overrides quality_preset: aim for this SSIM (0-1)
+    preview: Optional[Dict[str, Any]] = Depends(preview_options)
 ):
-    if not video.content_type or not video.content_type.startswith("video/"):
-        raise HTTPException(status_code=400, detail="Invalid file type. Please upload a video.")
-
     file_id = str(uuid.uuid4())
-    original_filename = video.filename if video.filename else "video"
+    original_filename = input_filename(video, asset_id)
     # Keep original extension for input temp file, though compression output will be mp4
     input_file_extension = os.path.splitext(original_filename)[1] if original_filename and os.path.splitext(original_filename)[1] else ".tmp"
 
@@ -378,32 +931,56 @@ async def compress_video_endpoint(
     # Output path base, function adds .mp4 extension
     output_temp_base = os.path.join(PROCESSED_DIR, f"{file_id}_compressed_{quality_preset}")
 
-    try:
-        with open(input_temp_path, "wb") as buffer:
-            shutil.copyfileobj(video.file, buffer)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Could not save uploaded video: {str(e)}")
-    finally:
-        video.file.close()
+    input_temp_path, input_is_temporary = await run_in_threadpool(stage_input, video, asset_id, input_temp_path)
 
     compressed_file_path = ""
     try:
-        compressed_file_path = compress_video_py(
-            input_path=input_temp_path,
-            output_path=output_temp_base,
-            quality_preset=quality_preset.lower()
-        )
+        search = None
+        window = await run_in_threadpool(resolve_preview_window, input_temp_path, preview["start"], preview["seconds"]) if preview else None
+        if target_size_mb is not None or target_ssim is not None:
+            # The CRF is searched on the whole video; a preview only encodes the window with it
+            compressed_file_path, search = await worker_pool.run_in_process(
+                compress_to_target_py,
+                input_path=input_temp_path,
+                output_path=output_temp_base,
+                target_size_mb=target_size_mb,
+                target_ssim=target_ssim,
+                window=window
+            )
+            if preview and preview["compare"]:
+                compressed_file_path = await worker_pool.run_in_process(compare_preview_py, input_temp_path, window, compressed_file_path)
+            label = f"{target_size_mb}MB" if target_size_mb is not None else f"ssim{target_ssim}"
+        else:
+            process = partial(
+                compress_video_py,
+                output_path=output_temp_base,
+                quality_preset=quality_preset.lower()
+            )
+            if preview:
+                compressed_file_path = await worker_pool.run_in_process(preview_py, process, input_temp_path, window, preview["compare"])
+            else:
+                compressed_file_path = await worker_pool.run_in_process(process, input_temp_path)
+            label = quality_preset
 
         # Output is always MP4 for this compression function
         response_media_type = "video/mp4"
         original_name_no_ext = os.path.splitext(original_filename)[0]
-        download_filename = f"{original_name_no_ext}_compressed_{quality_preset}.mp4"
+        download_filename = f"{original_name_no_ext}_compressed_{label}.mp4"
 
-        return FileResponse(
-            path=compressed_file_path,
-            media_type=response_media_type,
-            filename=download_filename
-        )
+        if preview:
+            response = preview_file_response(compressed_file_path, download_filename, window)
+        else:
+            response = output_file_response(
+                path=compressed_file_path,
+                media_type=response_media_type,
+                filename=download_filename
+            )
+        if search:
+            response.headers["X-Compression-CRF"] = str(search["crf"])
+            response.headers["X-Predicted-Size"] = str(search["predicted_size_bytes"])
+            if "predicted_ssim" in search:
+                response.headers["X-Predicted-SSIM"] = str(search["predicted_ssim"])
+        return response
     except FileNotFoundError as e:
         raise HTTPException(status_code=404, detail=str(e))
     except ValueError as e: # For issues like invalid preset
@@ -414,11 +991,19 @@ async def compress_video_endpoint(
              os.remove(compressed_file_path)
         raise HTTPException(status_code=500, detail=f"Error during video compression: {str(e)}")
     finally:
-        if os.path.exists(input_temp_path):
-            os.remove(input_temp_path)
+        if input_is_temporary:
+            remove_temporary_input(input_temp_path)
 
 
-def crop_video_py(input_path: str, output_path: str, crop_x: int, crop_y: int, crop_width: int, crop_height: int) -> str:
+def crop_video_py(
+    input_path: str,
+    output_path: str,
+    crop_x: int,
+    crop_y: int,
+    crop_width: int,
+    crop_height: int,
+    checkpoint: Optional[segmented_encode.SegmentCheckpoint] = None
+) -> str:
     """Crops a video using ffmpeg-python."""
     if not os.path.exists(input_path):
         raise FileNotFoundError(f"Input video not found: {input_path}")
@@ -440,17 +1025,16 @@ def crop_video_py(input_path: str, output_path: str, crop_x: int, crop_y: int, c
                 f"exceed original video dimensions ({original_width}x{original_height})."
             )
 
-        stream = ffmpeg.input(input_path)
-        # Use same preset and crf as compression for now, can be parameterized
-        stream = ffmpeg.output(
-            stream,
-            output_path_with_extension,
-            vf=f'crop={crop_width}:{crop_height}:{crop_x}:{crop_y}',
-            vcodec='libx264',
-            crf=23, # Medium quality
-            preset='medium'
-        )
-        ffmpeg.run(stream, overwrite_output=True, quiet=True)
+        # Only the video is cropped; audio and subtitles are copied whenever MP4 allows
+        plan = stream_planner.plan_streams(stream_planner.probe_streams(input_path), "mp4", transform_video=True)
+        print(f"Crop stream plan: {stream_planner.describe_plan(plan)}")
+        video_filter = f'crop={crop_width}:{crop_height}:{crop_x}:{crop_y}'
+        video_options = {'crf': 23, 'preset': 'medium'} # Medium quality, same as compression for now
+        if checkpoint is not None:
+            segmented_encode.encode_planned(input_path, output_path_with_extension, plan, checkpoint, video_filter=video_filter, video_options=video_options)
+        else:
+            stream = stream_planner.planned_output(input_path, output_path_with_extension, plan, video_filter=video_filter, video_options=video_options)
+            ffmpeg.run(stream, overwrite_output=True, quiet=True)
 
         if not os.path.exists(output_path_with_extension) or os.path.getsize(output_path_with_extension) == 0:
             raise Exception("Output file not created or is empty after ffmpeg cropping.")
@@ -469,46 +1053,46 @@ def crop_video_py(input_path: str, output_path: str, crop_x: int, crop_y: int, c
 
 @app.post("/crop-video/")
 async def crop_video_endpoint(
-    video: UploadFile = File(...),
+    video: Optional[UploadFile] = File(None),
+    asset_id: Optional[str] = Form(None),
     crop_x: int = Form(...),
     crop_y: int = Form(...),
     crop_width: int = Form(...),
-    crop_height: int = Form(...)
+    crop_height: int = Form(...),
+    preview: Optional[Dict[str, Any]] = Depends(preview_options)
 ):
-    if not video.content_type or not video.content_type.startswith("video/"):
-        raise HTTPException(status_code=400, detail="Invalid file type. Please upload a video.")
-
     file_id = str(uuid.uuid4())
-    original_filename = video.filename if video.filename else "video"
+    original_filename = input_filename(video, asset_id)
     input_file_extension = os.path.splitext(original_filename)[1] if original_filename and os.path.splitext(original_filename)[1] else ".tmp"
 
     input_temp_path = os.path.join(UPLOAD_DIR, f"{file_id}_input{input_file_extension}")
     output_temp_base = os.path.join(PROCESSED_DIR, f"{file_id}_cropped")
 
-    try:
-        with open(input_temp_path, "wb") as buffer:
-            shutil.copyfileobj(video.file, buffer)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Could not save uploaded video: {str(e)}")
-    finally:
-        video.file.close()
+    input_temp_path, input_is_temporary = await run_in_threadpool(stage_input, video, asset_id, input_temp_path)
 
     cropped_file_path = ""
     try:
-        cropped_file_path = crop_video_py(
-            input_path=input_temp_path,
+        process = partial(
+            crop_video_py,
             output_path=output_temp_base,
             crop_x=crop_x,
             crop_y=crop_y,
             crop_width=crop_width,
             crop_height=crop_height
         )
+        if preview:
+            window = await run_in_threadpool(resolve_preview_window, input_temp_path, preview["start"], preview["seconds"])
+            cropped_file_path = await worker_pool.run_in_process(preview_py, process, input_temp_path, window, preview["compare"])
+        else:
+            cropped_file_path = await worker_pool.run_in_process(process, input_temp_path)
 
         response_media_type = "video/mp4" # Output is MP4
         original_name_no_ext = os.path.splitext(original_filename)[0]
         download_filename = f"{original_name_no_ext}_cropped_{crop_width}x{crop_height}.mp4"
 
-        return FileResponse(
+        if preview:
+            return preview_file_response(cropped_file_path, download_filename, window)
+        return output_file_response(
             path=cropped_file_path,
             media_type=response_media_type,
             filename=download_filename
@@ -523,46 +1107,56 @@ async def crop_video_endpoint(
              os.remove(cropped_file_path)
         raise HTTPException(status_code=500, detail=f"Error during video cropping: {str(e)}")
     finally:
-        if os.path.exists(input_temp_path):
-            os.remove(input_temp_path)
+        if input_is_temporary:
+            remove_temporary_input(input_temp_path)
 
 
-def trim_video_py(input_path: str, output_path: str, start_time: str, end_time: str) -> str:
-    """Trims a video using ffmpeg-python from start_time to end_time."""
+def trim_video_py(input_path: str, output_path: str, start_time: str, end_time: str, keyframe_index: Optional[media_index.MediaIndex] = None) -> str:
+    """
+    Trims a video using ffmpeg-python from start_time to end_time.
+    When a keyframe index shows the cut starts on a keyframe and MP4 can hold every
+    stream, packets are copied instead of re-encoded.
+    """
     if not os.path.exists(input_path):
         raise FileNotFoundError(f"Input video not found: {input_path}")
 
-    # Basic validation for time format can be added here if needed, e.g., regex for HH:MM:SS or seconds.
-    # FFmpeg is quite flexible with time formats.
+    start_seconds = media_index.parse_timestamp(start_time)
+    end_seconds = media_index.parse_timestamp(end_time)
+    if end_seconds <= start_seconds:
+        raise ValueError("End time must be after start time.")
 
     # Output will be MP4 by default
     output_path_with_extension = f"{os.path.splitext(output_path)[0]}.mp4"
 
     try:
-        # Probe video to get duration for more robust validation if desired,
-        # e.g., to check if start_time < end_time and end_time <= duration.
-        # For now, relying on ffmpeg to handle invalid time inputs.
-        # probe = ffmpeg.probe(input_path)
-        # duration = float(probe['format']['duration'])
-
-        stream = ffmpeg.input(input_path, ss=start_time) # Input seeking (ss before -i)
-        # If end_time is provided, use it with -to option for ffmpeg.output
-        # Otherwise, if only start_time is given, it will go to the end of the video.
-        # For trimming, typically both start and end are desired.
-        # The -to option specifies an absolute end time.
-        # Alternatively, -t duration can be used if end_time is duration from start_time.
-        stream = ffmpeg.output(
-            stream,
-            output_path_with_extension,
-            to=end_time, # Output seeking (to relative to start of output)
-            vcodec='libx264', # Re-encode to ensure consistency
-            acodec='aac',     # Re-encode audio
-            crf=23,
-            preset='medium'
-            # Using -c copy (vcodec='copy', acodec='copy') would be faster if no re-encoding is needed,
-            # but might be less reliable across formats or if precise cutting on non-keyframes is an issue.
-            # Re-encoding provides more robustness here.
-        )
+        copy_plan = None
+        if keyframe_index is not None and keyframe_index.is_keyframe(start_seconds):
+            copy_plan = stream_planner.plan_streams(stream_planner.probe_streams(input_path), "mp4")
+            if not stream_planner.is_remux(copy_plan):
+                copy_plan = None
+
+        if copy_plan:
+            # Seeking to a keyframe is exact, so the cut needs no decoding at all
+            stream = stream_planner.planned_output(
+                input_path,
+                output_path_with_extension,
+                copy_plan,
+                input_options={'ss': start_seconds},
+                t=end_seconds - start_seconds
+            )
+        else:
+            stream = ffmpeg.input(input_path, ss=start_seconds) # Input seeking (ss before -i)
+            # Input seeking resets timestamps to zero, so the cut length is given with -t;
+            # an output -to would be measured from the new zero and act as a duration.
+            stream = ffmpeg.output(
+                stream,
+                output_path_with_extension,
+                t=end_seconds - start_seconds,
+                vcodec='libx264', # Re-encode: the cut does not start on a keyframe
+                acodec='aac',     # Re-encode audio
+                crf=23,
+                preset='medium'
+            )
         ffmpeg.run(stream, overwrite_output=True, quiet=True)
 
         if not os.path.exists(output_path_with_extension) or os.path.getsize(output_path_with_extension) == 0:
@@ -582,42 +1176,36 @@ def trim_video_py(input_path: str, output_path: str, start_time: str, end_time:
 
 @app.post("/trim-video/")
 async def trim_video_endpoint(
-    video: UploadFile = File(...),
+    video: Optional[UploadFile] = File(None),
+    asset_id: Optional[str] = Form(None),
     start_time: str = Form(...), # Expecting format like "HH:MM:SS" or seconds
     end_time: str = Form(...)    # Expecting format like "HH:MM:SS" or seconds
 ):
-    if not video.content_type or not video.content_type.startswith("video/"):
-        raise HTTPException(status_code=400, detail="Invalid file type. Please upload a video.")
-
     file_id = str(uuid.uuid4())
-    original_filename = video.filename if video.filename else "video"
+    original_filename = input_filename(video, asset_id)
     input_file_extension = os.path.splitext(original_filename)[1] if original_filename and os.path.splitext(original_filename)[1] else ".tmp"
 
     input_temp_path = os.path.join(UPLOAD_DIR, f"{file_id}_input{input_file_extension}")
     output_temp_base = os.path.join(PROCESSED_DIR, f"{file_id}_trimmed")
 
-    try:
-        with open(input_temp_path, "wb") as buffer:
-            shutil.copyfileobj(video.file, buffer)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Could not save uploaded video: {str(e)}")
-    finally:
-        video.file.close()
+    input_temp_path, input_is_temporary = await run_in_threadpool(stage_input, video, asset_id, input_temp_path)
 
     trimmed_file_path = ""
     try:
-        trimmed_file_path = trim_video_py(
+        trimmed_file_path = await worker_pool.run_in_process(
+            trim_video_py,
             input_path=input_temp_path,
             output_path=output_temp_base,
             start_time=start_time,
-            end_time=end_time
+            end_time=end_time,
+            keyframe_index=await run_in_threadpool(asset_media_index, asset_id) if asset_id else None
         )
 
         response_media_type = "video/mp4" # Output is MP4
         original_name_no_ext = os.path.splitext(original_filename)[0]
         download_filename = f"{original_name_no_ext}_trimmed_{start_time.replace(':', '-')}_to_{end_time.replace(':', '-')}.mp4"
 
-        return FileResponse(
+        return output_file_response(
             path=trimmed_file_path,
             media_type=response_media_type,
             filename=download_filename
@@ -632,12 +1220,17 @@ async def trim_video_endpoint(
              os.remove(trimmed_file_path)
         raise HTTPException(status_code=500, detail=f"Error during video trimming: {str(e)}")
     finally:
-        if os.path.exists(input_temp_path):
-            os.remove(input_temp_path)
+        if input_is_temporary:
+            remove_temporary_input(input_temp_path)
 
 
-def extract_frame_py(input_path: str, output_path_base: str, timestamp: str, output_format: str = "jpg") -> str:
-    """Extracts a single frame from a video at a given timestamp."""
+def extract_frame_py(input_path: str, output_path_base: str, timestamp: str, output_format: str = "jpg", keyframe_index: Optional[media_index.MediaIndex] = None) -> str:
+    """
+    Extracts a single frame from a video at a given timestamp.
+    With PyAV the frame is decoded in-process from a pooled, already open container;
+    otherwise (or if that fails) ffmpeg is run. When a keyframe index shows the
+    timestamp is a keyframe, ffmpeg only decodes keyframes.
+    """
     if not os.path.exists(input_path):
         raise FileNotFoundError(f"Input video not found: {input_path}")
 
@@ -647,10 +1240,21 @@ def extract_frame_py(input_path: str, output_path_base: str, timestamp: str, out
 
     output_filename = f"{output_path_base}.{output_format.lower()}"
 
+    if decode_pool.available():
+        try:
+            return decode_pool.extract_frame(input_path, media_index.parse_timestamp(timestamp), output_filename, output_format)
+        except decode_pool.DecodeError as e:
+            print(f"In-process frame extraction failed, using ffmpeg: {str(e)}")
+
+    input_options = {'ss': timestamp}
+    if keyframe_index is not None and keyframe_index.is_keyframe(media_index.parse_timestamp(timestamp)):
+        # The seek lands exactly on the frame, so nothing after it needs decoding
+        input_options['skip_frame'] = 'nokey'
+
     try:
         (
             ffmpeg
-            .input(input_path, ss=timestamp)
+            .input(input_path, **input_options)
             .output(output_filename, vframes=1, format='image2', vcodec=f'mjpeg' if output_format.lower() in ['jpg', 'jpeg'] else 'png')
             .run(overwrite_output=True, quiet=True)
         )
@@ -672,36 +1276,35 @@ def extract_frame_py(input_path: str, output_path_base: str, timestamp: str, out
 
 @app.post("/extract-frame/")
 async def extract_frame_endpoint(
-    video: UploadFile = File(...),
+    video: Optional[UploadFile] = File(None),
+    asset_id: Optional[str] = Form(None),
     timestamp: str = Form(...), # Expecting format like "HH:MM:SS" or seconds
-    image_format: str = Form("jpg") # "jpg" or "png"
+    image_format: str = Form("jpg"), # "jpg" or "png"
+    preview: bool = Form(False) # For asset_id inputs, decode the low-resolution proxy once it is ready
 ):
-    if not video.content_type or not video.content_type.startswith("video/"):
-        raise HTTPException(status_code=400, detail="Invalid file type. Please upload a video.")
-
     file_id = str(uuid.uuid4())
-    original_filename = video.filename if video.filename else "video"
+    original_filename = input_filename(video, asset_id)
     input_file_extension = os.path.splitext(original_filename)[1] if original_filename and os.path.splitext(original_filename)[1] else ".tmp"
 
     input_temp_path = os.path.join(UPLOAD_DIR, f"{file_id}_input{input_file_extension}")
     # Base name for the output, function will add extension
     output_temp_base = os.path.join(PROCESSED_DIR, f"{file_id}_frame_at_{timestamp.replace(':', '-')}")
 
-    try:
-        with open(input_temp_path, "wb") as buffer:
-            shutil.copyfileobj(video.file, buffer)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Could not save uploaded video: {str(e)}")
-    finally:
-        video.file.close()
+    input_temp_path, input_is_temporary = await run_in_threadpool(stage_input, video, asset_id, input_temp_path)
+    use_proxy = False
+    if preview and asset_id:
+        input_temp_path, use_proxy = asset_proxy.preview_input(asset_id)
 
     extracted_frame_path = ""
     try:
-        extracted_frame_path = extract_frame_py(
+        extracted_frame_path = await run_in_threadpool(
+            extract_frame_py,
             input_path=input_temp_path,
             output_path_base=output_temp_base,
             timestamp=timestamp,
-            output_format=image_format
+            output_format=image_format,
+            # The index describes the original; the proxy's short GOP makes exact seeks cheap anyway
+            keyframe_index=await run_in_threadpool(asset_media_index, asset_id) if asset_id and not use_proxy else None
         )
 
         media_type_map = {"jpg": "image/jpeg", "jpeg": "image/jpeg", "png": "image/png"}
@@ -710,11 +1313,14 @@ async def extract_frame_endpoint(
         original_name_no_ext = os.path.splitext(original_filename)[0]
         download_filename = f"{original_name_no_ext}_frame_at_{timestamp.replace(':', '-')}.{image_format.lower()}"
 
-        return FileResponse(
+        response = output_file_response(
             path=extracted_frame_path,
             media_type=response_media_type,
             filename=download_filename
         )
+        if preview and asset_id:
+            response.headers["X-Preview-Source"] = "proxy" if use_proxy else "original"
+        return response
     except FileNotFoundError as e:
         raise HTTPException(status_code=404, detail=str(e))
     except ValueError as e: # For issues like invalid timestamp or format
@@ -725,30 +1331,30 @@ async def extract_frame_endpoint(
              os.remove(extracted_frame_path)
         raise HTTPException(status_code=500, detail=f"Error during frame extraction: {str(e)}")
     finally:
-        if os.path.exists(input_temp_path):
-            os.remove(input_temp_path)
+        if input_is_temporary:
+            remove_temporary_input(input_temp_path)
 
 
-@app.post("/get-metadata/") # Changed to POST to accept file upload easily
-async def get_metadata_endpoint(video: UploadFile = File(...)):
-    if not video.content_type or not video.content_type.startswith("video/"):
-        raise HTTPException(status_code=400, detail="Invalid file type. Please upload a video.")
+def probe_video_py(input_path: str) -> Dict[str, Any]:
+    """ffprobe JSON of a video; with PyAV it has the same shape and is read from a pooled open container."""
+    if decode_pool.available():
+        try:
+            return decode_pool.probe(input_path)
+        except decode_pool.DecodeError as e:
+            print(f"In-process probe failed, using ffprobe: {str(e)}")
+    return ffmpeg.probe(input_path)
 
+@app.post("/get-metadata/") # Changed to POST to accept file upload easily
+async def get_metadata_endpoint(video: Optional[UploadFile] = File(None), asset_id: Optional[str] = Form(None)):
     file_id = str(uuid.uuid4())
-    original_filename = video.filename if video.filename else "video"
+    original_filename = input_filename(video, asset_id)
     input_file_extension = os.path.splitext(original_filename)[1] if original_filename and os.path.splitext(original_filename)[1] else ".tmp"
     input_temp_path = os.path.join(UPLOAD_DIR, f"{file_id}_metadata_input{input_file_extension}")
 
-    try:
-        with open(input_temp_path, "wb") as buffer:
-            shutil.copyfileobj(video.file, buffer)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Could not save uploaded video: {str(e)}")
-    finally:
-        video.file.close()
+    input_temp_path, input_is_temporary = await run_in_threadpool(stage_input, video, asset_id, input_temp_path)
 
     try:
-        probe = ffmpeg.probe(input_temp_path)
+        probe = await run_in_threadpool(probe_video_py, input_temp_path)
         # Return the whole probe for now, frontend can parse what it needs.
         # Or, select specific fields to return.
         # Example of selecting specific fields:
@@ -780,10 +1386,9 @@ async def get_metadata_endpoint(video: UploadFile = File(...)):
         print(f"Error getting video metadata: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Could not get video metadata: {str(e)}")
     finally:
-        if os.path.exists(input_temp_path):
-            os.remove(input_temp_path)
+        if input_is_temporary:
+            remove_temporary_input(input_temp_path)
 
-import re # For parsing ffmpeg output
 
 # ... (keep existing imports and code) ...
 
@@ -883,42 +1488,35 @@ def analyze_video_quality_py(original_path: str, processed_path: str, metric_typ
 
 @app.post("/analyze-quality/")
 async def analyze_quality_endpoint(
-    original_video: UploadFile = File(...),
-    processed_video: UploadFile = File(...),
-    metric_type: str = Form(...) # "psnr" or "ssim"
+    original_video: Optional[UploadFile] = File(None),
+    processed_video: Optional[UploadFile] = File(None),
+    metric_type: str = Form(...), # "psnr" or "ssim"
+    original_asset_id: Optional[str] = Form(None),
+    processed_asset_id: Optional[str] = Form(None)
 ):
-    if not original_video.content_type or not original_video.content_type.startswith("video/") or \
-       not processed_video.content_type or not processed_video.content_type.startswith("video/"):
-        raise HTTPException(status_code=400, detail="Invalid file type. Both files must be videos.")
+    original_filename = input_filename(original_video, original_asset_id)
+    processed_filename = input_filename(processed_video, processed_asset_id)
 
     # Save original video
     original_file_id = str(uuid.uuid4())
-    original_ext = os.path.splitext(original_video.filename if original_video.filename else ".tmp")[1]
+    original_ext = os.path.splitext(original_filename)[1] or ".tmp"
     original_temp_path = os.path.join(UPLOAD_DIR, f"{original_file_id}_original{original_ext}")
-    try:
-        with open(original_temp_path, "wb") as buffer:
-            shutil.copyfileobj(original_video.file, buffer)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Could not save original video: {e}")
-    finally:
-        original_video.file.close()
+    original_temp_path, original_is_temporary = await run_in_threadpool(stage_input, original_video, original_asset_id, original_temp_path)
 
     # Save processed video
     processed_file_id = str(uuid.uuid4())
-    processed_ext = os.path.splitext(processed_video.filename if processed_video.filename else ".tmp")[1]
+    processed_ext = os.path.splitext(processed_filename)[1] or ".tmp"
     processed_temp_path = os.path.join(UPLOAD_DIR, f"{processed_file_id}_processed{processed_ext}")
     try:
-        with open(processed_temp_path, "wb") as buffer:
-            shutil.copyfileobj(processed_video.file, buffer)
-    except Exception as e:
+        processed_temp_path, processed_is_temporary = await run_in_threadpool(stage_input, processed_video, processed_asset_id, processed_temp_path)
+    except HTTPException:
         # Clean up original if processed fails to save
-        if os.path.exists(original_temp_path): os.remove(original_temp_path)
-        raise HTTPException(status_code=500, detail=f"Could not save processed video: {e}")
-    finally:
-        processed_video.file.close()
+        if original_is_temporary and os.path.exists(original_temp_path): os.remove(original_temp_path)
+        raise
 
     try:
-        result = analyze_video_quality_py(
+        result = await worker_pool.run_in_process(
+            analyze_video_quality_py,
             original_path=original_temp_path,
             processed_path=processed_temp_path,
             metric_type=metric_type
@@ -933,23 +1531,22 @@ async def analyze_quality_endpoint(
         raise HTTPException(status_code=500, detail=f"Error during quality analysis: {str(e)}")
     finally:
         # Cleanup
-        if os.path.exists(original_temp_path):
+        if original_is_temporary and os.path.exists(original_temp_path):
             os.remove(original_temp_path)
-        if os.path.exists(processed_temp_path):
+        if processed_is_temporary and os.path.exists(processed_temp_path):
             os.remove(processed_temp_path)
 
-import subprocess # For running external processes like Real-ESRGAN
-from pathlib import Path # For easier path manipulation
-import re # For parsing ffmpeg output
-import cv2 # OpenCV for object detection
-from typing import List, Dict, Any # Ensure List is imported
-
 # Pydantic model for receiving metadata tags, though we'll use Form with JSON string for simplicity with file uploads.
 # class MetadataEditRequest(BaseModel):
 #     tags: Dict[str, Any]
 
-def edit_metadata_py(input_path: str, output_path: str, metadata_tags: Dict[str, Any]) -> str:
-    """Edits metadata tags of a video using ffmpeg-python and copies codecs."""
+def edit_metadata_py(input_path: str, output_path: str, metadata_tags: Dict[str, Any], consume_input: bool = False) -> str:
+    """
+    Edits metadata tags of a video. MP4/MOV and Matroska files are tagged in place by
+    rewriting only their header; other files, or layouts the native editor cannot
+    handle, are remuxed with ffmpeg-python using codec copy.
+    With consume_input the input file is moved to the output instead of copied.
+    """
     if not os.path.exists(input_path):
         raise FileNotFoundError(f"Input video not found: {input_path}")
 
@@ -963,6 +1560,23 @@ def edit_metadata_py(input_path: str, output_path: str, metadata_tags: Dict[str,
     # Filter out any None values from tags, as ffmpeg might not like them
     clean_metadata_tags = {k: str(v) for k, v in metadata_tags.items() if v is not None and v != ''} # Ensure values are strings
 
+    if clean_metadata_tags and metadata_editor.supports_in_place_edit(output_path_with_extension):
+        # Never edit the input itself: it may be a stored asset shared by other requests
+        if consume_input:
+            shutil.move(input_path, output_path_with_extension)
+        else:
+            shutil.copyfile(input_path, output_path_with_extension)
+        try:
+            metadata_editor.edit_metadata_in_place(output_path_with_extension, clean_metadata_tags)
+            return output_path_with_extension
+        except metadata_editor.UnsupportedLayout as e:
+            # Nothing was written, so the file is still the untouched input
+            print(f"In-place metadata edit not possible, remuxing with ffmpeg: {str(e)}")
+            if consume_input:
+                shutil.move(output_path_with_extension, input_path)
+            else:
+                os.remove(output_path_with_extension)
+
     try:
         stream = ffmpeg.input(input_path)
 
@@ -970,7 +1584,6 @@ def edit_metadata_py(input_path: str, output_path: str, metadata_tags: Dict[str,
             'map_metadata': '0', # Preserve existing metadata from input stream 0
             'map': '0',          # Map all streams from input 0
             'codec': 'copy',     # Copy all codecs
-            'metadata': clean_metadata_tags # Apply new/updated global metadata tags
         }
 
         # Add movflags if it's an mp4 or mov, as it helps with global tags like title, artist.
@@ -982,11 +1595,16 @@ def edit_metadata_py(input_path: str, output_path: str, metadata_tags: Dict[str,
         # This is more complex; for now, we rely on overwriting.
         # Example: if metadata_tags['title'] == '', ffmpeg might not clear the title.
         # To explicitly clear, one would use `-metadata title=`.
-        # The `metadata` kwarg in ffmpeg-python should handle overwriting. If a key is present with a value, it's set.
-        # If a key from clean_metadata_tags has an empty string, ffmpeg should set it to empty.
+        # ffmpeg-python cannot repeat an option, so one `-metadata key=value` pair per tag is
+        # inserted ahead of the output path. Present keys overwrite the preserved input tags.
 
         stream = ffmpeg.output(stream, output_path_with_extension, **output_options)
-        ffmpeg.run(stream, overwrite_output=True, quiet=True)
+        cmd = ffmpeg.compile(stream)
+        metadata_args = [arg for key, value in clean_metadata_tags.items() for arg in ('-metadata', f"{key}={value}")]
+        cmd = cmd[:1] + ['-y'] + cmd[1:-1] + metadata_args + cmd[-1:]
+        result = subprocess.run(cmd, capture_output=True)
+        if result.returncode != 0:
+            raise ffmpeg.Error('ffmpeg', result.stdout, result.stderr)
 
         if not os.path.exists(output_path_with_extension) or os.path.getsize(output_path_with_extension) == 0:
             raise Exception("Output file not created or is empty after metadata edit.")
@@ -1005,12 +1623,10 @@ def edit_metadata_py(input_path: str, output_path: str, metadata_tags: Dict[str,
 
 @app.post("/edit-metadata/")
 async def edit_metadata_endpoint(
-    video: UploadFile = File(...),
+    video: Optional[UploadFile] = File(None),
+    asset_id: Optional[str] = Form(None),
     tags_json: str = Form(...) # JSON string of tags: '{"title": "New Title", "artist": "Me"}'
 ):
-    if not video.content_type or not video.content_type.startswith("video/"):
-        raise HTTPException(status_code=400, detail="Invalid file type. Please upload a video.")
-
     import json
     try:
         metadata_to_edit = json.loads(tags_json)
@@ -1023,26 +1639,22 @@ async def edit_metadata_endpoint(
 
 
     file_id = str(uuid.uuid4())
-    original_filename = video.filename if video.filename else "video"
+    original_filename = input_filename(video, asset_id)
     input_file_extension = os.path.splitext(original_filename)[1] if original_filename and os.path.splitext(original_filename)[1] else ".mp4"
 
     input_temp_path = os.path.join(UPLOAD_DIR, f"{file_id}_metaedit_input{input_file_extension}")
     output_temp_base = os.path.join(PROCESSED_DIR, f"{file_id}_metaedit_output") # Extension added by function
 
-    try:
-        with open(input_temp_path, "wb") as buffer:
-            shutil.copyfileobj(video.file, buffer)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Could not save uploaded video: {str(e)}")
-    finally:
-        video.file.close()
+    input_temp_path, input_is_temporary = await run_in_threadpool(stage_input, video, asset_id, input_temp_path)
 
     edited_file_path = ""
     try:
-        edited_file_path = edit_metadata_py(
+        edited_file_path = await worker_pool.run_in_process(
+            edit_metadata_py,
             input_path=input_temp_path,
             output_path=output_temp_base,
-            metadata_tags=metadata_to_edit
+            metadata_tags=metadata_to_edit,
+            consume_input=input_is_temporary
         )
 
         # Determine media type from the edited file's extension for safety
@@ -1052,7 +1664,7 @@ async def edit_metadata_endpoint(
 
         download_filename = f"{os.path.splitext(original_filename)[0]}_metadata_edited{output_ext}"
 
-        return FileResponse(
+        return output_file_response(
             path=edited_file_path,
             media_type=media_type,
             filename=download_filename
@@ -1067,8 +1679,475 @@ async def edit_metadata_endpoint(
              os.remove(edited_file_path)
         raise HTTPException(status_code=500, detail=f"Error during video metadata editing: {str(e)}")
     finally:
-        if os.path.exists(input_temp_path):
-            os.remove(input_temp_path)
+        if input_is_temporary:
+            remove_temporary_input(input_temp_path)
+
+# Default video bitrates (kbps) for ladder renditions, keyed by output height
+ABR_BITRATES_KBPS = {2160: 16000, 1440: 9000, 1080: 5000, 720: 2800, 480: 1400, 360: 800, 240: 400}
+ABR_SEGMENT_SECONDS = 4
+
+# In-flight and finished ladder jobs of this process, keyed by job id
+ABR_JOBS: Dict[str, Dict[str, Any]] = {}
+# Finished ladder jobs are forgotten after this long; their output stays in PROCESSED_DIR
+ABR_JOB_RETENTION_SECONDS = float(os.environ.get("UPSCALEFX_ABR_JOB_RETENTION_HOURS", "24")) * 3600
+
+def expire_abr_jobs(now: Optional[float] = None) -> None:
+    """Forgets ladder jobs that finished more than ABR_JOB_RETENTION_SECONDS ago."""
+    now = time.time() if now is None else now
+    for job_id, job in list(ABR_JOBS.items()):
+        if job.get("finished_at") and now - job["finished_at"] > ABR_JOB_RETENTION_SECONDS:
+            ABR_JOBS.pop(job_id, None)
+
+def abr_bitrate_kbps(height: int) -> int:
+    return ABR_BITRATES_KBPS.get(height) or max(200, round(5000 * (height / 1080) ** 1.5))
+
+def abr_rendition_ladder(heights: List[int], source_height: int, allow_upscale: bool = False) -> List[Dict[str, int]]:
+    """
+    Turns requested output heights into renditions with bitrates, tallest first.
+    Heights above the source are dropped unless allow_upscale is set.
+    """
+    renditions = []
+    for height in sorted(set(heights), reverse=True):
+        if height <= 0 or height % 2:
+            raise ValueError(f"Invalid rendition height: {height}. Heights must be positive even numbers.")
+        if height > source_height and not allow_upscale:
+            continue
+        renditions.append({"height": height, "video_bitrate_kbps": abr_bitrate_kbps(height)})
+    if not renditions:
+        # Every requested height would upscale: fall back to a single native rendition
+        native_height = source_height - source_height % 2
+        renditions.append({"height": native_height, "video_bitrate_kbps": abr_bitrate_kbps(native_height)})
+    return renditions
+
+def start_abr_ladder_py(
+    input_path: str,
+    output_dir: str,
+    renditions: List[Dict[str, int]],
+    stream_format: str = "hls",
+    has_audio: bool = True
+):
+    """
+    Starts one ffmpeg process that decodes the input once, splits the decoded video into
+    one scale branch per rendition and encodes all of them in parallel into a segmented
+    HLS or DASH package. Returns the running process and the manifest path.
+    """
+    if not os.path.exists(input_path):
+        raise FileNotFoundError(f"Input video not found: {input_path}")
+    stream_format = stream_format.lower()
+    if stream_format not in ("hls", "dash"):
+        raise ValueError(f"Unsupported stream format: {stream_format}. Supported: 'hls', 'dash'.")
+    if not renditions:
+        raise ValueError("At least one rendition is required.")
+
+    os.makedirs(output_dir, exist_ok=True)
+    count = len(renditions)
+    source = ffmpeg.input(input_path)
+    branches = source.video.filter_multi_output("split", count)
+    video_streams = [
+        branches[i].filter("scale", w=-2, h=rendition["height"], flags="bicubic")
+        for i, rendition in enumerate(renditions)
+    ]
+
+    output_options: Dict[str, Any] = {
+        "c:v": "libx264",
+        "preset": "veryfast",
+        "pix_fmt": "yuv420p",
+        # Identical keyframe positions in every rendition so players can switch at any segment
+        "force_key_frames": f"expr:gte(t,n_forced*{ABR_SEGMENT_SECONDS})",
+        "sc_threshold": 0,
+    }
+    for i, rendition in enumerate(renditions):
+        bitrate = rendition["video_bitrate_kbps"]
+        output_options[f"b:v:{i}"] = f"{bitrate}k"
+        output_options[f"maxrate:v:{i}"] = f"{int(bitrate * 1.07)}k"
+        output_options[f"bufsize:v:{i}"] = f"{bitrate * 2}k"
+    if has_audio:
+        output_options.update({"c:a": "aac", "b:a": "128k", "ac": 2})
+
+    if stream_format == "hls":
+        # Every HLS variant carries its own copy of the audio, split from the same decode
+        audio_streams = []
+        if has_audio:
+            audio_branches = source.audio.filter_multi_output("asplit", count)
+            audio_streams = [audio_branches[i] for i in range(count)]
+            var_stream_map = " ".join(f"v:{i},a:{i}" for i in range(count))
+        else:
+            var_stream_map = " ".join(f"v:{i}" for i in range(count))
+        manifest_path = os.path.join(output_dir, "master.m3u8")
+        output_options.update({
+            "f": "hls",
+            "hls_time": ABR_SEGMENT_SECONDS,
+            # 'event' playlists only grow, so segments can be served while later ones encode
+            "hls_playlist_type": "event",
+            "hls_flags": "independent_segments+temp_file",
+            "hls_segment_filename": os.path.join(output_dir, "stream_%v", "segment_%05d.ts"),
+            "master_pl_name": "master.m3u8",
+            "var_stream_map": var_stream_map,
+        })
+        target = os.path.join(output_dir, "stream_%v", "index.m3u8")
+    else:
+        audio_streams = [source.audio] if has_audio else []
+        manifest_path = os.path.join(output_dir, "manifest.mpd")
+        output_options.update({
+            "f": "dash",
+            "seg_duration": ABR_SEGMENT_SECONDS,
+            "use_template": 1,
+            "use_timeline": 1,
+            "adaptation_sets": "id=0,streams=v id=1,streams=a" if has_audio else "id=0,streams=v",
+        })
+        target = manifest_path
+
+    try:
+        process = (
+            ffmpeg
+            .output(*video_streams, *audio_streams, target, **output_options)
+            .global_args("-loglevel", "error", "-nostdin")
+            .overwrite_output()
+            .run_async(pipe_stderr=True)
+        )
+    except Exception as e:
+        print(f"Error starting ABR ladder encode: {str(e)}")
+        raise Exception(f"General error starting ABR ladder encode: {str(e)}")
+    return process, manifest_path
+
+def _watch_abr_job(job_id: str, process, input_path: str, input_is_temporary: bool) -> None:
+    """Waits for a ladder encode to finish, records its outcome and removes a temporary input."""
+    try:
+        _, stderr_bytes = process.communicate()
+        if process.returncode == 0:
+            ABR_JOBS[job_id].update({"status": "complete", "finished_at": time.time()})
+        else:
+            error_message = stderr_bytes.decode("utf8", errors="ignore") if stderr_bytes else "Unknown ffmpeg error during ladder encode"
+            print(f"ffmpeg.Error during ABR ladder encode: {error_message}")
+            ABR_JOBS[job_id].update({"status": "failed", "error": error_message, "finished_at": time.time()})
+    finally:
+        if input_is_temporary:
+            remove_temporary_input(input_path)
+
+@app.post("/abr-ladder/", status_code=202)
+async def abr_ladder_endpoint(
+    video: Optional[UploadFile] = File(None),
+    asset_id: Optional[str] = Form(None),
+    renditions: str = Form("2160,1080,720"), # Comma separated output heights
+    stream_format: str = Form("hls"), # "hls" or "dash"
+    allow_upscale: bool = Form(False) # Keep renditions taller than the source, upscaling during the same decode
+):
+    expire_abr_jobs()
+    original_filename = input_filename(video, asset_id)
+    job_id = str(uuid.uuid4())
+    input_file_extension = os.path.splitext(original_filename)[1] or ".tmp"
+    input_temp_path = os.path.join(UPLOAD_DIR, f"{job_id}_input{input_file_extension}")
+    output_dir = os.path.join(PROCESSED_DIR, f"{job_id}_abr")
+
+    try:
+        heights = [int(h.strip().lower().rstrip("p")) for h in renditions.split(",") if h.strip()]
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid renditions. Use comma separated heights, e.g. '2160,1080,720'.")
+
+    input_temp_path, input_is_temporary = await run_in_threadpool(stage_input, video, asset_id, input_temp_path)
+    try:
+        probe = await run_in_threadpool(ffmpeg.probe, input_temp_path)
+        video_stream = next((stream for stream in probe['streams'] if stream['codec_type'] == 'video'), None)
+        if video_stream is None:
+            raise ValueError("No video stream found")
+        has_audio = any(stream['codec_type'] == 'audio' for stream in probe['streams'])
+        ladder = abr_rendition_ladder(heights, int(video_stream['height']), allow_upscale=allow_upscale)
+        process, manifest_path = start_abr_ladder_py(
+            input_path=input_temp_path,
+            output_dir=output_dir,
+            renditions=ladder,
+            stream_format=stream_format,
+            has_audio=has_audio
+        )
+    except ffmpeg.Error as e:
+        error_message = e.stderr.decode('utf8') if e.stderr else "Unknown ffmpeg error"
+        if input_is_temporary:
+            remove_temporary_input(input_temp_path)
+        raise HTTPException(status_code=400, detail=f"Error probing video file: {error_message}")
+    except ValueError as e:
+        if input_is_temporary:
+            remove_temporary_input(input_temp_path)
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        print(f"Unhandled error starting ABR ladder: {str(e)}")
+        if input_is_temporary:
+            remove_temporary_input(input_temp_path)
+        raise HTTPException(status_code=500, detail=f"Error starting ABR ladder encode: {str(e)}")
+
+    relative_manifest = os.path.relpath(manifest_path, PROCESSED_DIR).replace(os.sep, "/")
+    ABR_JOBS[job_id] = {
+        "job_id": job_id,
+        "status": "encoding",
+        "format": stream_format.lower(),
+        "renditions": ladder,
+        "manifest_path": manifest_path,
+        "manifest_url": f"../outputs/{quote(relative_manifest)}",
+        "finished_at": None,
+    }
+    threading.Thread(target=_watch_abr_job, args=(job_id, process, input_temp_path, input_is_temporary), daemon=True).start()
+    return abr_job_status(job_id)
+
+def abr_job_status(job_id: str) -> Dict[str, Any]:
+    job = ABR_JOBS[job_id]
+    status = {key: value for key, value in job.items() if key != "manifest_path"}
+    # The manifest appears with the first segments and can be played while encoding continues
+    status["ready"] = os.path.exists(job["manifest_path"])
+    return status
+
+@app.get("/abr-ladder/{job_id}")
+async def abr_ladder_status_endpoint(job_id: str):
+    expire_abr_jobs()
+    if job_id not in ABR_JOBS:
+        raise HTTPException(status_code=404, detail=f"Ladder job not found: {job_id}")
+    return abr_job_status(job_id)
+
+# Server-side directory that batch manifests may read inputs from by path. Unset disables path inputs over HTTP.
+BATCH_INPUT_ROOT = os.environ.get("UPSCALEFX_BATCH_INPUT_ROOT")
+
+def _batch_upscale(input_path: str, output_base: str, params: Dict[str, Any], checkpoint: Optional[segmented_encode.SegmentCheckpoint] = None) -> str:
+    scale_factor, target_width, target_height = parse_scale_option(str(params.get("scale_option", "2x")))
+    extension = os.path.splitext(input_path)[1] or ".mp4"
+    quality_floor = float(params["quality_floor"]) if params.get("quality_floor") is not None else None
+    return upscale_video_py(
+        input_path, f"{output_base}{extension}", scale_factor, target_width, target_height, checkpoint=checkpoint,
+        scaler=scalers.validate_scaler(str(params.get("scaler", scalers.DEFAULT_SCALER)), quality_floor), quality_floor=quality_floor
+    )
+
+def _batch_crop(input_path: str, output_base: str, params: Dict[str, Any], checkpoint: Optional[segmented_encode.SegmentCheckpoint] = None) -> str:
+    return crop_video_py(
+        input_path, output_base,
+        int(params["crop_x"]), int(params["crop_y"]), int(params["crop_width"]), int(params["crop_height"]),
+        checkpoint=checkpoint
+    )
+
+def _batch_compress(input_path: str, output_base: str, params: Dict[str, Any]) -> str:
+    if params.get("target_size_mb") is not None or params.get("target_ssim") is not None:
+        return compress_to_target_py(
+            input_path, output_base,
+            target_size_mb=float(params["target_size_mb"]) if params.get("target_size_mb") is not None else None,
+            target_ssim=float(params["target_ssim"]) if params.get("target_ssim") is not None else None
+        )[0]
+    return compress_video_py(input_path, output_base, str(params.get("quality_preset", "medium")).lower())
+
+# Batch operation name -> callable(input_path, output_base, params) returning the output path
+BATCH_OPERATIONS: Dict[str, Any] = {
+    "upscale": _batch_upscale,
+    "convert": lambda input_path, output_base, params: convert_video_py(input_path, output_base, str(params.get("target_format", "mp4")).lower()),
+    "compress": _batch_compress,
+    "crop": _batch_crop,
+    "trim": lambda input_path, output_base, params: trim_video_py(input_path, output_base, str(params["start_time"]), str(params["end_time"])),
+    "extract_frame": lambda input_path, output_base, params: extract_frame_py(input_path, output_base, str(params["timestamp"]), str(params.get("image_format", "jpg"))),
+    "edit_metadata": lambda input_path, output_base, params: edit_metadata_py(input_path, output_base, dict(params.get("tags", {}))),
+}
+
+def resolve_batch_input(item: Dict[str, Any], allow_any_path: bool = False) -> str:
+    """Resolves a manifest item's asset_id or server-side path to a readable file."""
+    if item.get("asset_id"):
+        return asset_store.get_asset(item["asset_id"])["path"]
+    path = str(item["path"])
+    if allow_any_path:
+        resolved = os.path.abspath(path)
+    elif not BATCH_INPUT_ROOT:
+        raise ValueError("Server-side paths are disabled. Set UPSCALEFX_BATCH_INPUT_ROOT or use asset ids.")
+    else:
+        resolved = resolve_within(BATCH_INPUT_ROOT, path)
+    if not os.path.isfile(resolved):
+        raise FileNotFoundError(f"Input video not found: {path}")
+    return resolved
+
+# Operations that accept a checkpoint and encode in resumable segments
+RESUMABLE_OPERATIONS = {"upscale", "crop"}
+
+def run_operation(
+    operation: str,
+    input_path: str,
+    output_base: str,
+    params: Dict[str, Any],
+    checkpoint: Optional[segmented_encode.SegmentCheckpoint] = None
+) -> str:
+    """
+    Runs a named batch/queue operation on input_path and returns the output path.
+    Resumable operations given a checkpoint pick up after its last finished segment.
+    """
+    operation = str(operation).lower()
+    function = BATCH_OPERATIONS.get(operation)
+    if function is None:
+        raise ValueError(f"Unsupported operation: {operation}. Supported: {', '.join(BATCH_OPERATIONS.keys())}")
+    if checkpoint is not None and operation in RESUMABLE_OPERATIONS:
+        return function(input_path, output_base, params, checkpoint=checkpoint)
+    return function(input_path, output_base, params)
+
+def run_batch_item(batch_id: str, index: int, item: Dict[str, Any], allow_any_path: bool = False) -> Dict[str, Any]:
+    """Runs one manifest item and returns where its output can be fetched."""
+    if str(item["operation"]).lower() not in BATCH_OPERATIONS:
+        raise ValueError(f"Unsupported operation: {item['operation']}. Supported: {', '.join(BATCH_OPERATIONS.keys())}")
+    input_path = resolve_batch_input(item, allow_any_path=allow_any_path)
+    output_dir = os.path.join(PROCESSED_DIR, batch_id)
+    os.makedirs(output_dir, exist_ok=True)
+    output_base = os.path.join(output_dir, f"{index:05d}_{str(item['operation']).lower()}")
+    output_path = run_operation(item["operation"], input_path, output_base, item.get("params", {}))
+    relative_path = os.path.relpath(output_path, PROCESSED_DIR).replace(os.sep, "/")
+    return {"output_path": os.path.abspath(output_path), "output_url": f"../outputs/{quote(relative_path)}"}
+
+@app.post("/batch/")
+async def batch_endpoint(request: Request):
+    """
+    Starts a JSON manifest (see batch.py) in the background and streams one NDJSON line
+    per item as it finishes, followed by a summary line. The batch keeps running if the
+    client disconnects; progress can also be polled at GET /batch/{batch_id}.
+    """
+    try:
+        manifest = batch.parse_manifest(await request.json())
+    except json.JSONDecodeError:
+        raise HTTPException(status_code=400, detail="Invalid JSON manifest.")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    batch_id = batch.start_batch(manifest["items"], run_batch_item, concurrency=manifest["concurrency"])
+
+    async def stream_results():
+        yield json.dumps({"batch_id": batch_id, "status": "started", "total": len(manifest["items"])}) + "\n"
+        received = 0
+        done = False
+        while not done:
+            # Bounded waits, so a disconnected client frees its thread within a second
+            results, done = await run_in_threadpool(batch.wait_for_results, batch_id, received, 1.0)
+            for result in results:
+                yield json.dumps(result) + "\n"
+            received += len(results)
+        summary = batch.batch_summary(batch_id)
+        yield json.dumps({"batch_id": batch_id, "status": "finished", "total": summary["total"], "counts": summary["counts"]}) + "\n"
+
+    return StreamingResponse(stream_results(), media_type="application/x-ndjson", headers={"X-Batch-Id": batch_id})
+
+@app.get("/batch/{batch_id}")
+async def batch_status_endpoint(batch_id: str):
+    try:
+        return batch.batch_summary(batch_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Batch not found: {batch_id}")
+
+# Queue and storage shared with standalone workers (worker.py), opened on first use
+_job_backends: Dict[str, Any] = {}
+_job_backends_lock = threading.Lock()
+
+def job_backends() -> tuple[job_queue.JobQueue, job_storage.Storage]:
+    with _job_backends_lock:
+        if not _job_backends:
+            _job_backends["queue"] = job_queue.open_queue()
+            _job_backends["storage"] = job_storage.open_storage()
+        return _job_backends["queue"], _job_backends["storage"]
+
+def store_job_input(video: Optional[UploadFile], asset_id: Optional[str]) -> Dict[str, Any]:
+    """Puts a job's input into job storage and returns its reference for the job record."""
+    queue, store = job_backends()
+    if asset_id:
+        asset = asset_store.get_asset(asset_id)
+        key = f"assets/{asset_id}{os.path.splitext(asset['path'])[1]}"
+        # Assets are immutable, so one stored copy serves every job on them
+        if not store.exists(key):
+            store.put(asset["path"], key)
+        return {"key": key, "filename": asset["filename"]}
+
+    extension = os.path.splitext(video.filename or "")[1] or ".mp4"
+    upload_path = os.path.join(UPLOAD_DIR, f"{uuid.uuid4()}_job_input{extension}")
+    upload_path, _ = stage_input(video, None, upload_path)
+    try:
+        key = store.put(upload_path, f"inputs/{uuid.uuid4()}{extension}")
+    finally:
+        os.remove(upload_path)
+    # Uploads are deleted from storage once their job has finished
+    return {"key": key, "filename": video.filename, "temporary": True}
+
+def job_response(job: Dict[str, Any]) -> Dict[str, Any]:
+    response = {key: value for key, value in job.items() if key != "input"}
+    response["filename"] = job["input"].get("filename")
+    if job["status"] == "complete":
+        response["output_url"] = f"{job['job_id']}/output"
+    return response
+
+@app.post("/jobs/", status_code=202)
+async def create_job_endpoint(
+    video: Optional[UploadFile] = File(None),
+    asset_id: Optional[str] = Form(None),
+    operation: str = Form(...),
+    params_json: str = Form("{}") # JSON object named like the operation's form fields, as in batch manifests
+):
+    """
+    Queues an operation for the standalone workers (worker.py) and returns the job
+    immediately; poll GET /jobs/{job_id} for its status.
+    """
+    operation = operation.lower()
+    if operation not in BATCH_OPERATIONS:
+        raise HTTPException(status_code=400, detail=f"Unsupported operation: {operation}. Supported: {', '.join(BATCH_OPERATIONS.keys())}")
+    try:
+        params = json.loads(params_json)
+        if not isinstance(params, dict):
+            raise ValueError("params_json must be a JSON object.")
+    except json.JSONDecodeError:
+        raise HTTPException(status_code=400, detail="Invalid JSON format for params_json.")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    input_filename(video, asset_id)
+
+    try:
+        input_ref = await run_in_threadpool(store_job_input, video, asset_id)
+        queue, _ = job_backends()
+        job = await run_in_threadpool(queue.enqueue, operation, params, input_ref)
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Error while queueing job: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Could not queue job: {str(e)}")
+    return JSONResponse(job_response(job), status_code=202, headers={"Location": f"{job['job_id']}"})
+
+@app.get("/jobs/{job_id}")
+async def job_status_endpoint(job_id: str):
+    queue, _ = job_backends()
+    try:
+        return job_response(await run_in_threadpool(queue.get, job_id))
+    except job_queue.JobNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+def local_job_output(job_id: str) -> str:
+    """Path of a complete job's output, fetched from job storage when it is not readable in place."""
+    queue, store = job_backends()
+    job = queue.get(job_id)
+    if job["status"] != "complete":
+        raise FileNotFoundError(f"Job {job_id} has no output (status: {job['status']}).")
+    output_key = job["result"]["output_key"]
+    path = store.local_path(output_key)
+    if path is None:
+        path = os.path.join(PROCESSED_DIR, "jobs", job_id, os.path.basename(output_key))
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            store.fetch(output_key, tmp_path)
+            os.replace(tmp_path, path)
+    return path
+
+@app.api_route("/jobs/{job_id}/output", methods=["GET", "HEAD"])
+async def job_output_endpoint(request: Request, job_id: str, filename: Optional[str] = None):
+    try:
+        path = await run_in_threadpool(local_job_output, job_id)
+    except (job_queue.JobNotFoundError, FileNotFoundError) as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    extension = os.path.splitext(path)[1].lower()
+    return RangedFileResponse(
+        path=path,
+        media_type=MEDIA_TYPES.get(extension) or mimetypes.guess_type(path)[0] or "application/octet-stream",
+        filename=filename,
+        request_headers=request.headers,
+        method=request.method
+    )
+
+@app.get("/workers/")
+async def workers_endpoint():
+    """Standalone workers that heartbeated recently and the jobs they are running."""
+    queue, _ = job_backends()
+    return {"workers": await run_in_threadpool(queue.workers)}
 
 
 if __name__ == "__main__":
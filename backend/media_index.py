@@ -0,0 +1,262 @@
+"""
+Keyframe and scene-cut index of a video, built once and kept as a binary sidecar.
+
+Keyframes come from packet-level demuxing (ffprobe packet flags), so nothing is
+decoded. Scene-cut scores are an optional second pass that decodes a downscaled
+copy of the video. The index is stored as a small header followed by packed
+arrays, and loads in microseconds, so operations can plan exact seeks and cut
+points without probing the file again.
+"""
+import bisect
+import os
+import re
+import struct
+import subprocess
+import sys
+import tempfile
+import uuid
+from array import array
+from typing import Any, Dict, List, Optional, Tuple
+
+SIDECAR_NAME = "index.bin"
+MAGIC = b"UFXIDX\0\0"
+VERSION = 2
+FLAG_SCENES = 1
+# magic, version, flags, keyframe count, scene count, duration, source size, source mtime (ns)
+HEADER = struct.Struct("<8sHHIIdQq")
+
+SCENE_THRESHOLD = 0.3
+SCENE_ANALYSIS_WIDTH = 160
+# Timestamps this close to a keyframe are treated as landing on it
+KEYFRAME_TOLERANCE = 0.001
+
+
+def parse_timestamp(value: str) -> float:
+    """Parses seconds ("12.5") or clock time ("MM:SS", "HH:MM:SS.mmm") into seconds."""
+    text = str(value).strip()
+    if not re.fullmatch(r"\d+(\.\d+)?|(\d+:){1,2}\d+(\.\d+)?", text):
+        raise ValueError(f"Invalid timestamp: {value}. Use seconds or HH:MM:SS(.mmm).")
+    seconds = 0.0
+    for part in text.split(":"):
+        seconds = seconds * 60 + float(part)
+    return seconds
+
+
+def _little_endian(values: array) -> bytes:
+    if sys.byteorder == "big":
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def _from_little_endian(typecode: str, data: bytes) -> array:
+    values = array(typecode)
+    values.frombytes(data)
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values
+
+
+class MediaIndex:
+    """
+    Keyframe times and byte positions of the first video stream, plus optional scene
+    cuts. Times are seconds from the start of the file, as taken by ffmpeg's -ss.
+    """
+
+    def __init__(
+        self,
+        keyframe_times: array,
+        keyframe_positions: array,
+        duration: float,
+        source_size: int,
+        scene_times: Optional[array] = None,
+        scene_scores: Optional[array] = None,
+        source_mtime_ns: int = 0,
+    ):
+        self.keyframe_times = keyframe_times
+        self.keyframe_positions = keyframe_positions
+        self.duration = duration
+        self.source_size = source_size
+        self.source_mtime_ns = source_mtime_ns
+        self.has_scenes = scene_times is not None
+        self.scene_times = scene_times if scene_times is not None else array("d")
+        self.scene_scores = scene_scores if scene_scores is not None else array("f")
+
+    def keyframe_at_or_before(self, time: float) -> Optional[float]:
+        i = bisect.bisect_right(self.keyframe_times, time + KEYFRAME_TOLERANCE)
+        return self.keyframe_times[i - 1] if i else None
+
+    def keyframe_at_or_after(self, time: float) -> Optional[float]:
+        i = bisect.bisect_left(self.keyframe_times, time - KEYFRAME_TOLERANCE)
+        return self.keyframe_times[i] if i < len(self.keyframe_times) else None
+
+    def is_keyframe(self, time: float) -> bool:
+        keyframe = self.keyframe_at_or_before(time)
+        return keyframe is not None and abs(keyframe - time) <= KEYFRAME_TOLERANCE
+
+    def keyframes_between(self, start: float, end: float) -> List[float]:
+        return list(self.keyframe_times[bisect.bisect_left(self.keyframe_times, start):bisect.bisect_right(self.keyframe_times, end)])
+
+    def to_bytes(self) -> bytes:
+        header = HEADER.pack(
+            MAGIC, VERSION, FLAG_SCENES if self.has_scenes else 0,
+            len(self.keyframe_times), len(self.scene_times), self.duration, self.source_size, self.source_mtime_ns,
+        )
+        return b"".join([
+            header,
+            _little_endian(self.keyframe_times),
+            _little_endian(self.keyframe_positions),
+            _little_endian(self.scene_times),
+            _little_endian(self.scene_scores),
+        ])
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "MediaIndex":
+        magic, version, flags, keyframes, scenes, duration, source_size, source_mtime_ns = HEADER.unpack_from(data)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("Not a media index, or an unsupported index version.")
+        offset = HEADER.size
+        sections = []
+        for typecode, count in (("d", keyframes), ("q", keyframes), ("d", scenes), ("f", scenes)):
+            size = array(typecode).itemsize * count
+            sections.append(_from_little_endian(typecode, data[offset:offset + size]))
+            offset += size
+        has_scenes = bool(flags & FLAG_SCENES)
+        return cls(
+            sections[0], sections[1], duration, source_size,
+            scene_times=sections[2] if has_scenes else None,
+            scene_scores=sections[3] if has_scenes else None,
+            source_mtime_ns=source_mtime_ns,
+        )
+
+    def matches(self, input_path: str) -> bool:
+        """True when input_path still has the size and modification time the index was built from."""
+        stat = os.stat(input_path)
+        return self.source_size == stat.st_size and self.source_mtime_ns == stat.st_mtime_ns
+
+    def to_dict(self) -> Dict[str, Any]:
+        result = {
+            "duration": self.duration,
+            "keyframes": [round(t, 6) for t in self.keyframe_times],
+            "keyframe_positions": list(self.keyframe_positions),
+        }
+        if self.has_scenes:
+            result["scenes"] = [{"time": round(t, 6), "score": round(s, 4)} for t, s in zip(self.scene_times, self.scene_scores)]
+        return result
+
+
+def _run(cmd: List[str]) -> str:
+    result = subprocess.run(cmd, capture_output=True)
+    if result.returncode != 0:
+        raise Exception(f"{cmd[0]} error while indexing: {result.stderr.decode('utf8', errors='ignore')}")
+    return result.stdout.decode("utf8", errors="ignore")
+
+
+def scan_keyframes(input_path: str) -> Tuple[array, array, float]:
+    """
+    Lists keyframe (time, pos) of the first video stream from packet flags, without
+    decoding. Times are pts_time minus the container's start_time, so they match -ss.
+    """
+    output = _run([
+        "ffprobe", "-v", "error", "-select_streams", "v:0",
+        "-show_entries", "packet=pts_time,dts_time,duration_time,pos,flags:format=start_time", "-of", "csv=print_section=0",
+        input_path,
+    ])
+    times, positions = array("d"), array("q")
+    end = 0.0
+    start_time = 0.0
+    for line in output.splitlines():
+        fields = line.split(",")
+        if len(fields) == 1:
+            # The format section, printed after the packets, holds only start_time
+            if fields[0] not in ("", "N/A"):
+                start_time = float(fields[0])
+            continue
+        if len(fields) < 5:
+            continue
+        pts_time, dts_time, duration_time, pos, flags = fields[:5]
+        time_text = pts_time if pts_time not in ("", "N/A") else dts_time
+        if time_text in ("", "N/A"):
+            continue
+        time = float(time_text)
+        if duration_time not in ("", "N/A"):
+            end = max(end, time + float(duration_time))
+        if flags.startswith("K"):
+            times.append(time)
+            positions.append(int(pos) if pos not in ("", "N/A") else -1)
+    if not times:
+        raise ValueError("No keyframes found in the first video stream.")
+    # Packets arrive in decode order; keyframes are sorted by presentation time for bisecting
+    order = sorted(range(len(times)), key=times.__getitem__)
+    return array("d", (times[i] - start_time for i in order)), array("q", (positions[i] for i in order)), max(0.0, end - start_time)
+
+
+def scan_scenes(input_path: str, threshold: float = SCENE_THRESHOLD) -> Tuple[array, array]:
+    """Scene-cut (time, score) pairs above threshold, from a decode of a downscaled copy."""
+    times, scores = array("d"), array("f")
+    with tempfile.TemporaryDirectory(prefix="scene_scan_") as work_dir:
+        log_path = os.path.join(work_dir, "scenes.txt")
+        _run([
+            "ffmpeg", "-nostdin", "-v", "error", "-i", input_path, "-map", "0:v:0", "-an", "-sn",
+            "-vf", f"scale={SCENE_ANALYSIS_WIDTH}:-2,select='gte(scene,{threshold})',metadata=print:file={log_path}",
+            "-f", "null", "-",
+        ])
+        time = None
+        with open(log_path) as f:
+            for line in f:
+                frame = re.search(r"pts_time:([\d.]+)", line)
+                if frame:
+                    time = float(frame.group(1))
+                    continue
+                score = re.search(r"lavfi\.scene_score=([\d.]+)", line)
+                if score and time is not None:
+                    times.append(time)
+                    scores.append(float(score.group(1)))
+    return times, scores
+
+
+def build_index(input_path: str, scenes: bool = False, existing: Optional[MediaIndex] = None) -> MediaIndex:
+    """Builds an index; the keyframe scan of an existing index is reused when only scenes are added."""
+    # Taken before scanning, so a file replaced during the scan is not recorded as current
+    stat = os.stat(input_path)
+    if existing is not None:
+        keyframe_times, keyframe_positions, duration = existing.keyframe_times, existing.keyframe_positions, existing.duration
+    else:
+        keyframe_times, keyframe_positions, duration = scan_keyframes(input_path)
+    scene_times, scene_scores = scan_scenes(input_path) if scenes else (None, None)
+    return MediaIndex(
+        keyframe_times, keyframe_positions, duration, stat.st_size,
+        scene_times=scene_times, scene_scores=scene_scores, source_mtime_ns=stat.st_mtime_ns,
+    )
+
+
+def load_index(sidecar_path: str) -> Optional[MediaIndex]:
+    try:
+        with open(sidecar_path, "rb") as f:
+            return MediaIndex.from_bytes(f.read())
+    except (FileNotFoundError, ValueError, struct.error):
+        return None
+
+
+def save_index(index: MediaIndex, sidecar_path: str) -> None:
+    # Written atomically so concurrent readers never see a partial index
+    tmp_path = f"{sidecar_path}.{uuid.uuid4().hex}"
+    with open(tmp_path, "wb") as f:
+        f.write(index.to_bytes())
+    os.replace(tmp_path, sidecar_path)
+
+
+def load_or_build_index(input_path: str, sidecar_path: Optional[str] = None, scenes: bool = False) -> MediaIndex:
+    """
+    Returns the index stored at sidecar_path, building (and storing) it when it is
+    missing, lacks requested scene data, or belongs to a different file.
+    Without a sidecar_path the index is built and not kept.
+    """
+    index = load_index(sidecar_path) if sidecar_path else None
+    if index is not None and not index.matches(input_path):
+        index = None
+    if index is None or (scenes and not index.has_scenes):
+        index = build_index(input_path, scenes=scenes, existing=index)
+        if sidecar_path:
+            save_index(index, sidecar_path)
+    return index
@@ -0,0 +1,596 @@
+"""
+In-place container metadata editing for MP4/MOV and Matroska/WebM.
+
+Only the metadata structure is rewritten, never the media payload:
+
+*   MP4/MOV: the `moov` box is rebuilt with updated `meta/ilst` items, either
+    iTunes-style or the keys-indexed form ffmpeg writes with `use_metadata_tags`. The new
+    `moov` is written over the old one when it fits together with any adjacent
+    `free` padding or ends the file, or otherwise appended at the end of the file with
+    the old box turned into `free`. Sample offsets in `stco`/`co64` point into `mdat`, which never moves.
+*   Matroska: the global `Tag` inside `Tags` is rebuilt and written over the old
+    element (using adjacent `Void` padding), or appended at the end of the segment
+    with the `SeekHead` entry and segment size patched in place. A `SeekHead` whose
+    positions are too narrow is rewritten into the `Void` that follows it.
+
+Layouts that cannot be handled this way raise UnsupportedLayout before anything is
+written, so callers can fall back to a full ffmpeg remux.
+"""
+import os
+import struct
+from typing import Dict, List, Optional, Tuple
+
+MP4_EXTENSIONS = (".mp4", ".m4v", ".m4a", ".mov", ".qt")
+MATROSKA_EXTENSIONS = (".mkv", ".mka", ".webm")
+
+
+class UnsupportedLayout(Exception):
+    """The file cannot be edited in place; nothing has been written."""
+
+
+def supports_in_place_edit(path: str) -> bool:
+    return os.path.splitext(path)[1].lower() in MP4_EXTENSIONS + MATROSKA_EXTENSIONS
+
+
+def edit_metadata_in_place(path: str, tags: Dict[str, str]) -> None:
+    """Sets global metadata tags of an MP4/MOV or Matroska file without rewriting its media."""
+    extension = os.path.splitext(path)[1].lower()
+    try:
+        if extension in MP4_EXTENSIONS:
+            _edit_mp4(path, tags)
+        elif extension in MATROSKA_EXTENSIONS:
+            _edit_matroska(path, tags)
+        else:
+            raise UnsupportedLayout(f"No in-place metadata editor for {extension or 'files without an extension'}.")
+    except (struct.error, IndexError) as e:
+        # Truncated or malformed structures are only ever hit while parsing, before any write
+        raise UnsupportedLayout(f"Could not parse container structure: {e}")
+
+
+# --- MP4 / MOV -------------------------------------------------------------------
+
+# ffmpeg's names for the iTunes-style ilst items it reads and writes
+MP4_TAG_ATOMS = {
+    "title": b"\xa9nam",
+    "artist": b"\xa9ART",
+    "album": b"\xa9alb",
+    "album_artist": b"aART",
+    "comment": b"\xa9cmt",
+    "date": b"\xa9day",
+    "genre": b"\xa9gen",
+    "composer": b"\xa9wrt",
+    "encoder": b"\xa9too",
+    "copyright": b"cprt",
+    "description": b"desc",
+    "synopsis": b"ldes",
+    "grouping": b"\xa9grp",
+    "lyrics": b"\xa9lyr",
+    "show": b"tvsh",
+    "episode_id": b"tven",
+    "network": b"tvnn",
+}
+FREEFORM_MEAN = b"com.apple.iTunes"
+UTF8_DATA_TYPE = 1
+
+
+def _box(box_type: bytes, payload: bytes) -> bytes:
+    return struct.pack(">I", 8 + len(payload)) + box_type + payload
+
+
+def _free_box(size: int) -> bytes:
+    return struct.pack(">I", size) + b"free" + b"\0" * (size - 8)
+
+
+def _children(data: bytes, start: int, end: int) -> List[Tuple[bytes, int, int, int]]:
+    """Lists (type, box_start, payload_start, box_end) of the boxes in data[start:end]."""
+    boxes = []
+    offset = start
+    while offset + 8 <= end:
+        size, box_type = struct.unpack(">I4s", data[offset:offset + 8])
+        header = 8
+        if size == 1:
+            size = struct.unpack(">Q", data[offset + 8:offset + 16])[0]
+            header = 16
+        elif size == 0:
+            size = end - offset
+        if size < header or offset + size > end:
+            raise UnsupportedLayout(f"Malformed '{box_type.decode('latin-1')}' box.")
+        boxes.append((box_type, offset, offset + header, offset + size))
+        offset += size
+    return boxes
+
+
+def _top_level_boxes(f, file_size: int) -> List[Tuple[bytes, int, int, int]]:
+    """Like _children, but reads only box headers from the file."""
+    boxes = []
+    offset = 0
+    while offset + 8 <= file_size:
+        f.seek(offset)
+        header_bytes = f.read(16)
+        size, box_type = struct.unpack(">I4s", header_bytes[:8])
+        header = 8
+        if size == 1:
+            size = struct.unpack(">Q", header_bytes[8:16])[0]
+            header = 16
+        elif size == 0:
+            size = file_size - offset
+        if size < header or offset + size > file_size:
+            raise UnsupportedLayout(f"Malformed top-level '{box_type.decode('latin-1')}' box.")
+        boxes.append((box_type, offset, offset + header, offset + size))
+        offset += size
+    return boxes
+
+
+def _find(children, box_type: bytes):
+    return next((child for child in children if child[0] == box_type), None)
+
+
+def _meta_layout(data: bytes, payload_start: int) -> int:
+    """ISO 'meta' is a full box with 4 bytes of version/flags; QuickTime's is not."""
+    return payload_start if data[payload_start + 4:payload_start + 8] == b"hdlr" else payload_start + 4
+
+
+def _handler_type(data: bytes, children) -> Optional[bytes]:
+    hdlr = _find(children, b"hdlr")
+    if hdlr is None:
+        return None
+    # version/flags (4) + pre_defined (4), then the handler type
+    return data[hdlr[2] + 8:hdlr[2] + 12]
+
+
+def _data_box(value: str) -> bytes:
+    return _box(b"data", struct.pack(">II", UTF8_DATA_TYPE, 0) + value.encode("utf-8"))
+
+
+def _freeform_item(name: str, value: str) -> bytes:
+    return _box(b"----", _box(b"mean", b"\0\0\0\0" + FREEFORM_MEAN) + _box(b"name", b"\0\0\0\0" + name.encode("utf-8")) + _data_box(value))
+
+
+def _freeform_name(data: bytes, item) -> Optional[str]:
+    name = _find(_children(data, item[2], item[3]), b"name")
+    return data[name[2] + 4:name[3]].decode("utf-8", errors="replace") if name else None
+
+
+def _rebuild_mdir_ilst(data: bytes, ilst, tags: Dict[str, str]) -> bytes:
+    """Updates iTunes-style items, keeping every item that is not being replaced."""
+    remaining = dict(tags)
+    items = []
+    for item in (_children(data, ilst[2], ilst[3]) if ilst else []):
+        item_type = item[0]
+        key = next((k for k, atom in MP4_TAG_ATOMS.items() if atom == item_type), None)
+        if item_type == b"----":
+            key = _freeform_name(data, item)
+            if key is not None and key in remaining:
+                items.append(_freeform_item(key, remaining.pop(key)))
+                continue
+        elif key is not None and key in remaining:
+            items.append(_box(item_type, _data_box(remaining.pop(key))))
+            continue
+        elif item_type == b"gnre" and "genre" in tags:
+            continue  # A numeric ID3 genre would shadow the new text genre
+        items.append(data[item[1]:item[3]])
+    for key, value in remaining.items():
+        atom = MP4_TAG_ATOMS.get(key)
+        items.append(_box(atom, _data_box(value)) if atom else _freeform_item(key, value))
+    return _box(b"ilst", b"".join(items))
+
+
+def _rebuild_mdta_meta(data: bytes, meta_children, tags: Dict[str, str]) -> List[bytes]:
+    """Updates a 'keys' + 'ilst' pair where ilst items are indexed into the key table."""
+    keys_box = _find(meta_children, b"keys")
+    ilst = _find(meta_children, b"ilst")
+    key_names: List[bytes] = []
+    if keys_box:
+        offset = keys_box[2] + 8  # version/flags + entry_count
+        while offset + 8 <= keys_box[3]:
+            size = struct.unpack(">I", data[offset:offset + 4])[0]
+            key_names.append(data[offset:offset + size])  # size + namespace + name
+            offset += size
+    values: Dict[int, bytes] = {}
+    order: List[int] = []
+    for item in (_children(data, ilst[2], ilst[3]) if ilst else []):
+        index = struct.unpack(">I", item[0])[0]
+        values[index] = data[item[1]:item[3]]
+        order.append(index)
+
+    for key, value in tags.items():
+        entry = struct.pack(">I", 8 + len(key.encode("utf-8"))) + b"mdta" + key.encode("utf-8")
+        if entry in key_names:
+            index = key_names.index(entry) + 1
+        else:
+            key_names.append(entry)
+            index = len(key_names)
+        if index not in values:
+            order.append(index)
+        values[index] = _box(struct.pack(">I", index), _data_box(value))
+
+    new_keys = _box(b"keys", b"\0\0\0\0" + struct.pack(">I", len(key_names)) + b"".join(key_names))
+    new_ilst = _box(b"ilst", b"".join(values[index] for index in order))
+    rebuilt = []
+    for child in meta_children:
+        if child[0] == b"keys":
+            rebuilt.append(new_keys)
+        elif child[0] == b"ilst":
+            rebuilt.append(new_ilst)
+        else:
+            rebuilt.append(data[child[1]:child[3]])
+    if keys_box is None:
+        rebuilt.append(new_keys)
+    if ilst is None:
+        rebuilt.append(new_ilst)
+    return rebuilt
+
+
+def _rebuild_meta(moov: bytes, meta, tags: Dict[str, str]) -> bytes:
+    prefix_end = _meta_layout(moov, meta[2])
+    meta_children = _children(moov, prefix_end, meta[3])
+    handler = _handler_type(moov, meta_children)
+    if handler == b"mdta":
+        parts = _rebuild_mdta_meta(moov, meta_children, tags)
+    elif handler in (b"mdir", None):
+        ilst = _find(meta_children, b"ilst")
+        new_ilst = _rebuild_mdir_ilst(moov, ilst, tags)
+        parts = [new_ilst if child is ilst else moov[child[1]:child[3]] for child in meta_children]
+        if ilst is None:
+            parts.append(new_ilst)
+    else:
+        raise UnsupportedLayout(f"meta box uses an unsupported '{handler.decode('latin-1')}' handler.")
+    return _box(b"meta", moov[meta[2]:prefix_end] + b"".join(parts))
+
+
+def _rebuild_moov(moov: bytes, tags: Dict[str, str]) -> bytes:
+    moov_children = _children(moov, 8, len(moov))
+
+    # Keys-based tags may sit directly in moov/meta; ffmpeg reads them from there too
+    moov_meta = _find(moov_children, b"meta")
+    if moov_meta:
+        new_meta = _rebuild_meta(moov, moov_meta, tags)
+        return _box(b"moov", b"".join(
+            new_meta if child is moov_meta else moov[child[1]:child[3]] for child in moov_children
+        ))
+
+    udta = _find(moov_children, b"udta")
+    udta_children = _children(moov, udta[2], udta[3]) if udta else []
+    meta = _find(udta_children, b"meta")
+    if meta:
+        new_meta = _rebuild_meta(moov, meta, tags)
+    else:
+        hdlr = _box(b"hdlr", b"\0" * 8 + b"mdir" + b"appl" + b"\0" * 9)
+        new_meta = _box(b"meta", b"\0\0\0\0" + hdlr + _rebuild_mdir_ilst(moov, None, tags))
+
+    udta_parts = [new_meta if child is meta else moov[child[1]:child[3]] for child in udta_children]
+    if meta is None:
+        udta_parts.append(new_meta)
+    new_udta = _box(b"udta", b"".join(udta_parts))
+    moov_parts = [new_udta if child is udta else moov[child[1]:child[3]] for child in moov_children]
+    if udta is None:
+        moov_parts.append(new_udta)
+    return _box(b"moov", b"".join(moov_parts))
+
+
+def _edit_mp4(path: str, tags: Dict[str, str]) -> None:
+    with open(path, "r+b") as f:
+        file_size = os.fstat(f.fileno()).st_size
+        boxes = _top_level_boxes(f, file_size)
+        moov_index = next((i for i, box in enumerate(boxes) if box[0] == b"moov"), None)
+        if moov_index is None:
+            raise UnsupportedLayout("No moov box found.")
+        _, moov_start, _, moov_end = boxes[moov_index]
+        f.seek(moov_start)
+        new_moov = _rebuild_moov(f.read(moov_end - moov_start), tags)
+
+        # Room available in place: the old moov plus any free/skip padding right after it
+        available_end = moov_end
+        following = boxes[moov_index + 1] if moov_index + 1 < len(boxes) else None
+        if following and following[0] in (b"free", b"skip"):
+            available_end = following[3]
+        available = available_end - moov_start
+        spare = available - len(new_moov)
+
+        if available_end == file_size:
+            # moov is the last thing in the file (ffmpeg's default): rewrite it there at any
+            # size, so repeated edits never leave stale copies behind
+            f.seek(moov_start)
+            f.write(new_moov)
+            f.truncate(moov_start + len(new_moov))
+        elif spare == 0 or spare >= 8:
+            f.seek(moov_start)
+            f.write(new_moov + (_free_box(spare) if spare else b""))
+        else:
+            if any(box[0] == b"moof" for box in boxes):
+                raise UnsupportedLayout("Fragmented MP4 needs moov before its fragments; not enough room in place.")
+            f.seek(boxes[-1][1])
+            last_size = struct.unpack(">I", f.read(4))[0]
+            if last_size == 0:
+                raise UnsupportedLayout("The last box runs to end of file; cannot append a relocated moov.")
+            # Append the new moov first, then retire the old one, so the file is never without a moov
+            f.seek(file_size)
+            f.write(new_moov)
+            f.flush()
+            f.seek(moov_start + 4)
+            f.write(b"free")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+# --- Matroska / WebM ---------------------------------------------------------------
+
+EBML_ID_SEGMENT = 0x18538067
+EBML_ID_SEEKHEAD = 0x114D9B74
+EBML_ID_SEEK = 0x4DBB
+EBML_ID_SEEKID = 0x53AB
+EBML_ID_SEEKPOSITION = 0x53AC
+EBML_ID_CLUSTER = 0x1F43B675
+EBML_ID_TAGS = 0x1254C367
+EBML_ID_TAG = 0x7373
+EBML_ID_TARGETS = 0x63C0
+EBML_ID_SIMPLETAG = 0x67C8
+EBML_ID_TAGNAME = 0x45A3
+EBML_ID_TAGSTRING = 0x4487
+EBML_ID_VOID = 0xEC
+EBML_ID_CRC32 = 0xBF
+# Target UIDs restrict a Tag to a track, edition, chapter or attachment; a global Tag has none
+EBML_TARGET_UID_IDS = (0x63C5, 0x63C9, 0x63C4, 0x63C6)
+
+
+def _read_vint(data: bytes, offset: int, keep_marker: bool) -> Tuple[int, int]:
+    """Returns (value, length); unknown sizes (all value bits set) are returned as -1."""
+    first = data[offset]
+    length = 1
+    while length <= 8 and not first & (0x80 >> (length - 1)):
+        length += 1
+    if length > 8:
+        raise UnsupportedLayout("Invalid EBML variable-length integer.")
+    value = first if keep_marker else first & (0xFF >> length)
+    for byte in data[offset + 1:offset + length]:
+        value = (value << 8) | byte
+    if not keep_marker and value == (1 << (7 * length)) - 1:
+        return -1, length
+    return value, length
+
+
+def _encode_size(size: int, length: Optional[int] = None) -> bytes:
+    if length is None:
+        length = 1
+        while size >= (1 << (7 * length)) - 1:
+            length += 1
+    if length > 8 or size >= (1 << (7 * length)) - 1:
+        raise UnsupportedLayout("EBML size does not fit in the available width.")
+    return ((1 << (7 * length)) | size).to_bytes(length, "big")
+
+
+def _encode_id(element_id: int) -> bytes:
+    return element_id.to_bytes((element_id.bit_length() + 7) // 8, "big")
+
+
+def _element(element_id: int, payload: bytes) -> bytes:
+    return _encode_id(element_id) + _encode_size(len(payload)) + payload
+
+
+def _void(total_size: int) -> bytes:
+    """A Void element occupying exactly total_size bytes (at least 2)."""
+    if total_size < 2:
+        raise UnsupportedLayout("Cannot pad a single byte.")
+    if total_size - 2 < 127:
+        return bytes([EBML_ID_VOID]) + _encode_size(total_size - 2, 1) + b"\0" * (total_size - 2)
+    return bytes([EBML_ID_VOID]) + _encode_size(total_size - 9, 8) + b"\0" * (total_size - 9)
+
+
+def _ebml_children(data: bytes, start: int, end: int) -> List[Tuple[int, int, int, int]]:
+    """Lists (id, element_start, payload_start, element_end) within data[start:end]."""
+    elements = []
+    offset = start
+    while offset < end:
+        element_id, id_length = _read_vint(data, offset, keep_marker=True)
+        size, size_length = _read_vint(data, offset + id_length, keep_marker=False)
+        payload_start = offset + id_length + size_length
+        if size < 0 or payload_start + size > end:
+            raise UnsupportedLayout("Unknown-size or truncated EBML element in metadata.")
+        elements.append((element_id, offset, payload_start, payload_start + size))
+        offset = payload_start + size
+    return elements
+
+
+def _read_element_header(f, offset: int) -> Tuple[int, int, int, int]:
+    """Reads (id, size, header_length, size_field_length) of the element at offset."""
+    f.seek(offset)
+    header = f.read(12)
+    if len(header) < 2:
+        raise UnsupportedLayout("Truncated EBML element header.")
+    element_id, id_length = _read_vint(header, 0, keep_marker=True)
+    size, size_length = _read_vint(header, id_length, keep_marker=False)
+    return element_id, size, id_length + size_length, size_length
+
+
+def _rebuild_tags(data: bytes, tags_payload: Tuple[int, int], tags: Dict[str, str]) -> bytes:
+    """Rebuilds Tags with the global Tag updated; other Tags are copied unchanged."""
+    tag_elements = _ebml_children(data, *tags_payload) if tags_payload else []
+    remaining = {key.upper(): value for key, value in tags.items()}
+    new_tags = []
+    updated_global = False
+    for element in tag_elements:
+        element_id, start, payload_start, end = element
+        if element_id == EBML_ID_CRC32:
+            continue  # The checksum would no longer match
+        if element_id != EBML_ID_TAG or updated_global:
+            new_tags.append(data[start:end])
+            continue
+        children = _ebml_children(data, payload_start, end)
+        targets = next((c for c in children if c[0] == EBML_ID_TARGETS), None)
+        if targets and any(t[0] in EBML_TARGET_UID_IDS for t in _ebml_children(data, targets[2], targets[3])):
+            new_tags.append(data[start:end])
+            continue
+        parts = []
+        for child in children:
+            if child[0] == EBML_ID_CRC32:
+                continue
+            if child[0] == EBML_ID_SIMPLETAG:
+                simple_children = _ebml_children(data, child[2], child[3])
+                name = next((s for s in simple_children if s[0] == EBML_ID_TAGNAME), None)
+                tag_name = data[name[2]:name[3]].decode("utf-8", errors="replace").upper() if name else None
+                if tag_name in remaining:
+                    value = remaining.pop(tag_name).encode("utf-8")
+                    rebuilt = b"".join(
+                        _element(EBML_ID_TAGSTRING, value) if s[0] == EBML_ID_TAGSTRING else data[s[1]:s[3]]
+                        for s in simple_children
+                    )
+                    if not any(s[0] == EBML_ID_TAGSTRING for s in simple_children):
+                        rebuilt += _element(EBML_ID_TAGSTRING, value)
+                    parts.append(_element(EBML_ID_SIMPLETAG, rebuilt))
+                    continue
+            parts.append(data[child[1]:child[3]])
+        parts += [_simple_tag(name, value) for name, value in remaining.items()]
+        remaining = {}
+        new_tags.append(_element(EBML_ID_TAG, b"".join(parts)))
+        updated_global = True
+    if remaining:
+        new_tags.append(_element(EBML_ID_TAG, _element(EBML_ID_TARGETS, b"") + b"".join(
+            _simple_tag(name, value) for name, value in remaining.items()
+        )))
+    return _element(EBML_ID_TAGS, b"".join(new_tags))
+
+
+def _simple_tag(name: str, value: str) -> bytes:
+    return _element(EBML_ID_SIMPLETAG, _element(EBML_ID_TAGNAME, name.encode("utf-8")) + _element(EBML_ID_TAGSTRING, value.encode("utf-8")))
+
+
+def _edit_matroska(path: str, tags: Dict[str, str]) -> None:
+    with open(path, "r+b") as f:
+        file_size = os.fstat(f.fileno()).st_size
+        # Skip the EBML header to reach the Segment
+        _, header_size, header_length, _ = _read_element_header(f, 0)
+        segment_offset = header_length + header_size
+        segment_id, segment_size, segment_header_length, segment_size_length = _read_element_header(f, segment_offset)
+        if segment_id != EBML_ID_SEGMENT:
+            raise UnsupportedLayout("No Segment element after the EBML header.")
+        segment_data = segment_offset + segment_header_length
+        segment_end = file_size if segment_size < 0 else segment_data + segment_size
+        if segment_end > file_size:
+            raise UnsupportedLayout("Segment is truncated.")
+
+        # Walk level-1 elements by their headers; clusters are skipped, never read
+        level1 = []
+        offset = segment_data
+        while offset < segment_end:
+            element_id, size, header_length, size_length = _read_element_header(f, offset)
+            if size < 0:
+                raise UnsupportedLayout("Unknown-size element inside the Segment.")
+            level1.append((element_id, offset, offset + header_length, offset + header_length + size, size_length))
+            offset += header_length + size
+        tags_elements = [e for e in level1 if e[0] == EBML_ID_TAGS]
+        if len(tags_elements) > 1:
+            raise UnsupportedLayout("Multiple Tags elements.")
+        old_tags = tags_elements[0] if tags_elements else None
+
+        if old_tags:
+            f.seek(old_tags[2])
+            payload = f.read(old_tags[3] - old_tags[2])
+            new_tags = _rebuild_tags(payload, (0, len(payload)), tags)
+        else:
+            new_tags = _rebuild_tags(b"", None, tags)
+
+        if old_tags:
+            index = level1.index(old_tags)
+            slot_start, slot_end = old_tags[1], old_tags[3]
+            following = level1[index + 1] if index + 1 < len(level1) else None
+            if following and following[0] == EBML_ID_VOID:
+                slot_end = following[3]
+        else:
+            # Without Tags, only a Void ahead of the first Cluster is found by a linear parse
+            first_cluster = next((e[1] for e in level1 if e[0] == EBML_ID_CLUSTER), segment_end)
+            void = next((e for e in level1 if e[0] == EBML_ID_VOID and e[3] <= first_cluster and e[3] - e[1] >= len(new_tags)), None)
+            if void is None:
+                raise UnsupportedLayout("No Tags element and no Void padding large enough to hold one.")
+            slot_start, slot_end = void[1], void[3]
+        spare = slot_end - slot_start - len(new_tags)
+
+        if spare == 0 or spare >= 2:
+            f.seek(slot_start)
+            f.write(new_tags + (_void(spare) if spare else b""))
+        elif old_tags and slot_end == segment_end == file_size:
+            # Tags closes the file: rewrite it there and resize the Segment
+            if segment_size >= 0:
+                new_segment_size = slot_start + len(new_tags) - segment_data
+                size_field = _encode_size(new_segment_size, segment_size_length)
+            f.seek(slot_start)
+            f.write(new_tags)
+            f.truncate(slot_start + len(new_tags))
+            if segment_size >= 0:
+                f.seek(segment_offset + segment_header_length - segment_size_length)
+                f.write(size_field)
+        else:
+            if segment_end != file_size:
+                raise UnsupportedLayout("Segment does not end the file; cannot append relocated Tags.")
+            seekhead_offset, seekhead_bytes = _seekhead_update(f, level1, file_size - segment_data)
+            if segment_size >= 0:
+                size_field = _encode_size(file_size + len(new_tags) - segment_data, segment_size_length)
+            old_id_and_size = old_tags[2] - old_tags[1]
+            if old_id_and_size - 1 > 8:
+                raise UnsupportedLayout("Tags header too large to turn into Void.")
+            # Append and re-point first; only then retire the old element
+            f.seek(file_size)
+            f.write(new_tags)
+            f.seek(seekhead_offset)
+            f.write(seekhead_bytes)
+            if segment_size >= 0:
+                f.seek(segment_offset + segment_header_length - segment_size_length)
+                f.write(size_field)
+            f.flush()
+            void_size_length = old_id_and_size - 1
+            f.seek(old_tags[1])
+            f.write(bytes([EBML_ID_VOID]) + _encode_size(old_tags[3] - old_tags[1] - 1 - void_size_length, void_size_length))
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _seekhead_update(f, level1, new_position: int) -> Tuple[int, bytes]:
+    """
+    Returns (file offset, bytes) that point the SeekHead's Tags entry at new_position
+    (relative to the Segment data). Usually only the SeekPosition is overwritten; when
+    it is too narrow (ffmpeg sizes it for the original position), the whole SeekHead is
+    rewritten with 8-byte positions into the Void padding ffmpeg leaves after it.
+    """
+    for index, element in enumerate(level1):
+        if element[0] != EBML_ID_SEEKHEAD:
+            continue
+        f.seek(element[2])
+        data = f.read(element[3] - element[2])
+        seeks = _ebml_children(data, 0, len(data))
+        for seek in seeks:
+            if seek[0] != EBML_ID_SEEK:
+                continue
+            children = _ebml_children(data, seek[2], seek[3])
+            seek_id = next((c for c in children if c[0] == EBML_ID_SEEKID), None)
+            position = next((c for c in children if c[0] == EBML_ID_SEEKPOSITION), None)
+            if not (seek_id and position and data[seek_id[2]:seek_id[3]] == _encode_id(EBML_ID_TAGS)):
+                continue
+            width = position[3] - position[2]
+            if new_position < 1 << (8 * width):
+                return element[2] + position[2], new_position.to_bytes(width, "big")
+            slot_end = element[3]
+            following = level1[index + 1] if index + 1 < len(level1) else None
+            if following and following[0] == EBML_ID_VOID:
+                slot_end = following[3]
+            new_seekhead = _rebuild_seekhead(data, seeks, seek, new_position)
+            spare = slot_end - element[1] - len(new_seekhead)
+            if spare < 0 or spare == 1:
+                raise UnsupportedLayout("SeekHead entry for Tags is too narrow and there is no room to widen it.")
+            return element[1], new_seekhead + (_void(spare) if spare else b"")
+    raise UnsupportedLayout("Tags element is not referenced from a SeekHead.")
+
+
+def _rebuild_seekhead(data: bytes, seeks, tags_seek, tags_position: int) -> bytes:
+    """SeekHead with every SeekPosition 8 bytes wide and the Tags entry at tags_position."""
+    entries = []
+    for seek in seeks:
+        if seek[0] != EBML_ID_SEEK:
+            continue  # CRC-32 would no longer match; Void is dropped
+        parts = []
+        for child in _ebml_children(data, seek[2], seek[3]):
+            if child[0] == EBML_ID_SEEKPOSITION:
+                value = tags_position if seek is tags_seek else int.from_bytes(data[child[2]:child[3]], "big")
+                parts.append(_element(EBML_ID_SEEKPOSITION, value.to_bytes(8, "big")))
+            else:
+                parts.append(data[child[1]:child[3]])
+        entries.append(_element(EBML_ID_SEEK, b"".join(parts)))
+    return _element(EBML_ID_SEEKHEAD, b"".join(entries))
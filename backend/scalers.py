@@ -0,0 +1,268 @@
+"""
+Scaler backends for upscaling and benchmark-driven choice between them.
+
+A scaler is a libswscale algorithm (the `scale` filter, slice-threaded through its
+`threads` option) or a zimg filter (`zscale`, slice-threaded by the filter graph).
+Their speed and quality differ with the scale factor and the host, so each encode
+host is calibrated once:
+
+    python scalers.py --factors 2,4 --output-height 2160 [--reference clip.mp4]
+
+For every factor the reference is downscaled by that factor and upscaled back with
+every scaler; the output pixel rate and PSNR/SSIM against the reference are saved to
+SCALER_CALIBRATION_PATH. The "auto" scaler then picks the fastest scaler whose SSIM
+at the nearest calibrated factor meets the quality floor (by default: within
+SCALER_SSIM_TOLERANCE of the best scaler), and falls back to DEFAULT_SCALER on
+hosts that were never calibrated.
+
+Usage: python scalers.py [--reference PATH] [--factors 2,4] [--output-height 2160] [--seconds 2] [--runs 1] [--output PATH]
+"""
+import argparse
+import json
+import math
+import os
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import ffmpeg
+
+# Scaler name -> (filter, algorithm)
+SCALERS: Dict[str, Tuple[str, str]] = {
+    "bilinear": ("scale", "bilinear"),
+    "bicubic": ("scale", "bicubic"),
+    "spline": ("scale", "spline"),
+    "lanczos": ("scale", "lanczos"),
+    "zscale": ("zscale", "spline36"),
+    "zscale_lanczos": ("zscale", "lanczos"),
+}
+AUTO_SCALER = "auto"
+DEFAULT_SCALER = os.environ.get("UPSCALEFX_SCALER", "lanczos")
+SCALER_CALIBRATION_PATH = os.environ.get("UPSCALEFX_SCALER_CALIBRATION", "scaler_calibration.json")
+# Without an explicit quality floor, "auto" accepts scalers this close to the best SSIM
+SCALER_SSIM_TOLERANCE = float(os.environ.get("UPSCALEFX_SCALER_SSIM_TOLERANCE", "0.002"))
+# Slice threads per scale filter; 0 uses one per CPU
+FILTER_THREADS = int(os.environ.get("UPSCALEFX_FILTER_THREADS", "0"))
+
+CALIBRATION_FACTORS = (2.0, 4.0)
+CALIBRATION_OUTPUT_HEIGHT = 2160
+CALIBRATION_SECONDS = 2.0
+
+_calibration_cache: Dict[str, Any] = {"path": None, "mtime": None, "data": None}
+
+
+def filter_threads() -> int:
+    return FILTER_THREADS if FILTER_THREADS > 0 else (os.cpu_count() or 1)
+
+
+def scaler_names() -> List[str]:
+    return [AUTO_SCALER, *SCALERS]
+
+
+def validate_scaler(scaler: str, quality_floor: Optional[float] = None) -> str:
+    """Normalized scaler name; raises ValueError for unknown scalers or an invalid floor."""
+    name = (scaler or DEFAULT_SCALER).strip().lower()
+    if name != AUTO_SCALER and name not in SCALERS:
+        raise ValueError(f"Unsupported scaler: {scaler}. Supported scalers: {', '.join(scaler_names())}")
+    if quality_floor is not None and not 0 < quality_floor < 1:
+        raise ValueError("quality_floor is an SSIM and must be between 0 and 1.")
+    return name
+
+
+def scaler_filter(scaler: str, width: Any, height: Any, threads: Optional[int] = None) -> str:
+    """Filter string scaling to width x height (numbers or filter expressions such as iw*2 or -2)."""
+    filter_name, algorithm = SCALERS[scaler]
+    if filter_name == "zscale":
+        # zscale is slice-threaded by the filter graph, which uses every CPU by default
+        return f"zscale=w={width}:h={height}:filter={algorithm}"
+    return f"scale=w={width}:h={height}:flags={algorithm}:threads={threads or filter_threads()}"
+
+
+def load_calibration(path: str = SCALER_CALIBRATION_PATH) -> Optional[Dict[str, Any]]:
+    """The saved calibration, reread only when the file changes; None on uncalibrated hosts."""
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return None
+    if _calibration_cache["path"] != path or _calibration_cache["mtime"] != mtime:
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Could not read scaler calibration {path}: {str(e)}")
+            data = None
+        _calibration_cache.update(path=path, mtime=mtime, data=data)
+    return _calibration_cache["data"]
+
+
+def choose_scaler(scale_factor: float, quality_floor: Optional[float] = None, calibration: Optional[Dict[str, Any]] = None) -> str:
+    """
+    Fastest calibrated scaler whose SSIM at the calibrated factor nearest scale_factor
+    reaches quality_floor (default: the best SSIM minus SCALER_SSIM_TOLERANCE). When no
+    scaler reaches the floor, the one with the best SSIM.
+    """
+    calibration = load_calibration() if calibration is None else calibration
+    factors = (calibration or {}).get("factors") or {}
+    if scale_factor <= 0 or not factors:
+        return DEFAULT_SCALER if DEFAULT_SCALER in SCALERS else "lanczos"
+    # Nearest on a log scale, so 3x is as close to 2x as to 4.5x
+    nearest = min(factors, key=lambda factor: abs(math.log(float(factor) / scale_factor)))
+    results = {name: result for name, result in factors[nearest].items() if name in SCALERS}
+    if not results:
+        return DEFAULT_SCALER if DEFAULT_SCALER in SCALERS else "lanczos"
+    best_ssim = max(result["ssim"] for result in results.values())
+    floor = quality_floor if quality_floor is not None else best_ssim - SCALER_SSIM_TOLERANCE
+    eligible = [name for name, result in results.items() if result["ssim"] >= floor]
+    if not eligible:
+        return max(results, key=lambda name: results[name]["ssim"])
+    return max(eligible, key=lambda name: results[name]["mpix_per_second"])
+
+
+def resolve_scaler(scaler: str, scale_factor: float, quality_floor: Optional[float] = None) -> str:
+    """Concrete scaler for a request: scaler itself, or the calibrated choice for "auto"."""
+    name = validate_scaler(scaler, quality_floor)
+    if name == AUTO_SCALER:
+        return choose_scaler(scale_factor, quality_floor)
+    return name
+
+
+def _even(value: float) -> int:
+    return max(2, int(round(value / 2)) * 2)
+
+
+def _run_ffmpeg(args: List[str]) -> str:
+    result = subprocess.run(["ffmpeg", "-hide_banner", "-nostdin", "-y", *args], capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed: {result.stderr[-2000:]}")
+    return result.stderr
+
+
+def _timed_pass(input_path: str, video_filter: Optional[str], runs: int) -> float:
+    """Best real time of decoding input_path (through video_filter) into the null muxer."""
+    # ffmpeg's own timer leaves out process start-up, which would swamp short clips
+    args = ["-benchmark", "-i", input_path, *(["-vf", video_filter] if video_filter else []), "-f", "null", "-"]
+    best = math.inf
+    for _ in range(max(1, runs)):
+        match = re.search(r"rtime=([\d.]+)s", _run_ffmpeg(args))
+        if not match:
+            raise RuntimeError("Could not read the time of a calibration pass.")
+        best = min(best, float(match.group(1)))
+    return best
+
+
+def _measure_quality(low_path: str, reference_path: str, video_filter: str) -> Tuple[float, float]:
+    """(PSNR dB, SSIM) of low_path upscaled with video_filter against the reference."""
+    graph = f"[0:v]{video_filter},split[a][b];[1:v]split[c][d];[a][c]ssim;[b][d]psnr"
+    stderr = _run_ffmpeg(["-i", low_path, "-i", reference_path, "-lavfi", graph, "-f", "null", "-"])
+    ssim = re.search(r"SSIM .*All:([\d.]+)", stderr)
+    psnr = re.search(r"PSNR .*average:([\d.]+|inf)", stderr)
+    if not ssim or not psnr:
+        raise RuntimeError("Could not read PSNR/SSIM of a calibration upscale.")
+    return float(psnr.group(1)), float(ssim.group(1))
+
+
+def _ffmpeg_version() -> str:
+    try:
+        return subprocess.run(["ffmpeg", "-version"], capture_output=True, text=True).stdout.splitlines()[0]
+    except (OSError, IndexError):
+        return "unknown"
+
+
+def calibrate(
+    reference: Optional[str] = None,
+    factors=CALIBRATION_FACTORS,
+    output_height: int = CALIBRATION_OUTPUT_HEIGHT,
+    seconds: float = CALIBRATION_SECONDS,
+    runs: int = 1,
+    scalers: Optional[List[str]] = None,
+) -> Dict[str, Any]:
+    """
+    Measures every scaler at every factor against a lossless reference of output_height
+    lines (taken from reference, or a synthetic test pattern) and returns the results.
+    Speed is the scaler's own time: a decode-only pass of the same input is subtracted.
+    """
+    names = scalers or list(SCALERS)
+    threads = filter_threads()
+    with tempfile.TemporaryDirectory(prefix="scaler_calibration_") as work_dir:
+        reference_path = os.path.join(work_dir, "reference.nut")
+        lossless = ["-an", "-sn", "-dn", "-pix_fmt", "yuv420p", "-c:v", "ffv1"]
+        if reference:
+            _run_ffmpeg(["-i", reference, "-t", str(seconds), "-vf", f"scale=w=-2:h={output_height}:flags=lanczos", *lossless, reference_path])
+        else:
+            width = _even(output_height * 16 / 9)
+            _run_ffmpeg(["-f", "lavfi", "-i", f"testsrc2=s={width}x{output_height}:r=30:d={seconds}", *lossless, reference_path])
+        stream = next(s for s in ffmpeg.probe(reference_path)["streams"] if s["codec_type"] == "video")
+        width, height = int(stream["width"]), int(stream["height"])
+        stderr = _run_ffmpeg(["-i", reference_path, "-f", "null", "-"])
+        frames = re.findall(r"frame=\s*(\d+)", stderr)
+        frame_count = int(frames[-1]) if frames else max(1, round(seconds * 30))
+
+        results: Dict[str, Dict[str, Any]] = {}
+        for factor in factors:
+            # Raw frames, so decoding barely adds to the time of each scaler pass
+            low_path = os.path.join(work_dir, f"low_{factor:g}.nut")
+            _run_ffmpeg(["-i", reference_path, "-vf", f"scale=w={_even(width / factor)}:h={_even(height / factor)}:flags=area", "-an", "-pix_fmt", "yuv420p", "-c:v", "rawvideo", low_path])
+            decode_seconds = _timed_pass(low_path, None, runs)
+            factor_results = results.setdefault(f"{factor:g}", {})
+            for name in names:
+                video_filter = scaler_filter(name, width, height, threads)
+                scale_seconds = max(1e-3, _timed_pass(low_path, video_filter, runs) - decode_seconds)
+                psnr, ssim = _measure_quality(low_path, reference_path, video_filter)
+                factor_results[name] = {
+                    "fps": round(frame_count / scale_seconds, 2),
+                    "mpix_per_second": round(frame_count * width * height / scale_seconds / 1e6, 2),
+                    "psnr": round(psnr, 3),
+                    "ssim": round(ssim, 5),
+                }
+                print(f"{factor:g}x {name:>15}: {factor_results[name]['fps']:8.2f} fps  PSNR {psnr:6.2f} dB  SSIM {ssim:.5f}")
+            os.remove(low_path)
+
+    return {
+        "host": socket.gethostname(),
+        "cpus": os.cpu_count(),
+        "ffmpeg": _ffmpeg_version(),
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "reference": reference or "testsrc2",
+        "output_size": [width, height],
+        "frames": frame_count,
+        "threads": threads,
+        "factors": results,
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Measure speed and quality of every upscaling scaler on this host.")
+    parser.add_argument("--reference", default=None, help="Reference clip (real footage is best); a test pattern when omitted")
+    parser.add_argument("--factors", default=",".join(f"{f:g}" for f in CALIBRATION_FACTORS), help="Comma-separated scale factors")
+    parser.add_argument("--output-height", type=int, default=CALIBRATION_OUTPUT_HEIGHT, help="Height of the upscaled output")
+    parser.add_argument("--seconds", type=float, default=CALIBRATION_SECONDS, help="Length of the reference used")
+    parser.add_argument("--runs", type=int, default=1, help="Timed runs per scaler; the fastest counts")
+    parser.add_argument("--scalers", default=None, help=f"Comma-separated subset of: {', '.join(SCALERS)}")
+    parser.add_argument("--output", default=SCALER_CALIBRATION_PATH, help="Where the calibration is saved")
+    args = parser.parse_args(argv)
+
+    try:
+        factors = [float(f) for f in args.factors.split(",") if f.strip()]
+        names = [validate_scaler(s) for s in args.scalers.split(",")] if args.scalers else None
+    except ValueError as e:
+        parser.error(str(e))
+    if not factors or any(f <= 1 for f in factors):
+        parser.error("Scale factors must be greater than 1.")
+    if names and AUTO_SCALER in names:
+        parser.error("The auto scaler cannot be calibrated.")
+
+    calibration = calibrate(args.reference, factors, args.output_height, args.seconds, args.runs, names)
+    with open(args.output, "w") as f:
+        json.dump(calibration, f, indent=2)
+    print(f"Saved scaler calibration to {args.output}.")
+    for factor in calibration["factors"]:
+        print(f"auto at {factor}x: {choose_scaler(float(factor), calibration=calibration)}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,148 @@
+"""
+Checkpointed encoding of long videos in keyframe-aligned segments.
+
+The video stream is encoded one segment (about SEGMENT_SECONDS, cut at source
+keyframes) at a time, and each finished segment is handed to a checkpoint that can
+persist it. When an interrupted job runs again, segments the checkpoint already holds
+are reused, so a crash or restart only costs the segment that was in progress. The
+segments are finally joined with the concat demuxer (packets copied) and muxed with
+the input's other streams according to the stream plan.
+"""
+import os
+import shutil
+from typing import Any, Dict, List, Optional, Tuple
+
+import ffmpeg
+
+import media_index
+
+SEGMENT_SECONDS = float(os.environ.get("UPSCALEFX_SEGMENT_SECONDS", "60"))
+# NUT keeps the encoder's exact timestamps for any codec; segments never leave the worker
+SEGMENT_EXTENSION = ".nut"
+
+
+class SegmentCheckpoint:
+    """Where finished segments are kept between runs. This base class keeps nothing."""
+
+    def load(self, index: int, start: float, end: Optional[float]) -> Optional[str]:
+        """Path of the finished segment index covering [start, end), or None."""
+        return None
+
+    def save(self, index: int, start: float, end: Optional[float], path: str, progress: float) -> None:
+        """Persists a finished segment; progress is the share of segments done (0-1)."""
+
+
+def plan_segments(keyframe_times: List[float], duration: float, segment_seconds: float = SEGMENT_SECONDS) -> List[Tuple[float, Optional[float]]]:
+    """
+    Splits [0, duration) into (start, end) ranges of at least segment_seconds that
+    begin on keyframes; the last range has end None (to the end of the input).
+    """
+    boundaries = [0.0]
+    for time in keyframe_times:
+        if time >= boundaries[-1] + segment_seconds and (not duration or time < duration):
+            boundaries.append(time)
+    return [(start, end) for start, end in zip(boundaries, boundaries[1:] + [None])]
+
+
+def encode_segment(
+    input_path: str,
+    output_path: str,
+    stream_index: int,
+    start: float,
+    end: Optional[float],
+    encoder: Optional[str],
+    video_filter: Optional[str] = None,
+    video_options: Optional[Dict[str, Any]] = None,
+) -> str:
+    """Encodes [start, end) of one video stream, without other streams, to output_path."""
+    # Decoding starts at the segment's keyframe, so the input seek is exact and cheap
+    source = ffmpeg.input(input_path, ss=start) if start else ffmpeg.input(input_path)
+    options: Dict[str, Any] = dict(video_options or {})
+    if encoder:
+        options["vcodec"] = encoder
+    if video_filter:
+        options["vf"] = video_filter
+    if end is not None:
+        # Frames at or after end belong to the next segment
+        options["t"] = end - start
+    ffmpeg.run(ffmpeg.output(source[str(stream_index)], output_path, an=None, sn=None, dn=None, **options), overwrite_output=True, quiet=True)
+    return output_path
+
+
+def join_segments(
+    input_path: str,
+    segment_paths: List[str],
+    segments: List[Tuple[float, Optional[float]]],
+    output_path: str,
+    plan: List[Dict[str, Any]],
+) -> str:
+    """Muxes the concatenated video segments with the input's other planned streams."""
+    list_path = f"{output_path}.segments.txt"
+    with open(list_path, "w") as f:
+        for path, (start, end) in zip(segment_paths, segments):
+            escaped = os.path.abspath(path).replace("'", "'\\''")
+            f.write(f"file '{escaped}'\n")
+            if end is not None:
+                # The demuxer would otherwise end a segment at its last frame's timestamp,
+                # overlapping the next segment's first frame
+                f.write(f"duration {end - start:.6f}\n")
+    try:
+        video = ffmpeg.input(list_path, f="concat", safe=0)
+        source = ffmpeg.input(input_path)
+        streams = []
+        kwargs: Dict[str, Any] = {}
+        for entry in plan:
+            if entry["action"] == "drop":
+                continue
+            output_index = len(streams)
+            if entry["codec_type"] == "video" and entry["action"] == "encode":
+                streams.append(video["0"])
+                kwargs[f"c:{output_index}"] = "copy"
+                continue
+            streams.append(source[str(entry["index"])])
+            if entry["action"] == "copy":
+                kwargs[f"c:{output_index}"] = "copy"
+            elif entry["encoder"]:
+                kwargs[f"c:{output_index}"] = entry["encoder"]
+        ffmpeg.run(ffmpeg.output(*streams, output_path, **kwargs), overwrite_output=True, quiet=True)
+    finally:
+        os.remove(list_path)
+    return output_path
+
+
+def encode_planned(
+    input_path: str,
+    output_path: str,
+    plan: List[Dict[str, Any]],
+    checkpoint: SegmentCheckpoint,
+    video_filter: Optional[str] = None,
+    video_options: Optional[Dict[str, Any]] = None,
+    segment_seconds: float = SEGMENT_SECONDS,
+) -> str:
+    """
+    Segmented counterpart of running stream_planner.planned_output(): the encoded video
+    stream of the plan is produced segment by segment through checkpoint, every other
+    stream is taken from the input when the segments are joined.
+    """
+    video_entry = next((e for e in plan if e["codec_type"] == "video" and e["action"] == "encode"), None)
+    if video_entry is None:
+        raise ValueError("Segmented encoding needs a plan that encodes the video.")
+    index = media_index.build_index(input_path)
+    segments = plan_segments(list(index.keyframe_times), index.duration, segment_seconds)
+
+    work_dir = f"{os.path.splitext(output_path)[0]}_segments"
+    os.makedirs(work_dir, exist_ok=True)
+    try:
+        segment_paths = []
+        for number, (start, end) in enumerate(segments):
+            path = checkpoint.load(number, start, end)
+            if path is None:
+                path = encode_segment(
+                    input_path, os.path.join(work_dir, f"{number:05d}{SEGMENT_EXTENSION}"),
+                    video_entry["index"], start, end, video_entry["encoder"], video_filter, video_options
+                )
+                checkpoint.save(number, start, end, path, (number + 1) / len(segments))
+            segment_paths.append(path)
+        return join_segments(input_path, segment_paths, segments, output_path, plan)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
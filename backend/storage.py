@@ -0,0 +1,133 @@
+"""
+Job storage: where queued jobs read their inputs and leave their outputs.
+
+Objects are addressed by relative keys such as "inputs/<job_id>.mp4". Workers fetch
+a job's input to local scratch space, run the operation and put the output back, so
+the API tier and encode nodes only need to share the storage, not a disk.
+
+Backends, chosen by URL (UPSCALEFX_JOB_STORAGE):
+
+    file:///mnt/shared/upscalefx    a local or network-mounted directory
+    s3://bucket/prefix              S3 or a compatible store (needs `boto3`;
+                                    UPSCALEFX_S3_ENDPOINT_URL for non-AWS endpoints)
+"""
+import os
+import shutil
+import uuid
+from abc import ABC, abstractmethod
+from typing import Optional
+
+from file_serving import resolve_within
+
+JOB_STORAGE_URL = os.environ.get("UPSCALEFX_JOB_STORAGE", "file://job_storage")
+
+
+class Storage(ABC):
+    """Interface of the storage backends."""
+
+    @abstractmethod
+    def exists(self, key: str) -> bool:
+        """Whether an object is stored under key."""
+
+    @abstractmethod
+    def put(self, local_path: str, key: str) -> str:
+        """Stores the file at local_path under key, replacing any previous object. Returns key."""
+
+    @abstractmethod
+    def fetch(self, key: str, local_path: str) -> str:
+        """Copies the object at key to local_path; raises FileNotFoundError. Returns local_path."""
+
+    @abstractmethod
+    def delete(self, key: str) -> None:
+        """Removes the object at key, if any."""
+
+    def local_path(self, key: str) -> Optional[str]:
+        """A path the object can be read from in place, or None when it has to be fetched."""
+        return None
+
+
+class FileSystemStorage(Storage):
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return resolve_within(self.root, key)
+
+    def exists(self, key):
+        return os.path.isfile(self._path(key))
+
+    def put(self, local_path, key):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            # Same filesystem: a hard link stores the object without copying it
+            os.link(local_path, tmp_path)
+        except OSError:
+            shutil.copyfile(local_path, tmp_path)
+        # Readers never see a partially written object
+        os.replace(tmp_path, path)
+        return key
+
+    def fetch(self, key, local_path):
+        path = self._path(key)
+        if not os.path.isfile(path):
+            raise FileNotFoundError(f"Stored object not found: {key}")
+        shutil.copyfile(path, local_path)
+        return local_path
+
+    def delete(self, key):
+        path = self._path(key)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def local_path(self, key):
+        path = self._path(key)
+        return path if os.path.isfile(path) else None
+
+
+class S3Storage(Storage):
+    def __init__(self, bucket: str, prefix: str = "", endpoint_url: Optional[str] = None):
+        try:
+            import boto3
+        except ImportError:
+            raise RuntimeError("The boto3 package is required for s3:// job storage.")
+        self.client = boto3.client("s3", endpoint_url=endpoint_url)
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+
+    def _object_key(self, key: str) -> str:
+        if key.startswith("/") or ".." in key.split("/"):
+            raise FileNotFoundError(f"Path not found: {key}")
+        return f"{self.prefix}/{key}" if self.prefix else key
+
+    def exists(self, key):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self._object_key(key))
+            return True
+        except self.client.exceptions.ClientError:
+            return False
+
+    def put(self, local_path, key):
+        self.client.upload_file(local_path, self.bucket, self._object_key(key))
+        return key
+
+    def fetch(self, key, local_path):
+        if not self.exists(key):
+            raise FileNotFoundError(f"Stored object not found: {key}")
+        self.client.download_file(self.bucket, self._object_key(key), local_path)
+        return local_path
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self._object_key(key))
+
+
+def open_storage(url: str = JOB_STORAGE_URL) -> Storage:
+    """Opens the storage backend named by url (see the module docstring)."""
+    if url.startswith("file://"):
+        return FileSystemStorage(url[len("file://"):])
+    if url.startswith("s3://"):
+        bucket, _, prefix = url[len("s3://"):].partition("/")
+        return S3Storage(bucket, prefix, endpoint_url=os.environ.get("UPSCALEFX_S3_ENDPOINT_URL"))
+    raise ValueError(f"Unsupported job storage URL: {url}. Use file:// or s3://.")
@@ -0,0 +1,176 @@
+"""
+Per-stream copy/encode planning for ffmpeg outputs.
+
+Given the probed streams of an input and the target container, each stream is
+planned as "copy" (the container can hold its codec and the operation does not
+touch it), "encode" (it must change) or "drop" (the target cannot carry it).
+A container-only conversion therefore becomes a pure remux, and operations that
+filter the video leave audio and subtitles as they are.
+"""
+import os
+from typing import Any, Dict, List, Optional
+
+import ffmpeg
+
+# Codecs each container can hold; None means the container accepts any codec of that type
+CONTAINER_CODECS: Dict[str, Dict[str, Optional[set]]] = {
+    "mp4": {
+        "video": {"h264", "hevc", "av1", "vp9", "mpeg4", "mpeg2video", "mjpeg", "png"},
+        "audio": {"aac", "mp3", "ac3", "eac3", "opus", "flac", "alac"},
+        "subtitle": {"mov_text"},
+    },
+    "mov": {
+        "video": {"h264", "hevc", "prores", "mpeg4", "mpeg2video", "mjpeg", "png", "dnxhd"},
+        "audio": {"aac", "mp3", "ac3", "eac3", "alac", "pcm_s16le", "pcm_s24le", "pcm_f32le"},
+        "subtitle": {"mov_text"},
+    },
+    "mkv": {
+        "video": None,
+        "audio": None,
+        "subtitle": {"subrip", "ass", "ssa", "webvtt", "hdmv_pgs_subtitle", "dvd_subtitle", "dvb_subtitle"},
+    },
+    "webm": {
+        "video": {"vp8", "vp9", "av1"},
+        "audio": {"opus", "vorbis"},
+        "subtitle": {"webvtt"},
+    },
+    "avi": {
+        "video": {"mpeg4", "h264", "mjpeg", "msmpeg4v3"},
+        "audio": {"mp3", "ac3", "pcm_s16le"},
+        "subtitle": set(),
+    },
+    "flv": {
+        "video": {"h264", "flv1"},
+        "audio": {"aac", "mp3"},
+        "subtitle": set(),
+    },
+}
+
+# Encoders used when a stream has to be re-encoded for a container (ffmpeg's own defaults)
+DEFAULT_ENCODERS: Dict[str, Dict[str, Optional[str]]] = {
+    "mp4": {"video": "libx264", "audio": "aac", "subtitle": "mov_text"},
+    "mov": {"video": "libx264", "audio": "aac", "subtitle": "mov_text"},
+    "mkv": {"video": "libx264", "audio": "libvorbis", "subtitle": "srt"},
+    "webm": {"video": "libvpx-vp9", "audio": "libopus", "subtitle": "webvtt"},
+    "avi": {"video": "mpeg4", "audio": "libmp3lame", "subtitle": None},
+    "flv": {"video": "flv1", "audio": "libmp3lame", "subtitle": None},
+}
+
+# Subtitles that can be converted between formats; bitmap subtitles can only be copied
+TEXT_SUBTITLE_CODECS = {"subrip", "ass", "ssa", "webvtt", "mov_text", "text"}
+
+CONTAINER_ALIASES = {"m4v": "mp4", "m4a": "mp4", "qt": "mov", "mka": "mkv"}
+
+
+def container_for(path: str) -> str:
+    """
+    Container name for an output path, as used in CONTAINER_CODECS. Containers missing
+    from the table are planned conservatively: nothing is copied and ffmpeg picks encoders.
+    """
+    extension = os.path.splitext(path)[1].lower().lstrip(".") or "mp4"
+    return CONTAINER_ALIASES.get(extension, extension)
+
+
+def probe_streams(input_path: str) -> List[Dict[str, Any]]:
+    try:
+        return ffmpeg.probe(input_path)["streams"]
+    except ffmpeg.Error as e:
+        raise ValueError(f"Error probing video file: {e.stderr.decode('utf8') if e.stderr else 'Unknown ffmpeg error'}")
+
+
+def _can_hold(container: str, codec_type: str, codec_name: str) -> bool:
+    if container not in CONTAINER_CODECS:
+        return False
+    allowed = CONTAINER_CODECS[container].get(codec_type, set())
+    return allowed is None or codec_name in allowed
+
+
+def plan_streams(streams: List[Dict[str, Any]], container: str, transform_video: bool = False) -> List[Dict[str, Any]]:
+    """
+    Plans every input stream for the target container. With transform_video the first
+    real video stream is always encoded (it is being filtered) and other video
+    streams are dropped; everything else is copied whenever the container allows it.
+    Each entry has the input "index", "codec_type", "codec_name", "action"
+    ("copy", "encode" or "drop"), the "encoder" for encoded streams (None leaves the
+    choice to ffmpeg) and a "reason".
+    """
+    encoders = DEFAULT_ENCODERS.get(container, {"video": None, "audio": None, "subtitle": None})
+    primary_video = next(
+        (s["index"] for s in streams if s.get("codec_type") == "video" and not s.get("disposition", {}).get("attached_pic")),
+        None,
+    )
+    if primary_video is None:
+        raise ValueError("No video stream found")
+
+    plan = []
+    for stream in streams:
+        codec_type = stream.get("codec_type")
+        codec_name = stream.get("codec_name", "")
+        entry = {"index": stream["index"], "codec_type": codec_type, "codec_name": codec_name, "encoder": None}
+        compatible = codec_type in ("video", "audio", "subtitle") and _can_hold(container, codec_type, codec_name)
+
+        if codec_type == "video" and stream.get("disposition", {}).get("attached_pic"):
+            # Cover art is never worth encoding into a video track
+            entry.update(action="copy" if compatible else "drop", reason="cover art")
+        elif codec_type == "video" and transform_video:
+            if stream["index"] == primary_video:
+                # Filtered video stays H.264 wherever the container allows it
+                encoder = encoders["video"] if container in CONTAINER_CODECS and not _can_hold(container, "video", "h264") else "libx264"
+                entry.update(action="encode", encoder=encoder, reason="video is being filtered")
+            else:
+                entry.update(action="drop", reason="only the first video stream is processed")
+        elif compatible:
+            entry.update(action="copy", reason=f"{container} can hold {codec_name}")
+        elif codec_type in ("video", "audio"):
+            entry.update(action="encode", encoder=encoders[codec_type], reason=f"{container} cannot hold {codec_name}")
+        elif codec_type == "subtitle" and codec_name in TEXT_SUBTITLE_CODECS and encoders["subtitle"]:
+            entry.update(action="encode", encoder=encoders["subtitle"], reason=f"{container} needs {encoders['subtitle']} subtitles")
+        elif codec_type == "attachment" and container == "mkv":
+            entry.update(action="copy", reason="mkv keeps attachments")
+        else:
+            entry.update(action="drop", reason=f"{container} cannot carry this {codec_type or 'unknown'} stream")
+        plan.append(entry)
+    return plan
+
+
+def is_remux(plan: List[Dict[str, Any]]) -> bool:
+    """True when no stream needs encoding, so the output is produced by copying packets only."""
+    return all(entry["action"] != "encode" for entry in plan)
+
+
+def describe_plan(plan: List[Dict[str, Any]]) -> str:
+    return ", ".join(
+        f"#{e['index']} {e['codec_type']}/{e['codec_name']}: {e['action']}{' -> ' + e['encoder'] if e['encoder'] else ''}"
+        for e in plan
+    )
+
+
+def planned_output(
+    input_path: str,
+    output_path: str,
+    plan: List[Dict[str, Any]],
+    video_filter: Optional[str] = None,
+    video_options: Optional[Dict[str, Any]] = None,
+    input_options: Optional[Dict[str, Any]] = None,
+    **output_options,
+):
+    """
+    Builds the ffmpeg output node for a plan: an explicit -map per kept stream and
+    per-output-stream codec options. video_filter and video_options (e.g. crf,
+    preset) only apply to encoded video streams; input_options (e.g. ss) go on the input.
+    """
+    source = ffmpeg.input(input_path, **(input_options or {}))
+    kept = [entry for entry in plan if entry["action"] != "drop"]
+    kwargs = dict(output_options)
+    for output_index, entry in enumerate(kept):
+        if entry["action"] == "copy":
+            kwargs[f"c:{output_index}"] = "copy"
+            continue
+        if entry["encoder"]:
+            kwargs[f"c:{output_index}"] = entry["encoder"]
+        if entry["codec_type"] == "video":
+            if video_filter:
+                kwargs[f"filter:{output_index}"] = video_filter
+            for key, value in (video_options or {}).items():
+                kwargs[f"{key}:{output_index}"] = value
+    return ffmpeg.output(*[source[str(entry["index"])] for entry in kept], output_path, **kwargs)
@@ -0,0 +1,150 @@
+import base64
+import hashlib
+import os
+import time
+
+import pytest
+
+import asset_store
+
+
+@pytest.fixture(autouse=True)
+def store_dirs(tmp_path, monkeypatch):
+    monkeypatch.setattr(asset_store, "ASSET_DIR", str(tmp_path / "assets"))
+    monkeypatch.setattr(asset_store, "UPLOAD_SESSION_DIR", str(tmp_path / "sessions"))
+
+
+def _digest(data):
+    return hashlib.sha256(data).digest()
+
+
+def _stored_bytes(asset_id):
+    with open(asset_store.get_asset(asset_id)["path"], "rb") as f:
+        return f.read()
+
+
+def _session_files(upload_id):
+    return sorted(name for name in os.listdir(asset_store.UPLOAD_SESSION_DIR) if name.startswith(upload_id))
+
+
+def test_overlapping_corrupt_chunk_leaves_stored_asset_intact():
+    data = b"A" * 4096
+    upload_id = asset_store.create_upload(len(data), "clip.mp4")["upload_id"]
+    good = asset_store.ChunkWriter(upload_id, 0)
+    bad = asset_store.ChunkWriter(upload_id, 0)
+    good.write(data)
+    state = good.commit(_digest(data))
+    assert state["complete"]
+    bad.write(b"B" * len(data))
+    with pytest.raises(asset_store.UploadChecksumError):
+        bad.commit(_digest(data))
+    assert _stored_bytes(state["asset_id"]) == data
+    assert asset_store.hash_file(asset_store.get_asset(state["asset_id"])["path"]) == state["asset_id"]
+
+
+def test_corrupt_retry_does_not_overwrite_received_bytes():
+    data = os.urandom(3000)
+    upload_id = asset_store.create_upload(len(data), "clip.mp4")["upload_id"]
+    asset_store.write_chunk(upload_id, 0, [data[:2000]], _digest(data[:2000]))
+    with pytest.raises(asset_store.UploadChecksumError):
+        asset_store.write_chunk(upload_id, 1000, [b"\0" * 2000], _digest(data[1000:]))
+    assert asset_store.get_upload(upload_id)["received"] == [[0, 2000]]
+    with open(os.path.join(asset_store.UPLOAD_SESSION_DIR, f"{upload_id}.part"), "rb") as f:
+        assert f.read(2000) == data[:2000]
+    # The overlapping retry with the right bytes completes the upload
+    state = asset_store.write_chunk(upload_id, 1000, [data[1000:]], _digest(data[1000:]))
+    assert state["complete"] and _stored_bytes(state["asset_id"]) == data
+    assert not [name for name in _session_files(upload_id) if name.endswith(".chunk")]
+
+
+def test_chunks_after_completion_are_refused():
+    data = b"x" * 100
+    upload_id = asset_store.create_upload(len(data), "clip.mp4")["upload_id"]
+    late = asset_store.ChunkWriter(upload_id, 0)
+    asset_store.write_chunk(upload_id, 0, [data])
+    late.write(b"y" * 100)
+    with pytest.raises(asset_store.UploadClosedError):
+        late.commit()
+    with pytest.raises(asset_store.UploadClosedError):
+        asset_store.ChunkWriter(upload_id, 0)
+    assert _stored_bytes(asset_store.get_upload(upload_id)["asset_id"]) == data
+
+
+@pytest.mark.parametrize("ranges, start, end, expected", [
+    ([], 0, 10, [[0, 10]]),
+    ([[0, 10]], 10, 20, [[0, 20]]),
+    ([[0, 10]], 20, 30, [[0, 10], [20, 30]]),
+    ([[0, 10], [20, 30]], 5, 25, [[0, 30]]),
+    ([[20, 30]], 0, 5, [[0, 5], [20, 30]]),
+    ([[0, 30]], 5, 10, [[0, 30]]),
+])
+def test_merge_range(ranges, start, end, expected):
+    assert asset_store._merge_range(ranges, start, end) == expected
+
+
+def test_parse_checksum_header():
+    digest = _digest(b"chunk")
+    assert asset_store.parse_checksum_header(f"sha256 {base64.b64encode(digest).decode()}") == digest
+    assert asset_store.parse_checksum_header(f"SHA256 {base64.b64encode(digest).decode()}") == digest
+    assert asset_store.parse_checksum_header(None) is None
+    assert asset_store.parse_checksum_header("") is None
+    for header in ("md5 AAAA", "sha256 not-base64!", f"sha256 {base64.b64encode(b'short').decode()}"):
+        with pytest.raises(ValueError):
+            asset_store.parse_checksum_header(header)
+
+
+def test_resume_reports_received_ranges_and_offset():
+    data = os.urandom(1000)
+    upload_id = asset_store.create_upload(len(data), "clip.mp4")["upload_id"]
+    asset_store.write_chunk(upload_id, 0, [data[:300]])
+    asset_store.write_chunk(upload_id, 600, [data[600:800]])
+    state = asset_store.get_upload(upload_id)
+    assert state["received"] == [[0, 300], [600, 800]]
+    assert state["offset"] == 300 and not state["complete"]
+    # A dropped chunk leaves no trace; resuming fills the gaps in any order
+    dropped = asset_store.ChunkWriter(upload_id, 300)
+    dropped.write(data[300:400])
+    dropped.close()
+    assert asset_store.get_upload(upload_id)["received"] == [[0, 300], [600, 800]]
+    asset_store.write_chunk(upload_id, 800, [data[800:]])
+    state = asset_store.write_chunk(upload_id, 300, [data[300:600]])
+    assert state["complete"] and state["asset_id"] == hashlib.sha256(data).hexdigest()
+    assert _stored_bytes(state["asset_id"]) == data
+
+
+def test_whole_file_hash_mismatch_resets_the_upload():
+    data = os.urandom(100)
+    upload_id = asset_store.create_upload(len(data), "clip.mp4", sha256="0" * 64)["upload_id"]
+    with pytest.raises(asset_store.UploadChecksumError):
+        asset_store.write_chunk(upload_id, 0, [data])
+    state = asset_store.get_upload(upload_id)
+    assert state["received"] == [] and not state["complete"]
+
+
+def test_known_content_is_deduplicated():
+    data = os.urandom(500)
+    first = asset_store.create_upload(len(data), "a.mp4")["upload_id"]
+    stored = asset_store.write_chunk(first, 0, [data])
+    assert not stored["deduplicated"]
+    # Announcing the hash skips the upload
+    skipped = asset_store.create_upload(len(data), "b.mp4", sha256=stored["asset_id"].upper())
+    assert skipped["complete"] and skipped["upload_id"] is None and skipped["asset_id"] == stored["asset_id"]
+    # Uploading the same bytes again stores them once
+    second = asset_store.create_upload(len(data), "c.mp4")["upload_id"]
+    again = asset_store.write_chunk(second, 0, [data])
+    assert again["deduplicated"] and again["asset_id"] == stored["asset_id"]
+    assert _stored_bytes(stored["asset_id"]) == data
+
+
+def test_declared_size_over_the_limit_is_rejected(monkeypatch):
+    monkeypatch.setattr(asset_store, "MAX_UPLOAD_BYTES", 1000)
+    with pytest.raises(asset_store.UploadTooLargeError):
+        asset_store.create_upload(1001, "clip.mp4")
+    assert not os.path.exists(asset_store.UPLOAD_SESSION_DIR) or not os.listdir(asset_store.UPLOAD_SESSION_DIR)
+
+
+def test_idle_sessions_expire():
+    upload_id = asset_store.create_upload(10, "clip.mp4")["upload_id"]
+    assert asset_store.expire_sessions(max_age=3600) == []
+    assert asset_store.expire_sessions(max_age=3600, now=time.time() + 7200) == [upload_id]
+    assert _session_files(upload_id) == []
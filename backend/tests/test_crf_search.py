@@ -0,0 +1,77 @@
+import math
+
+import pytest
+
+import crf_search
+
+DURATION = 12.0
+AUDIO_BITRATE = 128_000
+
+
+def _log_rate(crf):
+    # Convex like real encodes: bitrate climbs faster than exponentially at low CRFs
+    return 14.5 - 0.12 * crf + 0.002 * (crf - 30) ** 2
+
+
+def _ssim_db(crf):
+    return 30 - 0.4 * crf - 0.005 * (crf - 20) ** 2
+
+
+def _size(crf):
+    return (math.exp(_log_rate(crf)) + AUDIO_BITRATE) * DURATION / 8 / (1 - crf_search.MUXING_OVERHEAD)
+
+
+def _probe_samples(input_path, duration, measure_ssim=False, crfs=crf_search.PROBE_CRFS):
+    return [
+        {
+            "start": 0.0,
+            "length": duration,
+            "crf": crf,
+            "bytes": math.exp(_log_rate(crf)) * duration / 8,
+            **({"ssim": crf_search.db_to_ssim(_ssim_db(crf))} if measure_ssim else {}),
+        }
+        for crf in crfs
+    ]
+
+
+@pytest.fixture
+def probed(monkeypatch):
+    probed_crfs = []
+
+    def probe_samples(input_path, duration, measure_ssim=False, crfs=crf_search.PROBE_CRFS):
+        probed_crfs.extend(crfs)
+        return _probe_samples(input_path, duration, measure_ssim, crfs)
+
+    monkeypatch.setattr(crf_search, "probe_samples", probe_samples)
+    return probed_crfs
+
+
+def test_target_above_the_probes_is_not_extrapolated():
+    target = round(_size(15))
+    search = crf_search.choose_crf(_probe_samples("in.mp4", DURATION), DURATION, target_size_bytes=target, audio_bitrate=AUDIO_BITRATE)
+    assert search["crf"] == crf_search.PROBE_CRFS[0]
+    assert search["predicted_size_bytes"] <= target
+
+
+@pytest.mark.parametrize("crf", [10, 13.5, 15, 17, 21.3, 29, 35.9, 40, 47])
+def test_size_target_is_a_ceiling(probed, crf):
+    target = round(_size(crf))
+    search = crf_search.search_crf("in.mp4", DURATION, target_size_bytes=target, audio_bitrate=AUDIO_BITRATE)
+    assert search["predicted_size_bytes"] <= target
+    assert _size(search["crf"]) <= target
+    # Within a step of the CRF that meets the target exactly
+    assert search["crf"] - max(crf, crf_search.CRF_RANGE[0]) < 1.5
+    assert len(set(probed)) <= len(crf_search.PROBE_CRFS) + crf_search.EXTRA_PROBES
+
+
+def test_unreachable_size_target_gets_the_highest_crf(probed):
+    search = crf_search.search_crf("in.mp4", DURATION, target_size_bytes=round(_size(60)), audio_bitrate=AUDIO_BITRATE)
+    assert search["crf"] == crf_search.CRF_RANGE[1]
+
+
+@pytest.mark.parametrize("crf", [12.5, 16, 25.5, 33, 44])
+def test_ssim_target_is_a_floor(probed, crf):
+    target = round(crf_search.db_to_ssim(_ssim_db(crf)), 6)
+    search = crf_search.search_crf("in.mp4", DURATION, target_ssim=target)
+    assert search["predicted_ssim"] >= round(target, 5)
+    assert crf_search.db_to_ssim(_ssim_db(search["crf"])) >= target
@@ -0,0 +1,157 @@
+import os
+import threading
+import time
+
+import pytest
+
+import job_queue
+import storage
+import worker
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def queue(request, tmp_path):
+    if request.param == "memory":
+        return job_queue.MemoryJobQueue()
+    return job_queue.SQLiteJobQueue(str(tmp_path / "jobs.db"))
+
+
+def _expire(queue):
+    """Lets the lease of a running job lapse and sweeps it."""
+    time.sleep(0.02)
+    return queue.requeue_expired()
+
+
+def test_claims_oldest_job_first(queue):
+    ids = [queue.enqueue("compress", {"n": n}, {"key": f"inputs/{n}.mp4"})["job_id"] for n in range(3)]
+    claimed = [queue.claim("w1")["job_id"] for _ in ids]
+    assert claimed == ids
+    assert queue.claim("w1") is None
+    job = queue.get(ids[0])
+    assert job["status"] == "running" and job["worker_id"] == "w1" and job["attempts"] == 1
+    with pytest.raises(job_queue.JobNotFoundError):
+        queue.get("missing")
+
+
+def test_heartbeat_extends_the_lease(queue):
+    job_id = queue.enqueue("compress", {}, {"key": "inputs/a.mp4"})["job_id"]
+    queue.claim("w1", lease_seconds=0.01)
+    assert queue.heartbeat("w1", [job_id], lease_seconds=60) == [job_id]
+    assert _expire(queue) == []
+    assert queue.get(job_id)["status"] == "running"
+    # Another worker cannot extend a lease it does not hold
+    assert queue.heartbeat("w2", [job_id]) == []
+    assert {w["worker_id"]: w["jobs"] for w in queue.workers()} == {"w1": [job_id], "w2": []}
+
+
+def test_expired_jobs_are_requeued_until_attempts_run_out(queue):
+    job_id = queue.enqueue("compress", {}, {"key": "inputs/a.mp4"}, max_attempts=2)["job_id"]
+    queue.claim("w1", lease_seconds=0.01)
+    assert _expire(queue) == [job_id]
+    job = queue.get(job_id)
+    assert job["status"] == "queued" and job["worker_id"] is None and job["attempts"] == 1
+
+    assert queue.claim("w2", lease_seconds=0.01)["attempts"] == 2
+    assert _expire(queue) == [job_id]
+    job = queue.get(job_id)
+    assert job["status"] == "failed" and "gave up after 2 attempts" in job["error"]
+    assert queue.claim("w3") is None
+
+
+def test_reports_after_the_lease_is_lost_are_refused(queue):
+    job_id = queue.enqueue("compress", {}, {"key": "inputs/a.mp4"})["job_id"]
+    queue.claim("w1", lease_seconds=0.01)
+    _expire(queue)
+    queue.claim("w2")
+    segment = {"index": 0, "start": 0.0, "end": 10.0, "key": "segments/a/00000.mp4"}
+    assert not queue.save_segment(job_id, "w1", segment, 0.5)
+    assert not queue.complete(job_id, "w1", {"output_key": "outputs/a.mp4"})
+    assert not queue.fail(job_id, "w1", "late error")
+    assert queue.segments(job_id) == []
+
+    assert queue.save_segment(job_id, "w2", segment, 0.5)
+    assert queue.segments(job_id) == [segment]
+    assert queue.complete(job_id, "w2", {"output_key": "outputs/a.mp4"})
+    job = queue.get(job_id)
+    assert job["status"] == "complete" and job["progress"] == 1.0 and job["result"] == {"output_key": "outputs/a.mp4"}
+    # A finished job cannot be reported again
+    assert not queue.fail(job_id, "w2", "late error")
+
+
+def test_worker_runs_queued_jobs(tmp_path, monkeypatch):
+    monkeypatch.setattr(job_queue, "_memory_queue", None)
+    queue = job_queue.open_queue("memory://")
+    store = storage.open_storage(f"file://{tmp_path / 'storage'}")
+    source = tmp_path / "source.mp4"
+    source.write_bytes(b"video")
+    store.put(str(source), "inputs/a.mp4")
+    store.put(str(source), "inputs/b.mp4")
+    store.put(str(source), "assets/c.mp4")
+
+    def run_operation(operation, input_path, output_base, params, checkpoint=None):
+        if params.get("fail"):
+            raise ValueError("Unsupported codec.")
+        segment_path = f"{output_base}_00000.mp4"
+        with open(segment_path, "wb") as f:
+            f.write(b"segment")
+        checkpoint.save(0, 0.0, None, segment_path, 1.0)
+        with open(input_path, "rb") as f:
+            data = f.read()
+        with open(f"{output_base}.mp4", "wb") as f:
+            f.write(data.upper())
+        return f"{output_base}.mp4"
+
+    complete = queue.enqueue("compress", {}, {"key": "inputs/a.mp4", "temporary": True})["job_id"]
+    failed = queue.enqueue("compress", {"fail": True}, {"key": "inputs/b.mp4", "temporary": True})["job_id"]
+    asset = queue.enqueue("compress", {}, {"key": "assets/c.mp4"})["job_id"]
+    left = queue.enqueue("compress", {}, {"key": "assets/c.mp4"})["job_id"]
+
+    work_dir = tmp_path / "work"
+    runner = worker.Worker(queue, store, run_operation, concurrency=2, poll_seconds=0.01, work_dir=str(work_dir), daemon=True)
+    thread = threading.Thread(target=runner.run, kwargs={"max_jobs": 3}, daemon=True)
+    thread.start()
+    thread.join(timeout=30)
+    assert not thread.is_alive()
+
+    result = queue.get(complete)
+    assert result["status"] == "complete" and result["worker_id"] == runner.worker_id
+    output = tmp_path / "output.mp4"
+    store.fetch(result["result"]["output_key"], str(output))
+    assert output.read_bytes() == b"VIDEO" and result["result"]["size"] == 5
+    assert queue.get(failed)["status"] == "failed" and queue.get(failed)["error"] == "Unsupported codec."
+    assert queue.get(asset)["status"] == "complete"
+    assert queue.get(left)["status"] == "queued"
+    # Uploaded inputs and segments go once a job has its outcome; assets stay
+    assert not store.exists("inputs/a.mp4") and not store.exists("inputs/b.mp4")
+    assert store.exists("assets/c.mp4")
+    segments = queue.segments(complete)
+    assert segments and not any(store.exists(segment["key"]) for segment in segments)
+    assert os.listdir(work_dir) == []
+
+
+def test_worker_leaves_jobs_to_retry_when_storage_fails(tmp_path):
+    class UnavailableStorage(storage.FileSystemStorage):
+        def put(self, local_path, key):
+            if key.startswith("outputs/"):
+                raise ConnectionError("Storage unavailable.")
+            return super().put(local_path, key)
+
+    queue = job_queue.MemoryJobQueue()
+    store = UnavailableStorage(str(tmp_path / "storage"))
+    source = tmp_path / "source.mp4"
+    source.write_bytes(b"video")
+    store.put(str(source), "inputs/a.mp4")
+
+    def run_operation(operation, input_path, output_base, params, checkpoint=None):
+        with open(f"{output_base}.mp4", "wb") as f:
+            f.write(b"output")
+        return f"{output_base}.mp4"
+
+    job_id = queue.enqueue("compress", {}, {"key": "inputs/a.mp4", "temporary": True}, max_attempts=2)["job_id"]
+    runner = worker.Worker(queue, store, run_operation, work_dir=str(tmp_path / "work"), worker_id="w1")
+    runner.run_job(queue.claim("w1", lease_seconds=0.01))
+    # The job is neither failed nor its input deleted; it runs again once the lease lapses
+    assert queue.get(job_id)["status"] == "running"
+    assert store.exists("inputs/a.mp4")
+    assert _expire(queue) == [job_id]
+    assert queue.get(job_id)["status"] == "queued"
@@ -0,0 +1,98 @@
+import os
+import shutil
+import subprocess
+
+import pytest
+
+import metadata_editor
+
+pytestmark = pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="needs ffmpeg")
+
+# Each edit sets a longer title, so every one of them grows the metadata
+TITLES = ["a", "b" * 300, "c" * 600]
+
+
+def _ffmpeg(*args):
+    subprocess.run(["ffmpeg", "-hide_banner", "-loglevel", "error", "-nostdin", "-y", *args], check=True)
+
+
+def _make_clip(path, *output_args, seconds=4):
+    # Noise keeps the clusters large, so Matroska files pass the 64 KiB a 2-byte SeekPosition can address
+    _ffmpeg(
+        "-f", "lavfi", "-i", f"testsrc2=s=320x240:r=25:d={seconds},noise=alls=40:allf=t",
+        "-f", "lavfi", "-i", f"sine=d={seconds}",
+        "-metadata", "title=original", *output_args, path,
+    )
+    return path
+
+
+def _tags(path):
+    output = subprocess.run(
+        ["ffmpeg", "-hide_banner", "-loglevel", "error", "-nostdin", "-i", path, "-f", "ffmetadata", "-"],
+        capture_output=True, text=True, check=True,
+    ).stdout
+    # Matroska tag names are upper case; ffmpeg matches metadata keys case-insensitively
+    return {key.lower(): value for key, value in (line.split("=", 1) for line in output.splitlines() if "=" in line and not line.startswith(";"))}
+
+
+def _assert_plays(path):
+    result = subprocess.run(
+        ["ffmpeg", "-hide_banner", "-loglevel", "error", "-nostdin", "-i", path, "-f", "null", "-"],
+        capture_output=True, text=True,
+    )
+    assert result.returncode == 0 and not result.stderr.strip(), result.stderr
+
+
+def _edit_repeatedly(path):
+    """Applies every title in turn and returns the file size after each edit."""
+    sizes = []
+    for title in TITLES:
+        metadata_editor.edit_metadata_in_place(path, {"title": title, "artist": "someone"})
+        sizes.append(os.path.getsize(path))
+        _assert_plays(path)
+        tags = _tags(path)
+        assert tags.get("title") == title
+        assert tags.get("artist") == "someone"
+    return sizes
+
+
+def test_mp4_with_moov_last_is_rewritten_in_place(tmp_path):
+    path = _make_clip(str(tmp_path / "clip.mp4"))
+    original_size = os.path.getsize(path)
+    sizes = _edit_repeatedly(path)
+    # Only the tags themselves add to the file; no second moov is appended
+    assert sizes[-1] - original_size < len(TITLES[-1]) + 200
+
+
+def test_mp4_with_moov_first_relocates_once(tmp_path):
+    path = _make_clip(str(tmp_path / "clip.mp4"), "-movflags", "+faststart")
+    original_size = os.path.getsize(path)
+    sizes = _edit_repeatedly(path)
+    # The first growing edit appends moov; later ones rewrite it at the end
+    growth_after_first = sizes[-1] - sizes[0]
+    assert growth_after_first < len(TITLES[-1]) + 200
+    assert sizes[0] < original_size * 1.5
+
+
+def test_fragmented_mp4_is_left_untouched_when_moov_cannot_grow(tmp_path):
+    path = _make_clip(str(tmp_path / "clip.mp4"), "-movflags", "frag_keyframe+empty_moov")
+    with open(path, "rb") as f:
+        before = f.read()
+    with pytest.raises(metadata_editor.UnsupportedLayout):
+        metadata_editor.edit_metadata_in_place(path, {"title": TITLES[-1]})
+    with open(path, "rb") as f:
+        assert f.read() == before
+    _assert_plays(path)
+
+
+@pytest.mark.parametrize("extension, codecs", [
+    (".mkv", []),
+    (".webm", ["-c:v", "libvpx", "-b:v", "2M", "-c:a", "libopus"]),
+])
+def test_matroska_edits_stay_in_place(tmp_path, extension, codecs):
+    path = _make_clip(str(tmp_path / f"clip{extension}"), *codecs)
+    original_size = os.path.getsize(path)
+    assert original_size > 1 << 16
+    sizes = _edit_repeatedly(path)
+    # Tags move to the end once, then are rewritten there
+    assert sizes[-1] - original_size < 2 * len(TITLES[-1]) + 500
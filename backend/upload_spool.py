@@ -0,0 +1,367 @@
+"""
+Memory-bounded spooling of multipart uploads.
+
+Starlette spools every uploaded file into an anonymous temporary file, which the
+endpoints then copied into the upload directory, so each uploaded byte was written
+to disk twice. Routes using SpoolingRoute parse uploads into UploadSpool files
+instead:
+
+* A file stays in memory while it is at most MEMORY_FILE_BYTES and the memory budget
+  (MEMORY_BUDGET_BYTES, shared by in-memory uploads and inputs staged in SHM_DIR)
+  allows. When claimed it is written to SHM_DIR, which is RAM-backed, so ffmpeg reads
+  it without touching the disk. Each process stages into its own subdirectory named
+  by its pid, and sweep_stale_staging() removes those of processes that have died.
+* Anything else is written once, straight into SPOOL_DIR, and claimed by renaming it
+  to its final path.
+
+BodySizeLimitMiddleware answers request bodies over MAX_REQUEST_BYTES with 413, from
+the Content-Length header when there is one, otherwise as soon as the streamed body
+grows past the limit.
+"""
+import io
+import os
+import shutil
+import threading
+import uuid
+from typing import Any, Callable, List, Optional
+
+from fastapi import HTTPException, Request
+from fastapi.routing import APIRoute
+from starlette.datastructures import UploadFile
+from starlette.formparsers import MultiPartException, MultiPartParser, parse_options_header
+from starlette.responses import JSONResponse
+
+MB = 1024 * 1024
+# Largest accepted request body; 0 disables the limit
+MAX_REQUEST_BYTES = int(float(os.environ.get("UPSCALEFX_MAX_REQUEST_MB", "4096")) * MB)
+# Uploads up to this size may stay in memory
+MEMORY_FILE_BYTES = int(float(os.environ.get("UPSCALEFX_UPLOAD_MEMORY_FILE_MB", "16")) * MB)
+# Memory held by in-memory uploads of this process plus inputs staged in SHM_DIR
+MEMORY_BUDGET_BYTES = int(float(os.environ.get("UPSCALEFX_UPLOAD_MEMORY_MB", "256")) * MB)
+SHM_DIR = os.environ.get("UPSCALEFX_UPLOAD_SHM_DIR", "/dev/shm/upscalefx" if os.path.isdir("/dev/shm") else "")
+# Must be on the same filesystem as the endpoints' upload paths, so claiming is a rename
+SPOOL_DIR = os.environ.get("UPSCALEFX_UPLOAD_SPOOL_DIR", "temp_uploads")
+# Memory is reserved in steps, so the budget is not checked for every chunk
+RESERVE_STEP_BYTES = MB
+
+_memory_lock = threading.Lock()
+_memory_reserved = 0
+
+
+def _shm_usage() -> int:
+    if not SHM_DIR:
+        return 0
+    total = 0
+    for root, _, files in os.walk(SHM_DIR):
+        for name in files:
+            try:
+                total += os.stat(os.path.join(root, name)).st_size
+            except OSError:
+                # Removed while counting
+                pass
+    return total
+
+
+def _staging_dir() -> str:
+    return os.path.join(SHM_DIR, str(os.getpid()))
+
+
+def _process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Runs under another user
+        return True
+    return True
+
+
+def sweep_stale_staging() -> List[str]:
+    """
+    Removes what processes that are no longer running left in SHM_DIR, e.g. inputs
+    staged before a crash, which would otherwise hold memory until reboot. Returns
+    the removed paths.
+    """
+    if not SHM_DIR or not os.path.isdir(SHM_DIR):
+        return []
+    removed = []
+    for entry in os.scandir(SHM_DIR):
+        if entry.is_dir(follow_symlinks=False):
+            if entry.name.isdigit() and not _process_alive(int(entry.name)):
+                shutil.rmtree(entry.path, ignore_errors=True)
+                removed.append(entry.path)
+        else:
+            # Staged before inputs were kept in per-process directories
+            try:
+                os.remove(entry.path)
+                removed.append(entry.path)
+            except OSError:
+                pass
+    return removed
+
+
+def memory_in_use() -> int:
+    """Bytes held by in-memory uploads and staged inputs, as counted against MEMORY_BUDGET_BYTES."""
+    with _memory_lock:
+        reserved = _memory_reserved
+    return reserved + _shm_usage()
+
+
+def _reserve(size: int) -> bool:
+    global _memory_reserved
+    with _memory_lock:
+        if _memory_reserved + size + _shm_usage() > MEMORY_BUDGET_BYTES:
+            return False
+        _memory_reserved += size
+        return True
+
+
+def _release(size: int) -> None:
+    global _memory_reserved
+    with _memory_lock:
+        _memory_reserved = max(0, _memory_reserved - size)
+
+
+class UploadSpool:
+    """
+    File object of an UploadFile that keeps the upload in memory until it outgrows
+    its share of the memory budget, then continues in a file in SPOOL_DIR.
+    """
+
+    def __init__(self, spool_dir: str = SPOOL_DIR, memory_file_bytes: int = MEMORY_FILE_BYTES):
+        self.spool_dir = spool_dir
+        self.memory_file_bytes = memory_file_bytes
+        self.path: Optional[str] = None
+        self._file: Any = io.BytesIO()
+        self._reserved = 0
+        self._size = 0
+
+    @property
+    def _rolled(self) -> bool:
+        # Read by UploadFile: writes and reads of rolled files run in the threadpool
+        return self.path is not None
+
+    def _fits_in_memory(self, size: int) -> bool:
+        if size > self.memory_file_bytes:
+            return False
+        if size <= self._reserved:
+            return True
+        step = min(max(size - self._reserved, RESERVE_STEP_BYTES), self.memory_file_bytes - self._reserved)
+        if not _reserve(step):
+            return False
+        self._reserved += step
+        return True
+
+    def _release_memory(self) -> None:
+        _release(self._reserved)
+        self._reserved = 0
+
+    def rollover(self) -> None:
+        """Moves the upload from memory to its spool file (at most MEMORY_FILE_BYTES to copy)."""
+        if self._rolled:
+            return
+        os.makedirs(self.spool_dir, exist_ok=True)
+        path = os.path.join(self.spool_dir, f"{uuid.uuid4()}.upload")
+        disk_file = open(path, "w+b")
+        try:
+            disk_file.write(self._file.getbuffer())
+            disk_file.seek(self._file.tell())
+        except BaseException:
+            disk_file.close()
+            os.remove(path)
+            raise
+        self._file.close()
+        self._file, self.path = disk_file, path
+        self._release_memory()
+
+    def write(self, data: bytes) -> int:
+        if not self._rolled and not self._fits_in_memory(self._size + len(data)):
+            self.rollover()
+        written = self._file.write(data)
+        self._size = max(self._size, self._file.tell())
+        return written
+
+    def read(self, size: int = -1) -> bytes:
+        return self._file.read(size)
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        return self._file.seek(offset, whence)
+
+    def tell(self) -> int:
+        return self._file.tell()
+
+    def flush(self) -> None:
+        self._file.flush()
+
+    @property
+    def closed(self) -> bool:
+        return self._file.closed
+
+    def claim(self, path: str) -> str:
+        """
+        Hands the finished upload over as a file and returns its path: path itself for
+        spooled uploads, or a file of the same name under SHM_DIR for in-memory uploads
+        when it has room. The spool is closed afterwards; the caller owns the file.
+        """
+        if self._rolled:
+            self._file.close()
+            try:
+                os.replace(self.path, path)
+            except OSError:
+                # SPOOL_DIR on another filesystem than path
+                shutil.move(self.path, path)
+            self.path = None
+            return path
+        try:
+            return self._stage_from_memory(path)
+        finally:
+            self._file.close()
+            self._release_memory()
+
+    def _stage_from_memory(self, path: str) -> str:
+        data = self._file.getbuffer()
+        try:
+            if SHM_DIR:
+                staging_dir = _staging_dir()
+                os.makedirs(staging_dir, exist_ok=True)
+                # Docker mounts a small /dev/shm; a full one must not fail the request
+                if shutil.disk_usage(staging_dir).free > len(data) + RESERVE_STEP_BYTES:
+                    staged_path = os.path.join(staging_dir, os.path.basename(path))
+                    try:
+                        with open(staged_path, "wb") as f:
+                            f.write(data)
+                        return staged_path
+                    except OSError as e:
+                        print(f"Could not stage upload in {SHM_DIR}, writing it to disk: {str(e)}")
+                        if os.path.exists(staged_path):
+                            os.remove(staged_path)
+            with open(path, "wb") as f:
+                f.write(data)
+            return path
+        finally:
+            data.release()
+
+    def close(self) -> None:
+        """Discards an unclaimed upload."""
+        self._file.close()
+        self._release_memory()
+        if self.path is not None:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            self.path = None
+
+
+class SpoolingMultiPartParser(MultiPartParser):
+    """Starlette's multipart parser with every file part written to an UploadSpool."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.spools: List[UploadSpool] = []
+
+    def on_headers_finished(self) -> None:
+        super().on_headers_finished()
+        upload = self._current_part.file
+        if upload is not None:
+            # Replaces Starlette's spooled temporary file before any data reached it
+            upload.file.close()
+            upload.file = UploadSpool()
+            self.spools.append(upload.file)
+
+
+class SpoolingRequest(Request):
+    """Request whose multipart form uploads are parsed into UploadSpool files."""
+
+    async def _spooled_form(self, max_files: int, max_fields: int, max_part_size: int):
+        if self._form is None:
+            parser = SpoolingMultiPartParser(self.headers, self.stream(), max_files=max_files, max_fields=max_fields, max_part_size=max_part_size)
+            try:
+                self._form = await parser.parse()
+                # A file part cut off by a truncated body never made it into the form
+                in_form = {id(value.file) for _, value in self._form.multi_items() if isinstance(value, UploadFile)}
+                for spool in parser.spools:
+                    if id(spool) not in in_form:
+                        spool.close()
+            except BaseException as e:
+                for spool in parser.spools:
+                    spool.close()
+                if isinstance(e, MultiPartException):
+                    raise HTTPException(status_code=400, detail=e.message)
+                raise
+        return self._form
+
+    def form(self, *, max_files: int = 1000, max_fields: int = 1000, max_part_size: int = 1024 * 1024):
+        content_type, _ = parse_options_header(self.headers.get("Content-Type"))
+        if content_type != b"multipart/form-data":
+            return super().form(max_files=max_files, max_fields=max_fields, max_part_size=max_part_size)
+        return self._spooled_form(max_files, max_fields, max_part_size)
+
+
+class SpoolingRoute(APIRoute):
+    """Route class (app.router.route_class) that hands endpoints a SpoolingRequest."""
+
+    def get_route_handler(self) -> Callable:
+        handler = super().get_route_handler()
+
+        async def spooling_route_handler(request: Request):
+            return await handler(SpoolingRequest(request.scope, request.receive))
+
+        return spooling_route_handler
+
+
+def stage_upload(file: Any, path: str) -> str:
+    """
+    Makes an uploaded file available to ffmpeg and returns its path: claimed from an
+    UploadSpool, or copied to path from any other file object.
+    """
+    if isinstance(file, UploadSpool):
+        return file.claim(path)
+    with open(path, "wb") as buffer:
+        shutil.copyfileobj(file, buffer)
+    return path
+
+
+class BodySizeLimitMiddleware:
+    """ASGI middleware answering request bodies larger than max_bytes with 413."""
+
+    def __init__(self, app, max_bytes: int = MAX_REQUEST_BYTES):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or self.max_bytes <= 0:
+            await self.app(scope, receive, send)
+            return
+        detail = f"Request body exceeds the limit of {self.max_bytes / MB:g} MB."
+        content_length = dict(scope["headers"]).get(b"content-length")
+        if content_length is not None and content_length.isdigit() and int(content_length) > self.max_bytes:
+            await JSONResponse({"detail": detail}, status_code=413)(scope, receive, send)
+            return
+
+        state = {"received": 0, "exceeded": False, "started": False, "replaced": False}
+
+        async def limited_receive():
+            message = await receive()
+            if message["type"] == "http.request":
+                state["received"] += len(message.get("body", b""))
+                if state["received"] > self.max_bytes:
+                    state["exceeded"] = True
+                    raise HTTPException(status_code=413, detail=detail)
+            return message
+
+        async def guarded_send(message):
+            if message["type"] == "http.response.start" and not state["started"]:
+                state["started"] = True
+                # Endpoints that catch every error would otherwise answer 400 or 500
+                state["replaced"] = state["exceeded"]
+                if state["replaced"]:
+                    await JSONResponse({"detail": detail}, status_code=413)(scope, receive, send)
+            if not state["replaced"]:
+                await send(message)
+
+        try:
+            await self.app(scope, limited_receive, guarded_send)
+        except HTTPException:
+            if not state["exceeded"] or state["started"]:
+                raise
+            await JSONResponse({"detail": detail}, status_code=413)(scope, receive, send)
@@ -0,0 +1,285 @@
+"""
+Standalone encode worker for queued jobs.
+
+A worker claims jobs from the shared queue (job_queue.py), fetches each input from
+job storage (storage.py) into local scratch space, runs the operation exactly as the
+API would and puts the output back into storage. A heartbeat thread keeps the leases
+of its running jobs alive and re-queues jobs whose workers have died. A job fails
+only on errors from its operation; when job storage or the queue cannot be reached
+the worker drops the job, which runs again once its lease lapses. Encode nodes can
+therefore be added or removed without touching the API tier:
+
+    python worker.py --queue redis://queue-host:6379/0 --storage s3://media/upscalefx --concurrency 2
+
+Usage: python worker.py [--queue URL] [--storage URL] [--concurrency N] [--worker-id ID] [--max-jobs N]
+"""
+import argparse
+import os
+import shutil
+import socket
+import sys
+import threading
+import uuid
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+import job_queue
+import segmented_encode
+import storage as job_storage
+
+WORK_DIR = os.environ.get("UPSCALEFX_WORKER_DIR", "temp_worker")
+# Seconds an idle worker waits before polling the queue again
+POLL_SECONDS = float(os.environ.get("UPSCALEFX_WORKER_POLL_SECONDS", "1"))
+
+
+class LeaseLostError(Exception):
+    """The job was re-queued while this worker ran it."""
+
+
+class InfrastructureError(Exception):
+    """Job storage or the queue failed while a job ran; the job is retried once its lease lapses."""
+
+
+class JobCheckpoint(segmented_encode.SegmentCheckpoint):
+    """Keeps a job's finished segments in job storage and records them with the job."""
+
+    def __init__(self, queue: job_queue.JobQueue, storage: job_storage.Storage, job: Dict[str, Any], worker_id: str, scratch_dir: str):
+        self.queue = queue
+        self.storage = storage
+        self.job_id = job["job_id"]
+        self.worker_id = worker_id
+        self.scratch_dir = scratch_dir
+        self.finished = {segment["index"]: segment for segment in queue.segments(self.job_id)}
+
+    def load(self, index, start, end):
+        segment = self.finished.get(index)
+        # Segments planned differently by an earlier attempt (e.g. another segment length) are redone
+        if segment is None or segment["start"] != start or segment["end"] != end:
+            return None
+        try:
+            path = self.storage.local_path(segment["key"])
+            if path is not None:
+                return path
+            return self.storage.fetch(segment["key"], os.path.join(self.scratch_dir, os.path.basename(segment["key"])))
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            raise InfrastructureError(f"Could not fetch segment {index}: {str(e)}") from e
+
+    def save(self, index, start, end, path, progress):
+        key = f"segments/{self.job_id}/{index:05d}{os.path.splitext(path)[1]}"
+        segment = {"index": index, "start": start, "end": end, "key": key}
+        try:
+            self.storage.put(path, key)
+            held = self.queue.save_segment(self.job_id, self.worker_id, segment, progress)
+        except Exception as e:
+            raise InfrastructureError(f"Could not record segment {index}: {str(e)}") from e
+        if not held:
+            raise LeaseLostError(f"Job {self.job_id} was re-queued; stopping after segment {index}.")
+        self.finished[index] = segment
+
+
+class Worker:
+    """
+    Runs jobs with run_operation(operation, input_path, output_base, params, checkpoint),
+    which returns the output path (main.run_operation in production).
+    """
+
+    def __init__(
+        self,
+        queue: job_queue.JobQueue,
+        storage: job_storage.Storage,
+        run_operation: Callable[..., str],
+        concurrency: int = 1,
+        worker_id: Optional[str] = None,
+        lease_seconds: float = job_queue.LEASE_SECONDS,
+        poll_seconds: float = POLL_SECONDS,
+        work_dir: str = WORK_DIR,
+        daemon: bool = False,
+    ):
+        self.queue = queue
+        self.storage = storage
+        self.run_operation = run_operation
+        self.concurrency = max(1, concurrency)
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self.lease_seconds = lease_seconds
+        self.poll_seconds = poll_seconds
+        self.work_dir = work_dir
+        # Daemon job threads do not hold up interpreter exit; their jobs resume elsewhere
+        self.daemon = daemon
+        self.stop_event = threading.Event()
+        self._running: Set[str] = set()
+        self._running_lock = threading.Lock()
+        self._jobs_left: Optional[int] = None
+
+    def _take_job_slot(self) -> bool:
+        with self._running_lock:
+            if self._jobs_left is None:
+                return True
+            if self._jobs_left <= 0:
+                return False
+            self._jobs_left -= 1
+            return True
+
+    def _heartbeat_loop(self) -> None:
+        # Several beats per lease, so one slow round trip does not cost a job its lease
+        while not self.stop_event.wait(self.lease_seconds / 4):
+            self.beat()
+
+    def beat(self) -> None:
+        with self._running_lock:
+            running = list(self._running)
+        try:
+            held = set(self.queue.heartbeat(self.worker_id, running, self.lease_seconds))
+            for job_id in set(running) - held:
+                print(f"Worker {self.worker_id} lost the lease of job {job_id}; its result will be discarded.")
+            # Every live worker sweeps up after dead ones
+            for job_id in self.queue.requeue_expired():
+                job = self.queue.get(job_id)
+                if job["status"] == "failed":
+                    print(f"Job {job_id} failed: {job['error']}")
+                    self.delete_job_files(job)
+                else:
+                    print(f"Re-queued job {job_id} after its worker stopped responding.")
+        except Exception as e:
+            print(f"Error during worker heartbeat: {str(e)}")
+
+    def delete_job_files(self, job: Dict[str, Any]) -> None:
+        """Deletes a finished or failed job's segments and, if it was uploaded for the job, its input."""
+        for segment in self.queue.segments(job["job_id"]):
+            self.storage.delete(segment["key"])
+        if job["input"].get("temporary"):
+            self.storage.delete(job["input"]["key"])
+
+    def _prepare(self, job: Dict[str, Any], scratch_dir: str) -> Tuple[str, JobCheckpoint]:
+        """
+        Makes a job's input readable locally and loads its finished segments. A missing
+        input is the job's own error; any other storage or queue error is retried.
+        """
+        input_ref = job["input"]
+        try:
+            input_path = self.storage.local_path(input_ref["key"])
+            if input_path is None:
+                input_path = self.storage.fetch(input_ref["key"], os.path.join(scratch_dir, f"input{os.path.splitext(input_ref['key'])[1]}"))
+            return input_path, JobCheckpoint(self.queue, self.storage, job, self.worker_id, scratch_dir)
+        except FileNotFoundError:
+            raise
+        except Exception as e:
+            raise InfrastructureError(f"Could not fetch the input: {str(e)}") from e
+
+    def run_job(self, job: Dict[str, Any]) -> None:
+        """
+        Runs a claimed job and reports its outcome. Only errors from the operation fail
+        the job for good; when job storage or the queue fails the job is abandoned and
+        runs again once its lease lapses.
+        """
+        job_id = job["job_id"]
+        scratch_dir = os.path.join(self.work_dir, job_id)
+        os.makedirs(scratch_dir, exist_ok=True)
+        with self._running_lock:
+            self._running.add(job_id)
+        try:
+            operation = str(job["operation"]).lower()
+            try:
+                input_path, checkpoint = self._prepare(job, scratch_dir)
+                if checkpoint.finished:
+                    print(f"Resuming job {job_id} with {len(checkpoint.finished)} finished segments.")
+                output_path = self.run_operation(operation, input_path, os.path.join(scratch_dir, operation), job.get("params") or {}, checkpoint=checkpoint)
+            except (InfrastructureError, LeaseLostError):
+                raise
+            except Exception as e:
+                print(f"Error in job {job_id}: {str(e)}")
+                finished = self.queue.fail(job_id, self.worker_id, str(e))
+            else:
+                output_key = f"outputs/{job_id}/{os.path.basename(output_path)}"
+                try:
+                    self.storage.put(output_path, output_key)
+                except Exception as e:
+                    raise InfrastructureError(f"Could not store the output: {str(e)}") from e
+                finished = self.queue.complete(job_id, self.worker_id, {"output_key": output_key, "size": os.path.getsize(output_path)})
+        except InfrastructureError as e:
+            print(f"Job {job_id} will be retried once its lease lapses. {str(e)}")
+            return
+        except LeaseLostError:
+            finished = False
+        finally:
+            with self._running_lock:
+                self._running.discard(job_id)
+            shutil.rmtree(scratch_dir, ignore_errors=True)
+        if not finished:
+            print(f"Job {job_id} was re-queued while worker {self.worker_id} ran it; result discarded.")
+            return
+        # Segments and uploaded inputs are only needed until the job has its final outcome
+        self.delete_job_files(job)
+
+    def _job_loop(self) -> None:
+        while not self.stop_event.is_set():
+            if not self._take_job_slot():
+                return
+            try:
+                job = self.queue.claim(self.worker_id, self.lease_seconds)
+            except Exception as e:
+                print(f"Error while claiming a job: {str(e)}")
+                job = None
+            if job is None:
+                with self._running_lock:
+                    if self._jobs_left is not None:
+                        self._jobs_left += 1
+                self.stop_event.wait(self.poll_seconds)
+                continue
+            print(f"Worker {self.worker_id} running job {job['job_id']} ({job['operation']}, attempt {job['attempts']}).")
+            try:
+                self.run_job(job)
+            except Exception as e:
+                # e.g. the queue was unreachable when reporting; the lease lapses and the job is retried
+                print(f"Error while reporting job {job['job_id']}: {str(e)}")
+
+    def run(self, max_jobs: Optional[int] = None) -> None:
+        """Processes jobs until stop() is called, or until max_jobs jobs have run."""
+        self._jobs_left = max_jobs
+        self.beat()
+        heartbeat = threading.Thread(target=self._heartbeat_loop, daemon=True, name="worker-heartbeat")
+        heartbeat.start()
+        threads: List[threading.Thread] = [
+            threading.Thread(target=self._job_loop, name=f"worker-{index}", daemon=self.daemon) for index in range(self.concurrency)
+        ]
+        for thread in threads:
+            thread.start()
+        try:
+            for thread in threads:
+                thread.join()
+        finally:
+            self.stop_event.set()
+
+    def stop(self) -> None:
+        self.stop_event.set()
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Run queued processing jobs from a shared job queue.")
+    parser.add_argument("--queue", default=job_queue.JOB_QUEUE_URL, help="Job queue URL (sqlite://, redis://)")
+    parser.add_argument("--storage", default=job_storage.JOB_STORAGE_URL, help="Job storage URL (file://, s3://)")
+    parser.add_argument("--concurrency", type=int, default=1, help="Jobs run at once by this worker")
+    parser.add_argument("--worker-id", default=None)
+    parser.add_argument("--max-jobs", type=int, default=None, help="Exit after this many jobs")
+    args = parser.parse_args(argv)
+
+    # Imported here so the worker shares the API's operations without a circular import
+    from main import run_operation
+
+    worker = Worker(
+        job_queue.open_queue(args.queue),
+        job_storage.open_storage(args.storage),
+        run_operation,
+        concurrency=args.concurrency,
+        worker_id=args.worker_id,
+    )
+    print(f"Worker {worker.worker_id} polling {args.queue}.")
+    try:
+        worker.run(max_jobs=args.max_jobs)
+    except KeyboardInterrupt:
+        worker.stop()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,145 @@
+"""
+Prewarmed process pool for blocking processing jobs.
+
+Jobs (module-level functions and their arguments) run in spawned worker processes,
+so the event loop stays free and a crashing job cannot take the server down. The
+workers are started and their imports done at boot: the first requests of a fresh
+instance do not pay process start-up or import costs, and /ready reports when the
+pool can take traffic.
+"""
+import asyncio
+import functools
+import importlib
+import multiprocessing
+import os
+import pickle
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Iterable, Optional
+
+from fastapi.concurrency import run_in_threadpool
+
+# 0 disables the pool; jobs then run on the event loop's thread pool
+PROCESS_WORKERS = int(os.environ.get("UPSCALEFX_PROCESS_WORKERS", str(os.cpu_count() or 1)))
+
+_pool: Optional[ProcessPoolExecutor] = None
+_warm_modules: tuple = ()
+_workers = PROCESS_WORKERS
+_ready = threading.Event()
+_lock = threading.Lock()
+
+
+def _initialize(modules: Iterable[str]) -> None:
+    for name in modules:
+        importlib.import_module(name)
+
+
+def _ping() -> int:
+    return os.getpid()
+
+
+def _call(fn: Callable, args: tuple, kwargs: dict) -> Any:
+    """Runs a job in a worker; exceptions that would not survive pickling are flattened."""
+    try:
+        return fn(*args, **kwargs)
+    except Exception as e:
+        try:
+            pickle.loads(pickle.dumps(e))
+        except Exception:
+            # e.g. ffmpeg.Error, whose constructor cannot be replayed from its args
+            raise Exception(str(e)) from None
+        raise
+    finally:
+        # The caller usually deletes the job's inputs next, and cannot reach this process's decode pool
+        decode_pool = sys.modules.get("decode_pool")
+        if decode_pool is not None:
+            decode_pool.close_all()
+
+
+def _warm(pool: ProcessPoolExecutor, workers: int) -> None:
+    try:
+        # One task per worker forces every process to spawn and run its imports
+        for future in [pool.submit(_ping) for _ in range(workers)]:
+            future.result()
+        _ready.set()
+    except Exception as e:
+        print(f"Error while prewarming processing workers: {str(e)}")
+
+
+def start(warm_modules: Iterable[str] = (), workers: int = PROCESS_WORKERS) -> None:
+    """
+    Starts the pool and warms it in the background; warm_modules are imported by every
+    worker before it takes jobs (typically the modules defining the job functions).
+    """
+    global _pool, _warm_modules
+    if workers <= 0:
+        _ready.set()
+        return
+    with _lock:
+        if _pool is not None:
+            return
+        _warm_modules = tuple(warm_modules)
+        _start_locked(workers)
+
+
+def _start_locked(workers: int) -> None:
+    global _pool, _workers
+    _workers = workers
+    # Forking a threaded server is unsafe; spawned workers start from a clean interpreter
+    _pool = ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_initialize,
+        initargs=(_warm_modules,),
+    )
+    _ready.clear()
+    threading.Thread(target=_warm, args=(_pool, workers), daemon=True).start()
+
+
+def _replace_broken(pool: ProcessPoolExecutor) -> None:
+    """
+    Replaces pool with a fresh one, unless it was already replaced: every job running
+    on a broken pool fails at once, and only the first of them may restart it.
+    """
+    with _lock:
+        if _pool is not pool:
+            return
+        _start_locked(_workers)
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def shutdown() -> None:
+    global _pool
+    with _lock:
+        pool, _pool = _pool, None
+        _ready.clear()
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def is_ready() -> bool:
+    return _ready.is_set()
+
+
+def worker_count() -> int:
+    return PROCESS_WORKERS if _pool is not None else 0
+
+
+async def run_in_process(fn: Callable, *args, **kwargs) -> Any:
+    """
+    Awaits fn(*args, **kwargs) on a pooled worker process. fn and its arguments must be
+    picklable (module-level functions, functools.partial of them). Without a running
+    pool the job runs on the thread pool instead.
+    """
+    pool = _pool
+    if pool is None:
+        return await run_in_threadpool(fn, *args, **kwargs)
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.run_in_executor(pool, functools.partial(_call, fn, args, kwargs))
+    except BrokenProcessPool:
+        # A worker died mid-job; replace the pool so later jobs are not refused
+        _replace_broken(pool)
+        raise Exception("The processing worker stopped unexpectedly.")